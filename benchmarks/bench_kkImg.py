@@ -0,0 +1,406 @@
+"""
+kkImg の変換・日時推測の処理速度を測る
+
+  python benchmarks/bench_kkImg.py --output bench_results.json
+
+合成した PNG/JPEG を一時ディレクトリに作って測るので, 手元の画像は使わない
+avifenc / exiftool が見つからない項目は skipped として記録する
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import re
+import zlib
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import kkImg  # noqa: E402
+
+
+def write_png(path, width, height, seed):
+    # スクリーンショットのような, 色の帯と少しのノイズからなる画像
+    rng = random.Random(seed)
+    bands = []
+    y = 0
+    while y < height:
+        band_height = rng.randint(8, max(8, height // 6))
+        segments = []
+        x = 0
+        while x < width:
+            segment_width = min(width - x, rng.randint(16, max(16, width // 4)))
+            segments.append(bytes(rng.randrange(256) for _ in range(3)) * segment_width)
+            x += segment_width
+        row = b"".join(segments)
+        for _ in range(min(band_height, height - y)):
+            if rng.random() < 0.1:
+                # 文字のような細かい模様
+                start = rng.randrange(0, width - 64) * 3 if width > 64 else 0
+                noise = bytes(rng.randrange(256) for _ in range(min(64, width) * 3))
+                bands.append(b"\x00" + row[:start] + noise + row[start + len(noise):])
+            else:
+                bands.append(b"\x00" + row)
+        y += band_height
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(b"".join(bands), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def write_jpeg(png_path, jpeg_path):
+    if kkImg.Image is not None:
+        with kkImg.Image.open(png_path) as image:
+            image.convert("RGB").save(jpeg_path, format="JPEG", quality=90)
+        return True
+    if shutil.which("magick"):
+        subprocess.run(["magick", png_path, "-quality", "90", jpeg_path], check=True)
+        return True
+    return False
+
+
+def make_corpus(directory, count, width, height):
+    names = []
+    for index in range(count):
+        taken = datetime(2023, 1, 1) + timedelta(minutes=index)
+        png_name = taken.strftime("Screenshot_%Y%m%d-%H%M%S.png")
+        png_path = os.path.join(directory, png_name)
+        write_png(png_path, width, height, index)
+        names.append(png_name)
+        # 4枚に1枚は JPEG にする
+        if index % 4 == 0:
+            jpeg_name = taken.strftime("IMG_%Y%m%d_%H%M%S.jpg")
+            if write_jpeg(png_path, os.path.join(directory, jpeg_name)):
+                names.append(jpeg_name)
+    return names
+
+
+def synthetic_names(count):
+    rng = random.Random(0)
+    base = datetime(2020, 1, 1)
+    formats = [
+        "vlcsnap-%Y-%m-%d-%Hh%Mm%Ss123.png",
+        "VirtualBox_Windows_%d_%m_%Y_%H_%M_%S.png",
+        "Screenshot_%Y%m%d-%H%M%S.png",
+        "IMG_%Y%m%d_%H%M%S.jpg",
+        "Polish_%Y%m%d_%H%M%S123.jpg",
+        "chrome_image_%Y_%m_%d %H_%M_%S JST.png",
+        "%y-%m-%d-%H-%M-%S-123_photo.jpg",
+        "DSC%H%M%S.JPG",
+    ]
+    names = []
+    for index in range(count):
+        value = base + timedelta(seconds=rng.randrange(10 ** 8))
+        names.append(value.strftime(formats[index % len(formats)]))
+    return names
+
+
+# 比較用: FilenameDateEngine に置き換える前の関数 (そのままの写し)
+# 先頭の文字列で分けていた convert_filename_to_datetime (以下 legacy) と, 正規表現を順に試していた convert_filename_to_datetime_2
+
+
+def legacy_convert_vlcsnap_filename_to_datetime(filename):
+  match = re.match(r"vlcsnap-(\d{4})-(\d{2})-(\d{2})-(\d{2})h(\d{2})m(\d{2})s(\d{3}).png", filename)
+  if match:
+    return str(match.group(1)) + ":" + str(match.group(2)) + ":" + str(match.group(3)) + " " + str(match.group(4)) + ":" + str(match.group(5)) + ":" + str(match.group(6))
+  else:
+    return filename
+
+def legacy_convert_virtualbox_filename_to_datetime(filename):
+  match = re.match(r"VirtualBox_Windows_(\d{2})_(\d{2})_(\d{4})_(\d{2})_(\d{2})_(\d{2}).png", filename)
+  if match:
+    return str(match.group(3)) + ":" + str(match.group(2)) + ":" + str(match.group(1)) + " " + str(match.group(4)) + ":" + str(match.group(5)) + ":" + str(match.group(6))
+  else:
+    return filename
+
+def legacy_convert_screenshot_filename_to_datetime(filename):
+  match = re.match(r"Screenshot_(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2}).png", filename)
+  if match:
+    return str(match.group(1)) + ":" + str(match.group(2)) + ":" + str(match.group(3)) + " " + str(match.group(4)) + ":" + str(match.group(5)) + ":" + str(match.group(6))
+  else:
+    return filename
+
+def legacy_convert_screenshot_unix_filename_to_datetime(filename):
+    match = re.match(r"Screenshot_(\d{10}).png", filename)
+    if match:
+        timestamp = int(match.group(1))
+        datetime = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+        return datetime.strftime("%Y:%m:%d %H:%M:%S")
+    else:
+        return filename
+
+# IMG_20220812_121806.jpg
+def legacy_convert_img_filename_to_datetime(filename):
+  match = re.match(r"IMG_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2}).jpg", filename)
+  if match:
+    return str(match.group(1)) + ":" + str(match.group(2)) + ":" + str(match.group(3)) + " " + str(match.group(4)) + ":" + str(match.group(5)) + ":" + str(match.group(6))
+  else:
+    return filename
+
+# Polish_20220813_200837408.jpg
+def legacy_convert_polish_filename_to_datetime(filename):
+  match = re.match(r"Polish_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})(\d{3}).jpg", filename)
+  if match:
+    return str(match.group(1)) + ":" + str(match.group(2)) + ":" + str(match.group(3)) + " " + str(match.group(4)) + ":" + str(match.group(5)) + ":" + str(match.group(6))
+  else:
+    return filename
+
+# Unix時間と拡張子のみで構成されたファイル名かどうか
+def legacy_is_unix_timestamp_filename(filename):
+  # ファイル名の末尾に拡張子が存在するかどうか
+  if not filename.endswith(".jpg") and not filename.endswith(".png") and not filename.endswith(".mp4"):
+    return False
+  # ファイル名の先頭10文字が数字かどうか
+  try:
+    base_name = filename[:-4]
+    # Unix時間が10桁または13桁であるかを確認
+    if len(base_name) in [10, 13]:
+      int(base_name)
+    else:
+      return False
+  except ValueError:
+    return False
+  return True
+
+# Unix時間と拡張子のみで構成されたファイル名の抽出
+def legacy_convert_unix_timestamp_filename_to_datetime(filename):
+  base_name = filename[:-4]
+  # Unix時間をdatetimeに変換
+  unix_timestamp = int(base_name)
+  # 13桁のUnix時間の場合は10桁に変換
+  if len(str(unix_timestamp)) == 13:
+    unix_timestamp //= 1000
+  datetimeA = datetime.fromtimestamp(unix_timestamp)
+  # 日付と時刻を結合
+  return datetimeA.strftime("%Y:%m:%d %H:%M:%S")
+
+def legacy_convert_other_filename_to_datetime(filename):
+  # ファイル名末尾の括弧と連番を削除
+  filename = re.sub(r"\(.*\)", "", filename)
+  # ハイフンをコロンに置き換える
+  filename = filename.replace("-", ":")
+  # 拡張子 ".png" を削除する
+  if filename.endswith(".png"):
+    filename = filename[:-4]
+  return filename
+
+def legacy_convert_filename_to_datetime(filename):
+  """
+  Args:
+    filename: ファイル名
+  Returns:
+    yyyy:MM:dd hh:mm:ss
+  """
+  # VLCスナップショット
+  if filename.startswith("vlcsnap-"):
+    return legacy_convert_vlcsnap_filename_to_datetime(filename)
+  # VirtualBox
+  elif filename.startswith("VirtualBox_Windows_"):
+    return legacy_convert_virtualbox_filename_to_datetime(filename)
+  # スクリーンショット
+  elif filename.startswith("Screenshot_"):
+    # 2種類の抽出関数を試して、成功した方を返す
+    datetime = legacy_convert_screenshot_filename_to_datetime(filename)
+    if datetime != filename:
+        return datetime
+    return legacy_convert_screenshot_unix_filename_to_datetime(filename)
+
+  # IMGファイル (IMG_20220812_121806.jpg)
+  elif filename.startswith("IMG_"):
+    return legacy_convert_img_filename_to_datetime(filename)
+
+  # Polishファイル (Polish_20220813_200837408.jpg)
+  elif filename.startswith("Polish_"):
+    return legacy_convert_polish_filename_to_datetime(filename)
+
+  # Unix時間と拡張子のみで構成されたファイル名 (1660318616181.mp4)
+  elif legacy_is_unix_timestamp_filename(filename):
+    return legacy_convert_unix_timestamp_filename_to_datetime(filename)
+
+  # その他
+  else:
+    return legacy_convert_other_filename_to_datetime(filename)
+
+
+def baseline_filename_to_datetime_2(filename):
+    patterns = [
+        (r"vlcsnap-(\d{4})-(\d{2})-(\d{2})-(\d{2})h(\d{2})m(\d{2})s(\d{3}).png", "{0}:{1}:{2} {3}:{4}:{5}"),
+        (r"VirtualBox_Windows_(\d{2})_(\d{2})_(\d{4})_(\d{2})_(\d{2})_(\d{2}).png", "{2}:{1}:{0} {3}:{4}:{5}"),
+        (r"Screenshot_(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2}).png", "{0}:{1}:{2} {3}:{4}:{5}"),
+        (r"Screenshot_(\d{10}).png", lambda match: datetime.fromtimestamp(int(match.group(1)), tz=timezone.utc).strftime("%Y:%m:%d %H:%M:%S")),
+        (r"IMG_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2}).jpg", "{0}:{1}:{2} {3}:{4}:{5}"),
+        (r"Polish_(\d{8})_(\d{6})\d{3}.jpg", "{0}:{1}:{2} {3}:{4}:{5}"),
+        (r"chrome_image_(\d{4})_(\d{2})_(\d{2}) (\d{2})_(\d{2})_(\d{2}) JST.png", "{0}:{1}:{2} {3}:{4}:{5}"),
+        (r"(\d{13}).(jpg|png)", lambda match: datetime.fromtimestamp(int(match.group(1)) / 1000, tz=timezone(timedelta(hours=9))).strftime("%Y:%m:%d %H:%M:%S")),
+        (r"(\d{2})-(\d{2})-(\d{2})-(\d{2})-(\d{2})-(\d{2})-(\d{3})_photo.jpg", lambda match: f"20{match.group(1)}:{match.group(2)}:{match.group(3)} {match.group(4)}:{match.group(5)}:{match.group(6)}"),
+    ]
+
+    for pattern, format_str in patterns:
+        match = re.match(pattern, filename)
+        if match:
+            if callable(format_str):
+                return format_str(match)
+            return format_str.format(*match.groups())
+    return filename
+
+
+REFERENCE = "convert_filename_to_datetime (legacy)"
+
+
+def bench_filename_parsing(count):
+    names = synthetic_names(count)
+    # 比較用の関数が例外を投げるファイル名 (Polish の IndexError など) は, 例外の処理の時間が入らないように全ての計測から外す
+    timed = []
+    for name in names:
+        try:
+            legacy_convert_filename_to_datetime(name)
+            baseline_filename_to_datetime_2(name)
+        except Exception:
+            continue
+        timed.append(name)
+    results = {"names": count, "timed_names": len(timed), "reference": REFERENCE}
+    # ユーザー定義のルールは読まない (手元の設定で結果が変わらないように)
+    engine = kkImg.FilenameDateEngine(kkImg.DEFAULT_DATE_RULES)
+
+    def engine_to_string():
+        for name in timed:
+            match = engine.match(name)
+            _ = name if match is None else kkImg.format_exif_datetime(match.datetime)
+
+    candidates = {
+        REFERENCE: lambda: [legacy_convert_filename_to_datetime(name) for name in timed],
+        "convert_filename_to_datetime_2 (before the engine)": lambda: [baseline_filename_to_datetime_2(name) for name in timed],
+        "engine.match_many": lambda: engine.match_many(timed),
+        "engine.match + format_exif_datetime": engine_to_string,
+    }
+    for label, run in candidates.items():
+        started = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - started
+        results[label] = {"seconds": round(seconds, 4), "seconds_per_million": round(seconds * 1_000_000 / max(1, len(timed)), 4)}
+    reference = results[REFERENCE]["seconds"]
+    for label in candidates:
+        results[label]["relative_to_reference"] = round(results[label]["seconds"] / reference, 3) if reference else None
+    return results
+
+
+def bench_conversion(corpus_dir, grid, quality, encoder):
+    if not shutil.which("avifenc") or not shutil.which("exiftool"):
+        return {"skipped": "avifenc または exiftool が見つかりません"}
+    results = []
+    for cpu_budget, files_in_flight in grid:
+        output_dir = tempfile.mkdtemp(prefix="kkImg_bench_out_")
+        try:
+            summary = kkImg.convert_directory(
+                corpus_dir, output_dir, quality=quality, cpu_budget=cpu_budget,
+                files_in_flight=files_in_flight, incremental=False, encoder=encoder,
+            )
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        files_per_second = summary["converted"] / summary["seconds"] if summary["seconds"] else 0
+        results.append(dict(summary, cpu_budget=cpu_budget, files_in_flight=files_in_flight,
+                            files_per_second=round(files_per_second, 3)))
+    return results
+
+
+def bench_exiftool(corpus_dir, calls):
+    if not shutil.which("exiftool"):
+        return {"skipped": "exiftool が見つかりません"}
+    path = os.path.join(corpus_dir, sorted(os.listdir(corpus_dir))[0])
+    started = time.perf_counter()
+    for _ in range(calls):
+        subprocess.run(["exiftool", "-T", "-DateTimeOriginal", path], stdout=subprocess.DEVNULL, check=True)
+    spawn_seconds = time.perf_counter() - started
+    pool = kkImg.get_exiftool_pool()
+    pool.read_tags(path, ["DateTimeOriginal"])  # 起動は測らない
+    started = time.perf_counter()
+    for _ in range(calls):
+        pool.read_tags(path, ["DateTimeOriginal"])
+    stay_open_seconds = time.perf_counter() - started
+    return {
+        "calls": calls,
+        "spawn_ms_per_call": round(spawn_seconds * 1000 / calls, 3),
+        "stay_open_ms_per_call": round(stay_open_seconds * 1000 / calls, 3),
+    }
+
+
+def parse_grid(value):
+    grid = []
+    for item in value.split(","):
+        cpu_budget, files_in_flight = item.split(":")
+        grid.append((int(cpu_budget), int(files_in_flight)))
+    return grid
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(kkImg.__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    cpu_count = os.cpu_count() or 1
+    default_grid = ",".join(f"{cpu_count}:{files}" for files in sorted({1, max(1, cpu_count // 4), cpu_count}))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="bench_results.json", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--names", type=int, default=200_000, help="日時推測に使うファイル名の数")
+    parser.add_argument("--files", type=int, default=32, help="合成する画像の枚数")
+    parser.add_argument("--size", default="1280x720", help="合成する画像の大きさ (幅x高さ)")
+    parser.add_argument("--grid", type=parse_grid, default=parse_grid(default_grid),
+                        help="変換を測る (スレッド総数:同時ファイル数) の組 (例: 32:1,32:8,32:32)")
+    parser.add_argument("--quality", type=int, default=30)
+    parser.add_argument("--encoder", choices=sorted(kkImg.AVIF_ENCODERS), default="avifenc")
+    parser.add_argument("--exiftool-calls", type=int, default=50)
+    parser.add_argument("--skip-convert", action="store_true")
+    parser.add_argument("--skip-exiftool", action="store_true")
+    args = parser.parse_args(argv)
+
+    width, height = (int(value) for value in args.size.lower().split("x"))
+    results = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": cpu_count,
+        "settings": {"names": args.names, "files": args.files, "size": args.size, "quality": args.quality, "encoder": args.encoder},
+    }
+    print("ファイル名からの日時推測...", file=sys.stderr)
+    results["filename_parsing"] = bench_filename_parsing(args.names)
+
+    corpus_dir = tempfile.mkdtemp(prefix="kkImg_bench_corpus_")
+    try:
+        if not (args.skip_convert and args.skip_exiftool):
+            print(f"画像を合成しています ({args.files}枚)...", file=sys.stderr)
+            results["corpus"] = {"files": len(make_corpus(corpus_dir, args.files, width, height))}
+        if not args.skip_convert:
+            print("変換...", file=sys.stderr)
+            results["conversion"] = bench_conversion(corpus_dir, args.grid, args.quality, args.encoder)
+        if not args.skip_exiftool:
+            print("exiftool...", file=sys.stderr)
+            results["exiftool"] = bench_exiftool(corpus_dir, args.exiftool_calls)
+    finally:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,176 +1,3052 @@
-import flet as ft
+try:
+    import flet as ft
+except ImportError:
+    # コマンドラインやライブラリとして使う場合は flet はなくてもよい
+    ft = None
 import os
+import sys
+import argparse
+import zlib
 import subprocess
-from subprocess import run, PIPE
+from subprocess import PIPE
 import re
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
 import tempfile
+from collections import namedtuple, OrderedDict
+import json
+import math
+import queue
+import threading
+import atexit
+import sqlite3
+import hashlib
+import socket
+import struct
+import csv
+import shutil
+import time
+import traceback
+import contextlib
+import operator
+import cProfile
+import pstats
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def convert_vlcsnap_filename_to_datetime(filename):
-  match = re.match(r"vlcsnap-(\d{4})-(\d{2})-(\d{2})-(\d{2})h(\d{2})m(\d{2})s(\d{3}).png", filename)
-  if match:
-    return str(match.group(1)) + ":" + str(match.group(2)) + ":" + str(match.group(3)) + " " + str(match.group(4)) + ":" + str(match.group(5)) + ":" + str(match.group(6))
-  else:
-    return filename
-
-def convert_virtualbox_filename_to_datetime(filename):
-  match = re.match(r"VirtualBox_Windows_(\d{2})_(\d{2})_(\d{4})_(\d{2})_(\d{2})_(\d{2}).png", filename)
-  if match:
-    return str(match.group(3)) + ":" + str(match.group(2)) + ":" + str(match.group(1)) + " " + str(match.group(4)) + ":" + str(match.group(5)) + ":" + str(match.group(6))
-  else:
-    return filename
-
-def convert_screenshot_filename_to_datetime(filename):
-  match = re.match(r"Screenshot_(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2}).png", filename)
-  if match:
-    return str(match.group(1)) + ":" + str(match.group(2)) + ":" + str(match.group(3)) + " " + str(match.group(4)) + ":" + str(match.group(5)) + ":" + str(match.group(6))
-  else:
-    return filename
-
-def convert_screenshot_unix_filename_to_datetime(filename):
-    match = re.match(r"Screenshot_(\d{10}).png", filename)
+# 任意: 入っていれば HEIC をプロセス内でデコード・エンコードする
+try:
+    from PIL import Image, ImageMath
+except ImportError:
+    Image = None
+    ImageMath = None
+try:
+    import pillow_heif
+except ImportError:
+    pillow_heif = None
+try:
+    # Pillow 11.3 より前は AVIF の保存をこのプラグインで追加する
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pillow_avif = None
+try:
+    # JPEG XL を Pillow で保存する
+    import pillow_jxl  # noqa: F401
+except ImportError:
+    pillow_jxl = None
+# 任意: 重複の検出に速いハッシュを使う
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# ファイル名から日時を推測するルール
+# pattern の名前付きグループ:
+#   Y (4桁の年) / y (2桁の年) / m / d / H / M / S / f (ミリ秒)
+#   unix (Unix時間 秒) / unix_ms (Unix時間 ミリ秒)
+# tz: 日時のタイムゾーン (None はローカル時刻). Unix時間の場合は表示に使うタイムゾーン
+DateRule = namedtuple("DateRule", ["name", "pattern", "tz"])
+DateMatch = namedtuple("DateMatch", ["datetime", "rule", "tz"])
+
+JST = timezone(timedelta(hours=9))
+
+DEFAULT_DATE_RULES = [
+    DateRule("vlcsnap", r"vlcsnap-(?P<Y>\d{4})-(?P<m>\d{2})-(?P<d>\d{2})-(?P<H>\d{2})h(?P<M>\d{2})m(?P<S>\d{2})s(?P<f>\d{3})\.png", None),
+    DateRule("virtualbox", r"VirtualBox_Windows_(?P<d>\d{2})_(?P<m>\d{2})_(?P<Y>\d{4})_(?P<H>\d{2})_(?P<M>\d{2})_(?P<S>\d{2})\.png", None),
+    DateRule("screenshot", r"Screenshot_(?P<Y>\d{4})(?P<m>\d{2})(?P<d>\d{2})-(?P<H>\d{2})(?P<M>\d{2})(?P<S>\d{2})\.png", None),
+    DateRule("screenshot_unix", r"Screenshot_(?P<unix>\d{10})\.png", timezone.utc),
+    DateRule("img", r"IMG_(?P<Y>\d{4})(?P<m>\d{2})(?P<d>\d{2})_(?P<H>\d{2})(?P<M>\d{2})(?P<S>\d{2})\.jpg", None),
+    DateRule("polish", r"Polish_(?P<Y>\d{4})(?P<m>\d{2})(?P<d>\d{2})_(?P<H>\d{2})(?P<M>\d{2})(?P<S>\d{2})(?P<f>\d{3})\.jpg", None),
+    DateRule("chrome_image", r"chrome_image_(?P<Y>\d{4})_(?P<m>\d{2})_(?P<d>\d{2}) (?P<H>\d{2})_(?P<M>\d{2})_(?P<S>\d{2}) JST\.png", JST),
+    DateRule("unix_ms", r"(?P<unix_ms>\d{13})\.(?:jpg|png)", JST),
+    DateRule("photo", r"(?P<y>\d{2})-(?P<m>\d{2})-(?P<d>\d{2})-(?P<H>\d{2})-(?P<M>\d{2})-(?P<S>\d{2})-(?P<f>\d{3})_photo\.jpg", None),
+]
+
+# ユーザー定義のルール (JSON) の置き場所
+DATE_RULES_CONFIG = os.environ.get("KKIMG_DATE_RULES", os.path.join(os.path.expanduser("~"), ".kkImg_date_rules.json"))
+
+_DATE_FIELDS = ("Y", "y", "m", "d", "H", "M", "S", "f", "unix", "unix_ms")
+
+def _parse_timezone(value):
+    if value is None:
+        return None
+    match = re.fullmatch(r"([+-])(\d{2}):?(\d{2})", value)
     if match:
-        timestamp = int(match.group(1))
-        datetime = datetime.fromtimestamp(timestamp, tz=timezone.utc)
-        return datetime.strftime("%Y:%m:%d %H:%M:%S")
-    else:
-        return filename
+        offset = timedelta(hours=int(match.group(2)), minutes=int(match.group(3)))
+        return timezone(-offset if match.group(1) == "-" else offset)
+    if value.upper() == "UTC":
+        return timezone.utc
+    return ZoneInfo(value)
 
-# IMG_20220812_121806.jpg
-def convert_img_filename_to_datetime(filename):
-  match = re.match(r"IMG_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2}).jpg", filename)
-  if match:
-    return str(match.group(1)) + ":" + str(match.group(2)) + ":" + str(match.group(3)) + " " + str(match.group(4)) + ":" + str(match.group(5)) + ":" + str(match.group(6))
-  else:
-    return filename
-
-# Polish_20220813_200837408.jpg
-def convert_polish_filename_to_datetime(filename):
-  match = re.match(r"Polish_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})(\d{3}).jpg", filename)
-  if match:
-    return str(match.group(1)) + ":" + str(match.group(2)) + ":" + str(match.group(3)) + " " + str(match.group(4)) + ":" + str(match.group(5)) + ":" + str(match.group(6))
-  else:
-    return filename
-
-# Unix時間と拡張子のみで構成されたファイル名かどうか
-def _is_unix_timestamp_filename(filename):
-  # ファイル名の末尾に拡張子が存在するかどうか
-  if not filename.endswith(".jpg") and not filename.endswith(".png") and not filename.endswith(".mp4"):
-    return False
-  # ファイル名の先頭10文字が数字かどうか
-  try:
-    base_name = filename[:-4]
-    # Unix時間が10桁または13桁であるかを確認
-    if len(base_name) in [10, 13]:
-      int(base_name)
-    else:
-      return False
-  except ValueError:
-    return False
-  return True
-
-# Unix時間と拡張子のみで構成されたファイル名の抽出
-def convert_unix_timestamp_filename_to_datetime(filename):
-  base_name = filename[:-4]
-  # Unix時間をdatetimeに変換
-  unix_timestamp = int(base_name)
-  # 13桁のUnix時間の場合は10桁に変換
-  if len(str(unix_timestamp)) == 13:
-    unix_timestamp //= 1000
-  datetimeA = datetime.fromtimestamp(unix_timestamp)
-  # 日付と時刻を結合
-  return datetimeA.strftime("%Y:%m:%d %H:%M:%S")
-
-def convert_other_filename_to_datetime(filename):
-  # ファイル名末尾の括弧と連番を削除
-  filename = re.sub(r"\(.*\)", "", filename)
-  # ハイフンをコロンに置き換える
-  filename = filename.replace("-", ":")
-  # 拡張子 ".png" を削除する
-  if filename.endswith(".png"):
-    filename = filename[:-4]
-  return filename
+def load_date_rules(path=DATE_RULES_CONFIG):
+    """
+    ユーザー定義のルールを読み込む
+    [{"name": "...", "pattern": "...", "tz": "+09:00"}, ...]
+    ファイルがなければ空のリストを返す
+    """
+    if not os.path.isfile(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    return [DateRule(entry["name"], entry["pattern"], _parse_timezone(entry.get("tz"))) for entry in entries]
 
-def convert_filename_to_datetime(filename):
-  """
-  Args:
-    filename: ファイル名
-  Returns:
-    yyyy:MM:dd hh:mm:ss
-  """
-  # VLCスナップショット
-  if filename.startswith("vlcsnap-"):
-    return convert_vlcsnap_filename_to_datetime(filename)
-  # VirtualBox
-  elif filename.startswith("VirtualBox_Windows_"):
-    return convert_virtualbox_filename_to_datetime(filename)
-  # スクリーンショット
-  elif filename.startswith("Screenshot_"):
-    # 2種類の抽出関数を試して、成功した方を返す
-    datetime = convert_screenshot_filename_to_datetime(filename)
-    if datetime != filename:
-        return datetime
-    return convert_screenshot_unix_filename_to_datetime(filename)
-
-  # IMGファイル (IMG_20220812_121806.jpg)
-  elif filename.startswith("IMG_"):
-    return convert_img_filename_to_datetime(filename)
-
-  # Polishファイル (Polish_20220813_200837408.jpg)
-  elif filename.startswith("Polish_"):
-    return convert_polish_filename_to_datetime(filename)
-
-  # Unix時間と拡張子のみで構成されたファイル名 (1660318616181.mp4)
-  elif _is_unix_timestamp_filename(filename):
-    return convert_unix_timestamp_filename_to_datetime(filename)
-
-  # その他
-  else:
-    return convert_other_filename_to_datetime(filename)
+class _Digits(dict):
+    # 表にない数字の文字列は int() で変換する
+    def __missing__(self, key):
+        return int(key)
+
+# ファイル名の日時によく出る数字の文字列 -> 数 (int() より速い)
+_DIGITS = _Digits(
+    [(f"{number:02d}", number) for number in range(100)]
+    + [(f"{number:03d}", number) for number in range(1000)]
+    + [(str(number), number) for number in range(1970, 2100)]
+)
+_digit = _DIGITS.__getitem__
+
+def _literal_prefix(pattern):
+    """
+    正規表現の先頭の, 必ずその文字で始まる部分 (分からなければ "")
+    """
+    # 一番外側に | があると先頭が決まらない
+    depth = 0
+    in_class = escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return ""
+    prefix = []
+    for char in pattern:
+        if char in "\\.^$*+?{}[]|()":
+            # 量指定子が付いた直前の文字はなくてもよい
+            if char in "*+?{" and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+    return "".join(prefix)
+
+class FilenameDateEngine:
+    """
+    ルール毎の正規表現の先頭の文字列で候補を絞り, 候補だけを順に照合して日時を取り出す
+    ルールは先に並んでいるものが優先される (日時として正しくなければ後のルールを試す)
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+        entries = []
+        for rule in self.rules:
+            fields = [field for field in _DATE_FIELDS if f"(?P<{field}>" in rule.pattern]
+            if not ({"unix", "unix_ms"} & set(fields) or {"m", "d"} <= set(fields) and ({"Y", "y"} & set(fields))):
+                raise ValueError(f"ルール {rule.name} に日付のグループがありません")
+            regex = re.compile(rule.pattern)
+            entries.append((_literal_prefix(rule.pattern), regex.match, self._converter(rule, fields, regex), (rule.name, rule.tz)))
+        # ファイル名の1文字目 -> 照合するルール (先頭の文字列がないルールは常に候補)
+        self._any = tuple(entry for entry in entries if not entry[0])
+        self._by_first = {}
+        for first in {entry[0][0] for entry in entries if entry[0]}:
+            self._by_first[first] = tuple(entry for entry in entries if not entry[0] or entry[0][0] == first)
+
+    # datetime() に渡す引数の順番
+    _DATETIME_ORDER = ("year", "m", "d", "H", "M", "S", "f")
+
+    @classmethod
+    def _converter(cls, rule, fields, regex):
+        """
+        Returns:
+          照合の結果から datetime を作る関数 (日時として正しくなければ ValueError など)
+        """
+        tz = rule.tz
+        groupindex = regex.groupindex
+        if "unix" in fields:
+            index = groupindex["unix"]
+            tz = tz or timezone.utc
+            return lambda match: datetime.fromtimestamp(int(match.group(index)), tz=tz)
+        if "unix_ms" in fields:
+            index = groupindex["unix_ms"]
+            tz = tz or timezone.utc
+            return lambda match: datetime.fromtimestamp(int(match.group(index)) / 1000, tz=tz)
+        year = "Y" if "Y" in fields else "y"
+        names = [name for name in cls._DATETIME_ORDER if name == "year" or name in fields]
+        indices = tuple(groupindex[year if name == "year" else name] for name in names)
+        positions = [cls._DATETIME_ORDER.index(name) for name in names]
+        if indices == tuple(range(1, regex.groups + 1)):
+            # 日時のグループだけが順に並んでいる
+            values = operator.methodcaller("groups")
+        else:
+            values = operator.methodcaller("group", *indices)
+        if positions == list(range(len(positions))):
+            if year == "Y" and "f" not in fields:
+                # よくある形 (年月日時分秒の順) はそのまま渡す
+                if tz is None:
+                    return lambda match: datetime(*map(_digit, values(match)))
+                return lambda match: datetime(*map(_digit, values(match)), tzinfo=tz)
+
+            def convert(match):
+                numbers = list(map(_digit, values(match)))
+                if year == "y":
+                    numbers[0] += 2000
+                if len(numbers) == 7:
+                    numbers[6] *= 1000
+                return datetime(*numbers, tzinfo=tz)
+            return convert
+
+        def convert(match):
+            # 途中の項目がない (時と秒だけなど)
+            numbers = [0] * 7
+            for position, value in zip(positions, values(match)):
+                numbers[position] = _digit(value)
+            if year == "y":
+                numbers[0] += 2000
+            numbers[6] *= 1000
+            return datetime(*numbers, tzinfo=tz)
+        return convert
+
+    def match(self, filename):
+        """
+        Returns:
+          DateMatch (どのルールにも合わなければ None)
+        """
+        for prefix, regex_match, convert, rule in self._by_first.get(filename[:1], self._any):
+            # rule は (ルールの名前, タイムゾーン)
+            if prefix and not filename.startswith(prefix):
+                continue
+            match = regex_match(filename)
+            if match is None:
+                continue
+            try:
+                value = convert(match)
+            except (ValueError, OverflowError, OSError):
+                continue
+            return DateMatch._make((value, *rule))
+        return None
+
+    def match_many(self, filenames):
+        """
+        Returns:
+          {ファイル名: DateMatch または None}
+        """
+        match = self.match
+        return {filename: match(filename) for filename in filenames}
+
+_date_engine = None
+_date_rules_error = None
+
+def get_date_engine():
+    """
+    ユーザー定義のルールが読めない場合は組み込みのルールだけを使う (理由は date_rules_error() で分かる)
+    """
+    global _date_engine, _date_rules_error
+    if _date_engine is None:
+        _date_rules_error = None
+        try:
+            _date_engine = FilenameDateEngine(load_date_rules(DATE_RULES_CONFIG) + DEFAULT_DATE_RULES)
+        except Exception as exc:
+            # JSON の誤り, 正規表現の誤り, 不明なタイムゾーンなど
+            _date_rules_error = f"{DATE_RULES_CONFIG}: {exc}"
+            _date_engine = FilenameDateEngine(DEFAULT_DATE_RULES)
+    return _date_engine
+
+def date_rules_error():
+    """
+    Returns:
+      ユーザー定義のルールを読み込めなかった理由 (読み込めた場合は None)
+    """
+    get_date_engine()
+    return _date_rules_error
+
+def format_exif_datetime(value):
+    return value.strftime("%Y:%m:%d %H:%M:%S")
 
 # 試験運用
 
 def convert_filename_to_datetime_2(filename):
-    patterns = [
-        (r"vlcsnap-(\d{4})-(\d{2})-(\d{2})-(\d{2})h(\d{2})m(\d{2})s(\d{3}).png", "{0}:{1}:{2} {3}:{4}:{5}"),
-        (r"VirtualBox_Windows_(\d{2})_(\d{2})_(\d{4})_(\d{2})_(\d{2})_(\d{2}).png", "{2}:{1}:{0} {3}:{4}:{5}"),
-        (r"Screenshot_(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2}).png", "{0}:{1}:{2} {3}:{4}:{5}"),
-        (r"Screenshot_(\d{10}).png", lambda match: datetime.fromtimestamp(int(match.group(1)), tz=timezone.utc).strftime("%Y:%m:%d %H:%M:%S")),
-        (r"IMG_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2}).jpg", "{0}:{1}:{2} {3}:{4}:{5}"),
-        (r"Polish_(\d{8})_(\d{6})\d{3}.jpg", "{0}:{1}:{2} {3}:{4}:{5}"),
-        (r"chrome_image_(\d{4})_(\d{2})_(\d{2}) (\d{2})_(\d{2})_(\d{2}) JST.png", "{0}:{1}:{2} {3}:{4}:{5}"),
-        (r"(\d{13}).(jpg|png)", lambda match: datetime.fromtimestamp(int(match.group(1)) / 1000, tz=timezone(timedelta(hours=9))).strftime("%Y:%m:%d %H:%M:%S")),
-        (r"(\d{2})-(\d{2})-(\d{2})-(\d{2})-(\d{2})-(\d{2})-(\d{3})_photo.jpg", lambda match: f"20{match.group(1)}:{match.group(2)}:{match.group(3)} {match.group(4)}:{match.group(5)}:{match.group(6)}"),
-    ]
+    result = get_date_engine().match(filename)
+    if result is None:
+        return filename
+    return format_exif_datetime(result.datetime)
+
+def convert_filename_to_datetime(filename):
+    """
+    以前の名前 (ファイル名の先頭で分けていた関数). convert_filename_to_datetime_2 と同じ
+    Returns:
+      yyyy:MM:dd hh:mm:ss (推測できなければファイル名)
+    """
+    return convert_filename_to_datetime_2(filename)
+
+# スキャンで見つかったファイル (relpath は走査したディレクトリからの相対パス)
+ScanEntry = namedtuple("ScanEntry", ["path", "relpath", "name", "size", "mtime_ns"])
+
+def scan_directory(directory, extensions=None, recursive=False):
+    """
+    os.scandir でディレクトリをたどり, 見つかった順に ScanEntry を返すジェネレーター
+    Args:
+      directory: 対象ディレクトリ
+      extensions: 対象の拡張子 (大文字小文字は区別しない). None の場合は全て
+      recursive: サブディレクトリもたどるかどうか
+    """
+    if extensions is not None:
+        extensions = tuple(ext.lower() for ext in extensions)
+    stack = [(directory, "")]
+    while stack:
+        current, prefix = stack.pop()
+        subdirs = []
+        try:
+            iterator = os.scandir(current)
+        except OSError:
+            # 最初のディレクトリが読めない場合はそのままエラーにする
+            if current is directory:
+                raise
+            continue
+        with iterator:
+            for entry in iterator:
+                relpath = os.path.join(prefix, entry.name) if prefix else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            subdirs.append((entry.path, relpath))
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if extensions is not None and not entry.name.lower().endswith(extensions):
+                        continue
+                    # DirEntry の stat を使い回す (Windows ではディレクトリの読み込み時に取得済み)
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield ScanEntry(entry.path, relpath, entry.name, stat.st_size, stat.st_mtime_ns)
+        stack.extend(reversed(subdirs))
+
+class ScanResult:
+    """
+    1回分のスキャン結果
+    列挙の途中でも先頭から順に読むことができ, 2回目以降は記録した結果を返す
+    """
+    def __init__(self, directory, extensions=None, recursive=False):
+        self.directory = directory
+        self.extensions = extensions
+        self.recursive = recursive
+        self.complete = False
+        self._source = scan_directory(directory, extensions, recursive)
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        index = 0
+        while True:
+            with self._lock:
+                if index < len(self._entries):
+                    entry = self._entries[index]
+                elif self.complete:
+                    return
+                else:
+                    try:
+                        entry = next(self._source)
+                    except StopIteration:
+                        self.complete = True
+                        return
+                    self._entries.append(entry)
+            index += 1
+            yield entry
+
+    def entries(self):
+        # 最後まで列挙する
+        return [entry for entry in self]
+
+    def __len__(self):
+        return len(self.entries())
+
+    def stats(self):
+        return {entry.path: (entry.size, entry.mtime_ns) for entry in self.entries()}
+
+# 残しておくスキャン結果の数 (ディレクトリを選び直す毎に増えないように, 古く使われたものから捨てる)
+SCAN_CACHE_SIZE = 4
+
+_scan_cache = OrderedDict()
+_scan_cache_lock = threading.Lock()
 
-    for pattern, format_str in patterns:
-        match = re.match(pattern, filename)
-        if match:
-            if callable(format_str):
-                return format_str(match)
-            return format_str.format(*match.groups())
-    return filename
+def get_directory_scan(directory, extensions=None, recursive=False, refresh=False):
+    """
+    同じ条件のスキャン結果を共有する (確認と変換で同じディレクトリを2回読まない)
+    refresh=True の場合は読み直す
+    """
+    key = (os.path.abspath(directory), tuple(extensions) if extensions else None, recursive)
+    with _scan_cache_lock:
+        result = _scan_cache.get(key)
+        if result is None or refresh:
+            result = ScanResult(directory, extensions, recursive)
+            _scan_cache[key] = result
+        _scan_cache.move_to_end(key)
+        while len(_scan_cache) > SCAN_CACHE_SIZE:
+            _scan_cache.popitem(last=False)
+        return result
 
 # 廃止予定
 def list_png_files(directory):
-    png_files = [file for file in os.listdir(directory) if file.lower().endswith(('.png', '.jpeg', '.jpg', '.heic'))]
-    return png_files
+    return list_files(directory, ('.png', '.jpeg', '.jpg', '.heic'))
 
 def list_files(directory, extensions):
-    return [f for f in os.listdir(directory) if f.lower().endswith(extensions)] 
+    return [entry.name for entry in scan_directory(directory, extensions)]
 
 def get_image_files(exe, directory_path):
-    exew = '.' + str(exe)
-    png_files = [file for file in os.listdir(directory_path) if file.lower().endswith(exew)]
-    return png_files
+    return list_files(directory_path, ('.' + str(exe),))
 
 def replace_extension(filename, new_extension):
     base_name, _ = os.path.splitext(filename)  # 拡張子を除いたファイル名を取得
     new_filename = f"{base_name}.{new_extension}"  # 新しい拡張子を含むファイル名を作成
     return new_filename
 
-def main(page: ft.Page):
+class ExifToolError(RuntimeError):
+    pass
+
+class _PipeReader:
+    """
+    パイプを別スレッドで読み続ける
+    exiftool が stderr に大量に書いた時に, パイプが詰まって両方が止まらないようにする
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._buffer = b""
+        self._eof = False
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                chunk = os.read(self._stream.fileno(), 65536)
+            except OSError:
+                chunk = b""
+            with self._condition:
+                if not chunk:
+                    self._eof = True
+                else:
+                    self._buffer += chunk
+                self._condition.notify_all()
+            if not chunk:
+                return
+
+    def read_until(self, marker):
+        marker = marker.encode("utf-8")
+        with self._condition:
+            while True:
+                index = self._buffer.find(marker)
+                if index >= 0:
+                    text = self._buffer[:index]
+                    self._buffer = self._buffer[index + len(marker):].lstrip(b"\r\n")
+                    return text.rstrip().decode("utf-8", errors="replace")
+                if self._eof:
+                    raise EOFError("exiftool が終了しました")
+                self._condition.wait()
+
+class ExifToolProcess:
+    """
+    exiftool -stay_open True -@ - で起動したままにした1つのプロセス
+    コマンドは -execute 毎に区切って送り, {readyN} が返ってくるまで読む
+    """
+    def __init__(self, executable="exiftool"):
+        self.executable = executable
+        self._process = None
+        self._stderr = None
+        self._lock = threading.Lock()
+        self._counter = 0
+
+    def _start(self):
+        self._process = subprocess.Popen(
+            [self.executable, "-stay_open", "True", "-@", "-", "-common_args", "-charset", "filename=utf8"],
+            stdin=PIPE, stdout=PIPE, stderr=PIPE,
+        )
+        self._stderr = _PipeReader(self._process.stderr)
+
+    def _kill(self):
+        if self._process is not None:
+            try:
+                self._process.kill()
+                self._process.wait()
+            except OSError:
+                pass
+        self._process = None
+
+    @staticmethod
+    def _read_until(stream, marker):
+        marker = marker.encode("utf-8")
+        buf = b""
+        while not buf.rstrip().endswith(marker):
+            chunk = os.read(stream.fileno(), 65536)
+            if not chunk:
+                raise EOFError("exiftool が終了しました")
+            buf += chunk
+        return buf.rstrip()[:-len(marker)].decode("utf-8", errors="replace")
+
+    def execute(self, *args):
+        """
+        Args:
+          args: exiftool に渡す引数 (1つずつ)
+        Returns:
+          (stdout, stderr)
+        """
+        if any("\n" in str(arg) for arg in args):
+            raise ValueError("exiftool の引数に改行は使えません")
+        with self._lock:
+            # プロセスが落ちていたら起動し直して1回だけやり直す
+            for attempt in range(2):
+                if self._process is None or self._process.poll() is not None:
+                    self._start()
+                self._counter += 1
+                marker = "{ready%d}" % self._counter
+                payload = "\n".join([str(arg) for arg in args] + ["-echo4", marker, "-execute%d" % self._counter]) + "\n"
+                try:
+                    self._process.stdin.write(payload.encode("utf-8"))
+                    self._process.stdin.flush()
+                    stdout = self._read_until(self._process.stdout, marker)
+                    stderr = self._stderr.read_until(marker)
+                except (OSError, EOFError) as exc:
+                    self._kill()
+                    if attempt:
+                        raise ExifToolError(f"exiftool との通信に失敗しました: {exc}") from exc
+                    continue
+                return stdout, stderr
+
+    def close(self):
+        with self._lock:
+            if self._process is None:
+                return
+            try:
+                self._process.stdin.write(b"-stay_open\nFalse\n")
+                self._process.stdin.flush()
+                self._process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+            self._kill()
+
+class ExifToolPool:
+    """
+    起動したままの exiftool を複数抱えて, 同時に来た要求をそれぞれ別のプロセスに振り分ける
+    """
+    def __init__(self, size=None, executable="exiftool"):
+        self.size = size or max(1, min(8, os.cpu_count() or 1))
+        self._idle = queue.LifoQueue()
+        # プロセスは最初に使われた時に起動する
+        self._workers = [ExifToolProcess(executable) for _ in range(self.size)]
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def execute(self, *args):
+        worker = self._idle.get()
+        try:
+            return worker.execute(*args)
+        finally:
+            self._idle.put(worker)
+
+    def read_tags_many(self, paths, tags):
+        """
+        Returns:
+          {パス: {タグ名: 値}}
+        """
+        paths = list(paths)
+        if not paths:
+            return {}
+        stdout, stderr = self.execute("-json", *["-" + tag for tag in tags], *paths)
+        try:
+            records = json.loads(stdout) if stdout.strip() else []
+        except ValueError as exc:
+            raise ExifToolError(stderr.strip() or str(exc)) from exc
+        # Windows では SourceFile の区切りが / になるので正規化して突き合わせる
+        by_key = {os.path.normcase(os.path.normpath(path)): path for path in paths}
+        result = {path: {} for path in paths}
+        for record in records:
+            source = record.pop("SourceFile", "")
+            path = by_key.get(os.path.normcase(os.path.normpath(source)), source)
+            result[path] = record
+        return result
+
+    def read_tags(self, path, tags):
+        return self.read_tags_many([path], tags).get(path, {})
+
+    def execute_checked(self, *args):
+        # stay_open では終了コードが取れないので stderr で失敗を判定する
+        stdout, stderr = self.execute(*args)
+        if "Error" in stderr:
+            raise ExifToolError(stderr.strip())
+        return stdout
+
+    def write_tags(self, path, tags, overwrite_original=False):
+        args = [f"-{tag}={value}" for tag, value in tags.items()]
+        if overwrite_original:
+            args.append("-overwrite_original")
+        return self.execute_checked(*args, path)
+
+    def copy_tags(self, src_path, dst_path, overwrite_original=True):
+        return self.copy_tags_many(src_path, [dst_path], overwrite_original)
+
+    def copy_tags_many(self, src_path, dst_paths, overwrite_original=True):
+        # 1回の呼び出しで複数の出力にコピーする
+        args = ["-TagsFromFile", src_path, *dst_paths]
+        if overwrite_original:
+            args.append("-overwrite_original")
+        return self.execute_checked(*args)
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+
+_exiftool_pool = None
+_exiftool_pool_lock = threading.Lock()
+
+def get_exiftool_pool():
+    global _exiftool_pool
+    with _exiftool_pool_lock:
+        if _exiftool_pool is None:
+            _exiftool_pool = ExifToolPool()
+            atexit.register(_exiftool_pool.close)
+        return _exiftool_pool
+
+class ExifTagCache:
+    """
+    exiftool で読んだタグを (パス, 更新日時, サイズ) をキーにして覚えておく
+    まとめて読む場合は chunk_size 件ずつに分け, プールの複数のプロセスで同時に読む
+    """
+    def __init__(self, tags=("DateTimeOriginal",), chunk_size=500, pool=None):
+        self.tags = tuple(tags)
+        self.chunk_size = chunk_size
+        self._pool = pool
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _key(self, path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def _lookup(self, path):
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(self._key(path))
+        if entry is not None and entry[0] == stamp:
+            return stamp, entry[1]
+        return stamp, None
+
+    def read_many(self, paths):
+        """
+        Returns:
+          {パス: {タグ名: 値}} (変わっていないファイルは exiftool を呼ばない)
+        """
+        result = {}
+        missing = []
+        for path in paths:
+            try:
+                stamp, tags = self._lookup(path)
+            except OSError:
+                result[path] = {}
+                continue
+            if tags is None:
+                missing.append((path, stamp))
+            else:
+                result[path] = tags
+        if not missing:
+            return result
+        pool = self._pool or get_exiftool_pool()
+        chunks = [missing[start:start + self.chunk_size] for start in range(0, len(missing), self.chunk_size)]
+        with ThreadPoolExecutor(max_workers=max(1, min(pool.size, len(chunks)))) as executor:
+            for chunk, tags_by_path in zip(chunks, executor.map(lambda chunk: pool.read_tags_many([path for path, _ in chunk], self.tags), chunks)):
+                with self._lock:
+                    for path, stamp in chunk:
+                        tags = tags_by_path.get(path, {})
+                        self._entries[self._key(path)] = (stamp, tags)
+                        result[path] = tags
+        return result
+
+    def read(self, path):
+        return self.read_many([path]).get(path, {})
+
+    def invalidate(self, path):
+        with self._lock:
+            self._entries.pop(self._key(path), None)
+
+_exif_date_cache = None
+
+def get_exif_date_cache():
+    # DateTimeOriginal の読み込みはアプリ全体で共有する
+    global _exif_date_cache
+    if _exif_date_cache is None:
+        _exif_date_cache = ExifTagCache(("DateTimeOriginal",))
+    return _exif_date_cache
+
+# -AllDates で書き込まれるタグ
+ALL_DATE_TAGS = ("DateTimeOriginal", "CreateDate", "ModifyDate")
+# 一括書き込みの取り消し用 (対象ディレクトリに置く)
+DATE_UNDO_FILENAME = ".kkImg_date_undo.json"
+
+def plan_date_writes(directory, files):
+    """
+    ファイル名から日時を推測して, 現在の DateTimeOriginal と並べる
+    Returns:
+      [{"file", "path", "current", "proposed", "rule"}]
+    """
+    files = list(files)
+    paths = [os.path.join(directory, file) for file in files]
+    current = get_exif_date_cache().read_many(paths)
+    # サブディレクトリ内のファイルもファイル名だけで推測する
+    matches = get_date_engine().match_many(os.path.basename(file) for file in files)
+    plan = []
+    for file, path in zip(files, paths):
+        match = matches[os.path.basename(file)]
+        plan.append({
+            "file": file,
+            "path": path,
+            "current": str(current.get(path, {}).get("DateTimeOriginal", "")),
+            "proposed": format_exif_datetime(match.datetime) if match else "",
+            "rule": match.rule if match else None,
+        })
+    return plan
+
+def write_dates_batch(changes, dry_run=False, undo_path=None):
+    """
+    日時をまとめて書き込む (-csv= で exiftool の呼び出しは1回)
+    Args:
+      changes: (パス, yyyy:MM:dd hh:mm:ss) のリスト
+      dry_run: True の場合は書き込まずに変更内容だけを返す
+      undo_path: 書き込む前の値を保存するファイル
+    Returns:
+      [{"path", "before": {タグ: 値}, "after"}]
+    """
+    changes = list(changes)
+    if not changes:
+        return []
+    pool = get_exiftool_pool()
+    paths = [path for path, _ in changes]
+    before = pool.read_tags_many(paths, ALL_DATE_TAGS)
+    entries = [
+        {"path": path, "before": {tag: str(value) for tag, value in before.get(path, {}).items()}, "after": value}
+        for path, value in changes
+    ]
+    if dry_run:
+        return entries
+    if undo_path is not None:
+        with open(undo_path, "w", encoding="utf-8") as f:
+            json.dump({"written_at": datetime.now().isoformat(), "entries": entries}, f, ensure_ascii=False, indent=1)
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False, newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(("SourceFile",) + ALL_DATE_TAGS)
+        for path, value in changes:
+            writer.writerow([path] + [value] * len(ALL_DATE_TAGS))
+        csv_path = csv_file.name
+    try:
+        pool.execute_checked("-csv=" + csv_path, "-overwrite_original", *paths)
+    finally:
+        os.remove(csv_path)
+        # 更新日時の精度が粗いファイルシステムでも古い値を返さないように
+        for path in paths:
+            get_exif_date_cache().invalidate(path)
+    return entries
+
+def undo_date_writes(undo_path):
+    """
+    write_dates_batch で保存した値に戻す (元々なかったタグは削除する)
+    Returns:
+      戻したファイル数
+    """
+    with open(undo_path, encoding="utf-8") as f:
+        entries = json.load(f)["entries"]
+    pool = get_exiftool_pool()
+
+    def restore(entry):
+        args = [f"-{tag}={entry['before'].get(tag, '')}" for tag in ALL_DATE_TAGS]
+        pool.execute_checked(*args, "-overwrite_original", entry["path"])
+        get_exif_date_cache().invalidate(entry["path"])
+
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        list(executor.map(restore, entries))
+    os.remove(undo_path)
+    return len(entries)
+
+# 変換対象の拡張子
+CONVERT_EXTENSIONS = ('.png', '.jpeg', '.jpg', '.heic')
+
+# avifenc に渡す固定の設定
+AVIF_MIN_QUANTIZER = 0
+AVIF_MAX_QUANTIZER = 63
+AVIF_TUNE = 'ssim'
+
+def avif_encoder_settings(quality, encoder="avifenc", codec=None, speed=None, adaptive=None):
+    # 出力に影響する設定 (マニフェストでの比較に使う)
+    settings = {
+        "quality": int(quality),
+        "tune": AVIF_TUNE,
+        "min": AVIF_MIN_QUANTIZER,
+        "max": AVIF_MAX_QUANTIZER,
+    }
+    # 既定以外の場合だけ加える (以前のマニフェストと比較できるように)
+    if encoder != "avifenc":
+        settings["encoder"] = encoder
+    if codec is not None:
+        settings["codec"] = codec
+    if speed is not None:
+        settings["speed"] = int(speed)
+    if adaptive is not None:
+        settings["adaptive"] = adaptive.settings()
+    return settings
+
+def iter_conversion_tasks(entries, output_dir):
+    # サブディレクトリの構成は出力先でも同じにする
+    for entry in entries:
+        yield entry.path, os.path.join(output_dir, replace_extension(entry.relpath, 'avif'))
+
+# 変換済みファイルの記録 (出力先ディレクトリに置く)
+MANIFEST_FILENAME = '.kkImg_manifest.sqlite'
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def open_manifest(output_dir):
+    conn = sqlite3.connect(os.path.join(output_dir, MANIFEST_FILENAME), check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        " source TEXT PRIMARY KEY,"
+        " size INTEGER, mtime_ns INTEGER, hash TEXT,"
+        " settings TEXT, output TEXT, output_size INTEGER, output_mtime_ns INTEGER)"
+    )
+    # AVIF と一緒に書き出した出力 (--target)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS extra_outputs ("
+        " source TEXT, output TEXT, output_size INTEGER, output_mtime_ns INTEGER,"
+        " PRIMARY KEY (source, output))"
+    )
+    conn.commit()
+    return conn
+
+def _extra_outputs_up_to_date(conn, src_path, extra_paths):
+    recorded = {
+        output: (output_size, output_mtime_ns)
+        for output, output_size, output_mtime_ns in conn.execute(
+            "SELECT output, output_size, output_mtime_ns FROM extra_outputs WHERE source = ?", (src_path,)
+        )
+    }
+    for path in extra_paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if recorded.get(path) != (stat.st_size, stat.st_mtime_ns):
+            return False
+    return True
+
+def _is_up_to_date(conn, src_path, dst_path, settings_json, use_hash, src_stat=None, extra_paths=()):
+    row = conn.execute(
+        "SELECT size, mtime_ns, hash, settings, output, output_size, output_mtime_ns FROM files WHERE source = ?",
+        (src_path,)
+    ).fetchone()
+    if row is None:
+        return False
+    size, mtime_ns, digest, settings, output, output_size, output_mtime_ns = row
+    if settings != settings_json or output != dst_path:
+        return False
+    # 出力が消されたり書き換えられたりしていないか
+    try:
+        dst_stat = os.stat(dst_path)
+        if src_stat is None:
+            stat = os.stat(src_path)
+            src_stat = (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        return False
+    if dst_stat.st_size != output_size or dst_stat.st_mtime_ns != output_mtime_ns:
+        return False
+    if extra_paths and not _extra_outputs_up_to_date(conn, src_path, extra_paths):
+        return False
+    if src_stat[0] != size:
+        return False
+    if src_stat[1] == mtime_ns:
+        return True
+    # 更新日時だけ変わった場合は内容で比べる
+    if use_hash and digest and file_digest(src_path) == digest:
+        conn.execute("UPDATE files SET mtime_ns = ? WHERE source = ?", (src_stat[1], src_path))
+        conn.commit()
+        return True
+    return False
+
+def plan_incremental_conversion(conn, tasks, settings, use_hash=False, source_stats=None, extra_outputs=None):
+    """
+    Args:
+      source_stats: {変換元のパス: (サイズ, 更新日時)} スキャン時の値があれば stat を省く
+      extra_outputs: AVIF と一緒に書き出す出力 (target_outputs). 1つでも消えていれば変換し直す
+    Returns:
+      (変換が必要なタスク, スキップするタスク)
+    """
+    skipped = []
+    to_convert = list(iter_incremental_conversion(conn, tasks, settings, use_hash, source_stats, skipped, extra_outputs))
+    return to_convert, skipped
+
+def iter_incremental_conversion(conn, tasks, settings, use_hash=False, source_stats=None, skipped=None, extra_outputs=None):
+    """
+    plan_incremental_conversion の逐次版 (変換が必要なタスクだけを順に返す)
+    skipped にリストを渡すとスキップしたタスクを追加する
+    """
+    settings_json = json.dumps(settings, sort_keys=True)
+    source_stats = source_stats or {}
+    for src_path, dst_path in tasks:
+        extra_paths = extra_output_paths(extra_outputs, src_path, dst_path)
+        if _is_up_to_date(conn, src_path, dst_path, settings_json, use_hash, source_stats.get(src_path), extra_paths):
+            if skipped is not None:
+                skipped.append((src_path, dst_path))
+        else:
+            yield src_path, dst_path
+
+def record_conversion(conn, src_path, dst_path, settings, use_hash=False, extra_paths=()):
+    src_stat = os.stat(src_path)
+    dst_stat = os.stat(dst_path)
+    extra_stats = [(path, os.stat(path)) for path in extra_paths]
+    conn.execute(
+        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            src_path, src_stat.st_size, src_stat.st_mtime_ns,
+            file_digest(src_path) if use_hash else None,
+            json.dumps(settings, sort_keys=True), dst_path,
+            dst_stat.st_size, dst_stat.st_mtime_ns,
+        )
+    )
+    conn.execute("DELETE FROM extra_outputs WHERE source = ?", (src_path,))
+    conn.executemany(
+        "INSERT INTO extra_outputs VALUES (?, ?, ?, ?)",
+        [(src_path, path, stat.st_size, stat.st_mtime_ns) for path, stat in extra_stats]
+    )
+    conn.commit()
+
+# 変換の途中経過の記録 (出力先ディレクトリに置く)
+JOURNAL_FILENAME = '.kkImg_journal.sqlite'
+
+def journal_filename(shard=None):
+    # --shard で同じ出力先を分け合う場合は, 分割毎に別のジャーナルにする
+    if shard is None:
+        return JOURNAL_FILENAME
+    index, count = shard
+    return f".kkImg_journal-{index}-of-{count}.sqlite"
+JOURNAL_STATES = ("queued", "encoding", "tagging", "done", "failed")
+
+def partial_output_path(dst_path):
+    # 書き込み中の出力 (同じディレクトリに置き, 終わったら os.replace で置き換える)
+    directory, name = os.path.split(dst_path)
+    root, extension = os.path.splitext(name)
+    return os.path.join(directory, f".{root}.kkImg-part{extension}")
+
+class JobJournal:
+    """
+    ファイル毎の状態 (JOURNAL_STATES) を記録し, 落ちたり閉じられたりした変換を続きから再開できるようにする
+    失敗したファイルは failed として残り, 後で再試行できる
+    """
+    def __init__(self, output_dir, shard=None):
+        os.makedirs(output_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(output_dir, journal_filename(shard)), timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        # ファイル毎に何度も書き込むので, 電源断以外では失われない程度に同期を減らす
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " source TEXT PRIMARY KEY, output TEXT, state TEXT, attempts INTEGER, error TEXT)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS batch (id INTEGER PRIMARY KEY CHECK (id = 0), settings TEXT, finished INTEGER)")
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def begin(self, settings):
+        """
+        前回の変換が同じ設定で終わっていなければ, その記録を使って再開する
+        Returns:
+          再開する場合は True
+        """
+        settings_json = json.dumps(settings, sort_keys=True)
+        with self._lock:
+            row = self._conn.execute("SELECT settings, finished FROM batch WHERE id = 0").fetchone()
+            if row is not None and row[0] == settings_json and not row[1]:
+                # 書き込み途中だった出力を消す
+                for (output,) in self._conn.execute("SELECT output FROM jobs WHERE state IN ('encoding', 'tagging')").fetchall():
+                    try:
+                        os.remove(partial_output_path(output))
+                    except OSError:
+                        pass
+                self._conn.execute("UPDATE jobs SET state = 'queued' WHERE state IN ('encoding', 'tagging')")
+                self._conn.commit()
+                return True
+            self._conn.execute("DELETE FROM jobs WHERE state != 'failed'")
+            self._conn.execute("INSERT OR REPLACE INTO batch VALUES (0, ?, 0)", (settings_json,))
+            self._conn.commit()
+            return False
+
+    def pending(self, tasks):
+        """
+        記録が done のタスクを除いて返す (再開しない場合は何も除かない)
+        """
+        for src_path, dst_path in tasks:
+            with self._lock:
+                row = self._conn.execute("SELECT state, output FROM jobs WHERE source = ?", (src_path,)).fetchone()
+            if row is not None and row[0] == "done" and row[1] == dst_path and os.path.exists(dst_path):
+                continue
+            yield src_path, dst_path
+
+    def mark(self, src_path, dst_path, state, error=None):
+        if state not in JOURNAL_STATES:
+            raise ValueError(f"不明な状態です: {state}")
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, 0, ?) ON CONFLICT (source) DO UPDATE SET"
+                " output = excluded.output, state = excluded.state, error = excluded.error,"
+                " attempts = attempts + (excluded.state = 'encoding')",
+                (src_path, dst_path, state, error)
+            )
+            # queued はまとめて書き込む (次の状態の記録と一緒に確定する)
+            if state != "queued":
+                self._conn.commit()
+
+    def failed(self):
+        """
+        Returns:
+          [(変換元, 変換先, エラー)]
+        """
+        with self._lock:
+            return self._conn.execute("SELECT source, output, error FROM jobs WHERE state = 'failed' ORDER BY source").fetchall()
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def finish(self):
+        # 中断せずに最後まで進んだ場合だけ, 次回は最初から始める
+        with self._lock:
+            self._conn.execute("UPDATE batch SET finished = 1 WHERE id = 0")
+            self._conn.execute("DELETE FROM jobs WHERE state != 'failed'")
+            self._conn.commit()
+
+# 内容のハッシュの保存先 (入力ディレクトリをまたいで共有する)
+HASH_INDEX_PATH = os.environ.get(
+    "KKIMG_HASH_INDEX", os.path.join(os.path.expanduser("~"), ".cache", "kkImg", "hash_index.sqlite")
+)
+
+def content_hash_algorithm():
+    if xxhash is not None:
+        return "xxh3_128"
+    if blake3 is not None:
+        return "blake3"
+    return "blake2b"
+
+def content_hash(path, algorithm=None, chunk_size=1024 * 1024):
+    """
+    ファイルを少しずつ読んでハッシュを計算する (xxhash / BLAKE3 があればそれを使う)
+    """
+    algorithm = algorithm or content_hash_algorithm()
+    if algorithm == "xxh3_128":
+        digest = xxhash.xxh3_128()
+    elif algorithm == "blake3":
+        digest = blake3.blake3()
+    else:
+        digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def perceptual_hash(path, hash_size=8):
+    """
+    見た目が近い画像を見つけるための dHash (Pillow が必要)
+    """
+    with _decode_image(path, draft=("L", (hash_size * 8, hash_size * 8))) as image:
+        return image_dhash(image, hash_size)
+
+def _pixels(image):
+    # Pillow 12.1 以降は getdata の代わりに get_flattened_data を使う
+    return list(getattr(image, "get_flattened_data", image.getdata)())
+
+def image_dhash(image, hash_size=8):
+    pixels = _pixels(image.convert("L").resize((hash_size + 1, hash_size)))
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+class HashIndex:
+    """
+    ファイルの内容のハッシュを (パス, サイズ, 更新日時) と一緒に保存し, 変わっていないファイルは計算し直さない
+    """
+    def __init__(self, path=HASH_INDEX_PATH, algorithm=None):
+        self.algorithm = algorithm or content_hash_algorithm()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            " path TEXT, algorithm TEXT, size INTEGER, mtime_ns INTEGER, digest TEXT, phash TEXT,"
+            " PRIMARY KEY (path, algorithm))"
+        )
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def _lookup(self, path, size, mtime_ns):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, digest, phash FROM hashes WHERE path = ? AND algorithm = ?",
+                (os.path.abspath(path), self.algorithm)
+            ).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return None
+        return row[2], row[3]
+
+    def _store(self, rows):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def hash_files(self, paths, workers=None, perceptual=False):
+        """
+        Args:
+          paths: パスのリスト
+          workers: ハッシュを計算するスレッド数
+          perceptual: dHash も計算するかどうか (Pillow が必要)
+        Returns:
+          {パス: (内容のハッシュ, dHash または None)}
+        """
+        perceptual = perceptual and Image is not None
+        result = {}
+        missing = []
+        for path in paths:
+            stat = os.stat(path)
+            cached = self._lookup(path, stat.st_size, stat.st_mtime_ns)
+            if cached is not None and (cached[1] is not None or not perceptual):
+                result[path] = cached
+            else:
+                missing.append((path, stat.st_size, stat.st_mtime_ns))
+
+        def compute(item):
+            path, size, mtime_ns = item
+            digest = content_hash(path, self.algorithm)
+            phash = None
+            if perceptual:
+                try:
+                    phash = perceptual_hash(path)
+                except Exception:
+                    phash = None
+            return path, size, mtime_ns, digest, phash
+
+        rows = []
+        with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1)) as executor:
+            for path, size, mtime_ns, digest, phash in executor.map(compute, missing):
+                result[path] = (digest, phash)
+                rows.append((os.path.abspath(path), self.algorithm, size, mtime_ns, digest, phash))
+        if rows:
+            self._store(rows)
+        return result
+
+def find_duplicate_groups(hashes):
+    """
+    Args:
+      hashes: HashIndex.hash_files の結果
+    Returns:
+      内容が同じファイルのグループ (2件以上のもの) のリスト
+    """
+    groups = {}
+    for path, (digest, _) in hashes.items():
+        groups.setdefault(digest, []).append(path)
+    return [sorted(paths) for paths in groups.values() if len(paths) > 1]
+
+def find_near_duplicate_groups(hashes, max_distance=4):
+    """
+    dHash のハミング距離が max_distance 以下で, 内容は異なるファイルの組
+    Returns:
+      [(パス, パス, 距離)]
+    """
+    # 同じ内容のものは1つにまとめてから比べる
+    representatives = {}
+    for path, (digest, phash) in sorted(hashes.items()):
+        if phash is not None and digest not in representatives:
+            representatives[digest] = (path, int(phash, 16))
+    items = list(representatives.values())
+    pairs = []
+    for index, (path, value) in enumerate(items):
+        for other_path, other_value in items[index + 1:]:
+            distance = bin(value ^ other_value).count("1")
+            if distance <= max_distance:
+                pairs.append((path, other_path, distance))
+    return pairs
+
+def plan_deduplicated_tasks(tasks, hash_index, workers=None):
+    """
+    内容が同じ変換元は最初の1つだけを変換し, 残りは変換結果をリンク (またはコピー) する
+    Returns:
+      (変換するタスク, {変換するタスクの変換元: [(重複した変換元, その変換先)]})
+    """
+    tasks = list(tasks)
+    hashes = hash_index.hash_files([src for src, _ in tasks], workers=workers)
+    primaries = {}
+    unique_tasks = []
+    duplicates = {}
+    for src, dst in tasks:
+        digest = hashes[src][0]
+        primary = primaries.get(digest)
+        if primary is None:
+            primaries[digest] = src
+            unique_tasks.append((src, dst))
+        else:
+            duplicates.setdefault(primary, []).append((src, dst))
+    return unique_tasks, duplicates
+
+def link_or_copy(src_path, dst_path):
+    os.makedirs(os.path.dirname(dst_path) or ".", exist_ok=True)
+    temp_path = partial_output_path(dst_path)
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(src_path, temp_path)
+    except OSError:
+        # 別のドライブなどでハードリンクが作れない場合はコピーする
+        shutil.copy2(src_path, temp_path)
+    os.replace(temp_path, dst_path)
+
+def split_cpu_budget(cpu_budget, file_count, files_in_flight=None):
+    """
+    CPUの割り当てを同時に変換するファイル数とファイル毎の --jobs に分ける
+    Args:
+      cpu_budget: 変換に使うスレッドの総数
+      file_count: 変換するファイル数
+      files_in_flight: 同時に変換するファイル数 (None の場合は自動)
+    Returns:
+      (同時に変換するファイル数, ファイル毎の --jobs)
+    """
+    cpu_budget = max(1, int(cpu_budget))
+    if files_in_flight is None:
+        # avifenc は1ファイルの中ではあまり並列化されないので, ファイル単位で並べる
+        files_in_flight = cpu_budget
+    files_in_flight = max(1, min(int(files_in_flight), cpu_budget, max(1, file_count)))
+    jobs_per_file = max(1, cpu_budget // files_in_flight)
+    return files_in_flight, jobs_per_file
+
+def pillow_can_save_avif():
+    if Image is None:
+        return False
+    Image.init()
+    return "AVIF" in Image.SAVE
+
+def cq_level_to_avif_quality(cq_level):
+    # libavif の quality (0-100) と量子化パラメータ (0-63) の対応に合わせる
+    return max(0, min(100, round(100 - int(cq_level) * 100 / 63)))
+
+def open_heic(src_path):
+    return pillow_heif.open_heif(src_path, convert_hdr_to_8bit=True).to_pillow()
+
+@contextlib.contextmanager
+def _temporary_file(suffix='.png'):
+    # 外部コマンドとの受け渡しに使う一時ファイル (抜けると消す)
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_file:
+        temp_name = temp_file.name
+    try:
+        yield temp_name
+    finally:
+        os.remove(temp_name)
+
+def _decode_image(src_path, draft=None):
+    """
+    画像を読み込む (HEIC は pillow-heif, なければ ImageMagick で PNG にしてから読む)
+    draft: (モード, 大きさ) JPEG はこの大きさに近づくように縮小しながら読む
+    """
+    if os.path.splitext(src_path)[1].lower() != '.heic':
+        with Image.open(src_path) as image:
+            if draft is not None:
+                image.draft(*draft)
+            image.load()
+            return image
+    if pillow_heif is not None:
+        return open_heic(src_path)
+    with _temporary_file() as temp_png_name:
+        subprocess.run(['magick', src_path, temp_png_name], check=True)
+        with Image.open(temp_png_name) as image:
+            image.load()
+            return image
+
+def _to_rgb_or_rgba(image):
+    # エンコーダーに渡せる RGB / RGBA にする (透明な部分があれば RGBA)
+    if image.mode in ("RGB", "RGBA"):
+        return image
+    return image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+
+# プレビュー用の縮小画像の置き場所
+THUMBNAIL_CACHE_DIR = os.path.join(tempfile.gettempdir(), "kkImg_thumbnails")
+
+class ThumbnailCache:
+    """
+    プレビュー用の縮小画像 (WebP/JPEG) を (パス, 更新日時, サイズ) をキーにしてディスクに保存する
+    合計が max_bytes を超えたら, 使われていない順に消す
+    """
+    def __init__(self, directory=THUMBNAIL_CACHE_DIR, max_bytes=256 * 1024 * 1024, size=300, workers=2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = size
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # キー: (縮小画像のパス, バイト数) 古く使われた順
+        self._total = 0
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        os.makedirs(directory, exist_ok=True)
+        # 前回までの縮小画像を, 最後に使われた順 (更新日時) で読み込む
+        for entry in sorted(scan_directory(directory, ('.webp', '.jpg')), key=lambda entry: entry.mtime_ns):
+            self._index[os.path.splitext(entry.name)[0]] = (entry.path, entry.size)
+            self._total += entry.size
+
+    def _key(self, path):
+        stat = os.stat(path)
+        return hashlib.sha1(f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{self.size}".encode("utf-8")).hexdigest()
+
+    def lookup(self, path):
+        """
+        作成済みの縮小画像のパス (なければ None)
+        """
+        try:
+            key = self._key(path)
+        except OSError:
+            return None
+        with self._lock:
+            item = self._index.get(key)
+            if item is None:
+                return None
+            self._index.move_to_end(key)
+        try:
+            # 使われた順を次回の起動にも残す
+            os.utime(item[0])
+        except OSError:
+            return None
+        return item[0]
+
+    def get(self, path):
+        """
+        縮小画像のパスを返す (なければその場で作る). 作れなかった場合は元のパスを返す
+        """
+        thumbnail = self.lookup(path)
+        if thumbnail is not None:
+            return thumbnail
+        future = self._submit(path)
+        try:
+            return future.result() if future is not None else path
+        except Exception:
+            traceback.print_exc()
+            return path
+
+    def prefetch(self, paths):
+        # 表示されそうなものを裏で先に作っておく
+        for path in paths:
+            if self.lookup(path) is None:
+                self._submit(path)
+
+    def _submit(self, path):
+        try:
+            key = self._key(path)
+        except OSError:
+            return None
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._executor.submit(self._generate, path, key)
+                self._pending[key] = future
+            return future
+
+    def _generate(self, path, key):
+        try:
+            if Image is not None:
+                thumbnail = self._generate_with_pillow(path, key)
+            else:
+                thumbnail = os.path.join(self.directory, key + ".webp")
+                subprocess.run(
+                    ['magick', path + '[0]', '-thumbnail', f'{self.size}x{self.size}', 'webp:' + thumbnail + '.tmp'],
+                    check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                )
+                os.replace(thumbnail + '.tmp', thumbnail)
+            self._add(key, thumbnail)
+            return thumbnail
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _generate_with_pillow(self, path, key):
+        Image.init()
+        extension, image_format = (".webp", "WEBP") if "WEBP" in Image.SAVE else (".jpg", "JPEG")
+        thumbnail = os.path.join(self.directory, key + extension)
+        with _decode_image(path, draft=("RGB", (self.size, self.size))) as image:
+            image.thumbnail((self.size, self.size))
+            image.convert("RGB").save(thumbnail + ".tmp", format=image_format, quality=80)
+        os.replace(thumbnail + ".tmp", thumbnail)
+        return thumbnail
+
+    def _add(self, key, thumbnail):
+        size = os.path.getsize(thumbnail)
+        removed = []
+        with self._lock:
+            previous = self._index.pop(key, None)
+            if previous is not None:
+                self._total -= previous[1]
+            self._index[key] = (thumbnail, size)
+            self._total += size
+            while self._total > self.max_bytes and len(self._index) > 1:
+                _, (old_path, old_size) = self._index.popitem(last=False)
+                self._total -= old_size
+                removed.append(old_path)
+        for old_path in removed:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+# avifenc がそのまま読める形式
+AVIFENC_INPUT_EXTENSIONS = ('.png', '.jpeg', '.jpg')
+
+class AvifencEncoder:
+    """
+    avifenc を呼び出すエンコーダー
+    """
+    name = "avifenc"
+    in_process = False
+
+    def __init__(self, quality, jobs=1, codec=None, speed=None):
+        self.quality = int(quality)
+        self.jobs = int(jobs)
+        self.codec = codec
+        self.speed = speed
+        self._args = self._build_args()
+
+    @staticmethod
+    def available():
+        return shutil.which("avifenc") is not None
+
+    def _build_args(self):
+        args = []
+        if self.codec is not None:
+            args += ['--codec', self.codec]
+        if self.speed is not None:
+            args += ['--speed', str(int(self.speed))]
+        if self.codec in (None, 'aom'):
+            args += [
+                '--min', str(AVIF_MIN_QUANTIZER), '--max', str(AVIF_MAX_QUANTIZER), '-a', 'end-usage=q',
+                '-a', f'cq-level={self.quality}', '-a', f'tune={AVIF_TUNE}',
+            ]
+        else:
+            # -a の指定は aom 専用なので, それ以外は同じ量子化になる -q を使う
+            args += ['-q', str(cq_level_to_avif_quality(self.quality))]
+        args += ['--jobs', f'{self.jobs}']
+        return args
+
+    def encode_file(self, src_path, dst_path):
+        subprocess.run(['avifenc', src_path, dst_path, *self._args], check=True)
+
+    def encode_image(self, image, dst_path):
+        # avifenc は画素を直接受け取れないので PNG を経由する
+        with _temporary_file() as temp_png_name:
+            image.save(temp_png_name, format="PNG")
+            self.encode_file(temp_png_name, dst_path)
+
+class PillowAvifEncoder:
+    """
+    Pillow (11.3 以降または pillow-avif-plugin) の libavif でプロセス内でエンコードする
+    使い回すのは作成時に組み立てた保存の設定 (dict) だけで, libavif のエンコーダーは保存毎に Pillow が作る
+    """
+    name = "pillow"
+    in_process = True
+
+    def __init__(self, quality, jobs=1, codec=None, speed=None):
+        self.quality = int(quality)
+        self.jobs = int(jobs)
+        self.codec = codec
+        self.speed = speed
+        self._save_options = {
+            "format": "AVIF",
+            "quality": cq_level_to_avif_quality(self.quality),
+            "max_threads": self.jobs,
+            "codec": codec or "auto",
+        }
+        if speed is not None:
+            self._save_options["speed"] = int(speed)
+        if codec in (None, "aom"):
+            self._save_options["advanced"] = [("end-usage", "q"), ("cq-level", str(self.quality)), ("tune", AVIF_TUNE)]
+
+    @staticmethod
+    def available():
+        return pillow_can_save_avif()
+
+    def encode_image(self, image, dst_path):
+        _to_rgb_or_rgba(image).save(dst_path, **self._save_options)
+
+    def encode_file(self, src_path, dst_path):
+        self.encode_image(_decode_image(src_path), dst_path)
+
+# 使えるエンコーダー (名前: クラス)
+AVIF_ENCODERS = {
+    "avifenc": AvifencEncoder,
+    "pillow": PillowAvifEncoder,
+}
+AVIF_CODECS = ("aom", "rav1e", "svt")
+
+def available_avif_encoders():
+    return [name for name, encoder_class in AVIF_ENCODERS.items() if encoder_class.available()]
+
+def avif_encoder_choices():
+    # 画面と CLI で選べるエンコーダー (既定の avifenc は見つからなくても先頭に残す)
+    return ["avifenc"] + [name for name in available_avif_encoders() if name != "avifenc"]
+
+def create_avif_encoder(name="avifenc", quality=30, jobs=1, codec=None, speed=None):
+    if name not in AVIF_ENCODERS:
+        raise ValueError(f"不明なエンコーダーです: {name}")
+    if codec is not None and codec not in AVIF_CODECS:
+        raise ValueError(f"不明なコーデックです: {codec}")
+    return AVIF_ENCODERS[name](quality, jobs, codec, speed)
+
+# AVIF と一緒に書き出せる形式 (形式: (拡張子, 既定の品質))
+OUTPUT_FORMATS = {
+    "avif": ("avif", 30),
+    "webp": ("webp", 80),
+    "jpeg": ("jpg", 85),
+    "jxl": ("jxl", 90),
+}
+
+class OutputTarget:
+    """
+    AVIF と一緒に書き出す追加の出力 (形式毎の設定と出力先)
+    デコードした画素を受け取ってエンコードするので, 元のファイルは1回しか読まない
+    """
+    def __init__(self, format, directory, quality=None, max_size=None, options=None):
+        if format not in OUTPUT_FORMATS:
+            raise ValueError(f"不明な出力形式です: {format}")
+        self.format = format
+        self.directory = directory
+        self.extension, default_quality = OUTPUT_FORMATS[format]
+        # avif の quality は cq-level (小さいほど高品質), それ以外は 0-100 (大きいほど高品質)
+        self.quality = default_quality if quality is None else int(quality)
+        self.max_size = None if max_size is None else int(max_size)
+        self.options = dict(options or {})
+
+    def __repr__(self):
+        return f"OutputTarget({self.format!r}, {self.directory!r}, quality={self.quality}, max_size={self.max_size})"
+
+    def settings(self):
+        # 出力に影響する設定 (マニフェストでの比較に使う)
+        return dict({"format": self.format, "directory": self.directory, "quality": self.quality, "max_size": self.max_size}, **self.options)
+
+    def output_path(self, relpath):
+        return os.path.join(self.directory, replace_extension(relpath, self.extension))
+
+    def encode_image(self, image, dst_path):
+        # ICC プロファイルは RGB のものだけを引き継ぐ (CMYK やグレーのプロファイルは変換後の画素に合わない)
+        icc_profile = image.info.get("icc_profile") if image.mode in ("RGB", "RGBA", "P", "PA") else None
+        image = _to_rgb_or_rgba(image)
+        if self.format == "avif":
+            encoder = self.options.get("encoder") or ("pillow" if pillow_can_save_avif() else "avifenc")
+            create_avif_encoder(encoder, self.quality, int(self.options.get("jobs", 1))).encode_image(image, dst_path)
+        elif self.format == "webp":
+            image.save(dst_path, format="WEBP", quality=self.quality, method=int(self.options.get("method", 4)),
+                       icc_profile=icc_profile)
+        elif self.format == "jpeg":
+            image.convert("RGB").save(dst_path, format="JPEG", quality=self.quality, optimize=True, progressive=True,
+                                      icc_profile=icc_profile)
+        elif "JXL" in Image.SAVE:
+            image.save(dst_path, format="JXL", quality=self.quality, effort=int(self.options.get("effort", 7)))
+        else:
+            # Pillow で保存できない場合は cjxl に PNG を渡す
+            with _temporary_file() as temp_png_name:
+                image.save(temp_png_name, format="PNG")
+                subprocess.run([
+                    'cjxl', temp_png_name, dst_path, '-q', str(self.quality), '-e', str(self.options.get("effort", 7))
+                ], check=True, stdout=subprocess.DEVNULL)
+
+def parse_output_target(spec):
+    """
+    "形式:出力先[:キー=値,...]" を OutputTarget にする (例: webp:/srv/thumbs:quality=75,max=512)
+    キーは quality (q), max と形式毎の設定 (avif: encoder, jobs / webp: method / jxl: effort)
+    """
+    format, _, rest = spec.partition(":")
+    directory, options = rest, {}
+    # Windows のドライブ名の : と区別するため, 最後の : の後ろに = がある場合だけ設定とみなす
+    head, separator, tail = rest.rpartition(":")
+    if separator and "=" in tail:
+        directory = head
+        options = dict(item.split("=", 1) for item in tail.split(",") if item)
+    if not format or not directory:
+        raise ValueError(f"出力の指定が正しくありません: {spec}")
+    quality = options.pop("quality", options.pop("q", None))
+    max_size = options.pop("max", None)
+    return OutputTarget(format.lower(), directory, quality, max_size, options)
+
+def target_outputs(targets, output_dir):
+    """
+    Returns:
+      (変換元, AVIF の変換先) から [(OutputTarget, 追加の変換先)] を返す関数 (run_conversion_jobs の extra_outputs)
+    """
+    def outputs(src_path, dst_path):
+        relpath = os.path.relpath(dst_path, output_dir)
+        return [(target, target.output_path(relpath)) for target in targets]
+    return outputs
+
+def extra_output_paths(extra_outputs, src_path, dst_path):
+    # extra_outputs (target_outputs) の出力先だけを返す (マニフェストでの記録と比較に使う)
+    if extra_outputs is None:
+        return []
+    return [path for _, path in extra_outputs(src_path, dst_path)]
+
+# 1ファイルの変換に使うメモリの見積もり (デコードした画素とエンコーダーの作業領域)
+JOB_BYTES_PER_PIXEL = 16
+JOB_BASE_MEMORY = 64 * 1024 * 1024
+# 予算の半分を超える画像は単独で変換する
+LARGE_JOB_FRACTION = 0.5
+
+def _jpeg_size(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        # 詰め物の 0xFF を飛ばす
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                return None
+        if 0xD0 <= marker[1] <= 0xD9:
+            continue
+        length = struct.unpack(">H", f.read(2))[0]
+        if length < 2:
+            return None
+        if marker[1] in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+            height, width = struct.unpack(">xHH", f.read(5))
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+def _heic_size(head):
+    # ispe (画像の大きさ) のうち一番大きいもの (タイルではなく画像全体)
+    best = None
+    index = head.find(b"ispe")
+    while index >= 4:
+        width, height = struct.unpack(">II", head[index + 8:index + 16])
+        if best is None or width * height > best[0] * best[1]:
+            best = (width, height)
+        index = head.find(b"ispe", index + 4)
+    return best
+
+def read_image_size(path):
+    """
+    画像のヘッダーだけを読んで大きさを調べる (画素はデコードしない)
+    Returns:
+      (幅, 高さ) または None
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(64 * 1024)
+            if head.startswith(b"\x89PNG\r\n\x1a\n"):
+                return struct.unpack(">II", head[16:24])
+            if head.startswith(b"\xff\xd8"):
+                return _jpeg_size(f)
+            if head[4:8] == b"ftyp":
+                return _heic_size(head)
+    except Exception:
+        # 壊れたヘッダーは大きさ不明として見積もる
+        return None
+    if Image is not None:
+        try:
+            with Image.open(path) as image:
+                return image.size
+        except Exception:
+            return None
+    return None
+
+def estimate_job_cost(src_path, encoder="avifenc"):
+    """
+    1ファイルの変換に使うメモリと一時ファイルの容量を見積もる
+    Returns:
+      (メモリのバイト数, 一時ディスクのバイト数)
+    """
+    try:
+        src_size = os.path.getsize(src_path)
+    except OSError:
+        # 消えたファイルは変換の時に失敗として記録する
+        return JOB_BASE_MEMORY, 0
+    size = read_image_size(src_path)
+    # 大きさが分からなければ, 1画素が1バイトに圧縮されていると仮定する
+    pixels = size[0] * size[1] if size else src_size
+    memory = JOB_BASE_MEMORY + pixels * JOB_BYTES_PER_PIXEL
+    # 書き込み中の出力 (元のファイルより大きくなることはまずない)
+    disk = src_size
+    if os.path.splitext(src_path)[1].lower() == '.heic':
+        in_process = pillow_heif is not None and (AVIF_ENCODERS[encoder].in_process or pillow_can_save_avif())
+        if not in_process:
+            # ImageMagick や avifenc に渡す非圧縮に近い PNG
+            disk += pixels * 4
+    return memory, disk
+
+def physical_memory():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def default_resource_budget(memory_bytes=None, disk_bytes=None, fraction=0.5):
+    """
+    指定がなければ搭載メモリと一時ディレクトリの空き容量の半分 (分からなければ制限なし)
+    """
+    if memory_bytes is None:
+        memory = physical_memory()
+        memory_bytes = int(memory * fraction) if memory else None
+    if disk_bytes is None:
+        try:
+            disk_bytes = int(shutil.disk_usage(tempfile.gettempdir()).free * fraction)
+        except OSError:
+            disk_bytes = None
+    return ResourceBudget(memory_bytes, disk_bytes)
+
+class ResourceBudget:
+    """
+    同時に変換するファイルのメモリと一時ディスクの合計を予算内に抑える
+    予算を超える大きな画像は, 他に何も変換していない時に単独で変換する
+    大きな画像が待っている間は小さな画像を新しく始めない (小さな画像が続くといつまでも単独になれないので)
+    """
+    def __init__(self, memory_bytes=None, disk_bytes=None):
+        self.limits = (memory_bytes, disk_bytes)
+        self._used = [0, 0]
+        self._running = 0
+        self._large_running = 0
+        self._waiting_large = 0
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    def is_large(self, cost):
+        return any(limit is not None and value > limit * LARGE_JOB_FRACTION for value, limit in zip(cost, self.limits))
+
+    def _try_acquire_locked(self, cost, large):
+        if not large and self._waiting_large:
+            return False
+        if self._running > 0:
+            if large or self._large_running:
+                return False
+            for value, used, limit in zip(cost, self._used, self.limits):
+                if limit is not None and used + value > limit:
+                    return False
+        self._running += 1
+        self._large_running += large
+        self._used = [used + value for used, value in zip(self._used, cost)]
+        return True
+
+    def try_acquire(self, cost):
+        with self._lock:
+            return self._try_acquire_locked(cost, self.is_large(cost))
+
+    def acquire(self, cost, control=None, poll_seconds=0.1):
+        """
+        予算が空くまで待ってから確保する
+        control: JobControl 待っている間に中断されたら JobCancelled を投げる
+        """
+        large = self.is_large(cost)
+        with self._released:
+            if large:
+                self._waiting_large += 1
+            try:
+                while not self._try_acquire_locked(cost, large):
+                    self._released.wait(poll_seconds)
+                    if control is not None and control.cancelled:
+                        raise JobCancelled()
+            finally:
+                if large:
+                    self._waiting_large -= 1
+                    self._released.notify_all()
+
+    def release(self, cost):
+        with self._released:
+            self._running -= 1
+            self._large_running -= self.is_large(cost)
+            self._used = [used - value for used, value in zip(self._used, cost)]
+            self._released.notify_all()
+
+    @property
+    def used(self):
+        with self._lock:
+            return tuple(self._used)
+
+# 自動調整で品質を探す縮小画像の長辺と, 探す cq-level の範囲
+ADAPTIVE_PROXY_SIZE = 512
+ADAPTIVE_MIN_LEVEL = 10
+ADAPTIVE_MAX_LEVEL = 50
+
+def _float_product(a, b):
+    if hasattr(ImageMath, "lambda_eval"):
+        return ImageMath.lambda_eval(lambda args: args["a"] * args["b"], a=a, b=b)
+    return ImageMath.eval("a * b", a=a, b=b)
+
+def _block_means(image, blocks):
+    return _pixels(image.resize(blocks, Image.Resampling.BOX))
+
+def image_ssim(image_a, image_b, block=8):
+    """
+    明るさの SSIM (block x block 画素の窓毎に計算して平均する)
+    窓毎の平均・分散は BOX 縮小で求めるので, numpy は使わない
+    """
+    width, height = image_a.size
+    blocks = (max(1, width // block), max(1, height // block))
+    box = (0, 0, blocks[0] * block, blocks[1] * block)
+    a = image_a.convert("L").crop(box).convert("F")
+    b = image_b.convert("L").resize(image_a.size).crop(box).convert("F")
+    mean_a = _block_means(a, blocks)
+    mean_b = _block_means(b, blocks)
+    mean_aa = _block_means(_float_product(a, a), blocks)
+    mean_bb = _block_means(_float_product(b, b), blocks)
+    mean_ab = _block_means(_float_product(a, b), blocks)
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    total = 0.0
+    for ma, mb, maa, mbb, mab in zip(mean_a, mean_b, mean_aa, mean_bb, mean_ab):
+        var_a = maa - ma * ma
+        var_b = mbb - mb * mb
+        cov = mab - ma * mb
+        total += ((2 * ma * mb + c1) * (2 * cov + c2)) / ((ma * ma + mb * mb + c1) * (var_a + var_b + c2))
+    return total / len(mean_a)
+
+class QualityLevelCache:
+    """
+    自動調整で選んだ cq-level を dHash と一緒に保存し, 見た目が近い画像では探索を省く
+    """
+    def __init__(self, path=HASH_INDEX_PATH, max_distance=4):
+        self.max_distance = max_distance
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute("CREATE TABLE IF NOT EXISTS quality_levels (key TEXT, phash TEXT, level INTEGER, PRIMARY KEY (key, phash))")
+        self._conn.commit()
+        self._levels = {}
+
+    def close(self):
+        self._conn.close()
+
+    def _entries(self, key):
+        # 呼び出し側で self._lock を持っていること
+        entries = self._levels.get(key)
+        if entries is None:
+            rows = self._conn.execute("SELECT phash, level FROM quality_levels WHERE key = ?", (key,)).fetchall()
+            entries = self._levels[key] = [(int(phash, 16), level) for phash, level in rows]
+        return entries
+
+    def lookup(self, key, phash):
+        value = int(phash, 16)
+        with self._lock:
+            best = None
+            for other, level in self._entries(key):
+                distance = bin(value ^ other).count("1")
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, level)
+        return None if best is None else best[1]
+
+    def store(self, key, phash, level):
+        with self._lock:
+            self._entries(key).append((int(phash, 16), level))
+            self._conn.execute("INSERT OR REPLACE INTO quality_levels VALUES (?, ?, ?)", (key, phash, level))
+            self._conn.commit()
+
+class AdaptiveQuality:
+    """
+    画像毎に, 目標を満たす一番大きい (ファイルが小さくなる) cq-level を縮小画像で二分探索する
+    target_ssim: 縮小画像での SSIM の下限 (読み戻しに Pillow の AVIF 対応が必要)
+    target_bytes: 1ファイルのサイズの上限 (縮小画像の 1 画素あたりのビット数から見積もる)
+    両方を指定した場合は, サイズの上限を優先する
+    """
+    def __init__(self, target_ssim=None, target_bytes=None, min_level=ADAPTIVE_MIN_LEVEL, max_level=ADAPTIVE_MAX_LEVEL,
+                 proxy_size=ADAPTIVE_PROXY_SIZE, cache=None):
+        if Image is None:
+            raise ValueError("品質の自動調整には Pillow が必要です")
+        if target_ssim is None and target_bytes is None:
+            raise ValueError("SSIM かサイズの目標を指定してください")
+        if target_ssim is not None:
+            Image.init()
+            if "AVIF" not in Image.OPEN:
+                raise ValueError("SSIM の計算には AVIF を読み込める Pillow が必要です")
+        self.target_ssim = target_ssim
+        self.target_bytes = target_bytes
+        self.min_level = int(min_level)
+        self.max_level = int(max_level)
+        self.proxy_size = int(proxy_size)
+        self.cache = cache
+
+    def settings(self):
+        # 出力に影響する設定 (マニフェストとレポートに入れる)
+        settings = {"min_level": self.min_level, "max_level": self.max_level, "proxy": self.proxy_size}
+        if self.target_ssim is not None:
+            settings["ssim"] = self.target_ssim
+        if self.target_bytes is not None:
+            settings["bytes"] = self.target_bytes
+        return settings
+
+    def _load_proxy(self, src_path):
+        # JPEG は縮小しながら読むので, 元の大きさはヘッダーから読む
+        full_size = read_image_size(src_path)
+        image = _decode_image(src_path, draft=("RGB", (self.proxy_size, self.proxy_size)))
+        proxy = _to_rgb_or_rgba(image)
+        proxy.thumbnail((self.proxy_size, self.proxy_size))
+        return proxy, full_size or image.size
+
+    def choose(self, src_path, encoder_for_level, cache_key=""):
+        """
+        Args:
+          encoder_for_level: cq-level を受け取ってエンコーダーを返す関数
+          cache_key: エンコーダーなど, 同じ画像でも結果が変わる設定 (QualityLevelCache のキーに入れる)
+        Returns:
+          {"cq_level", "ssim", "bpp", "proxy_encodes", "cached"}
+        """
+        proxy, full_size = self._load_proxy(src_path)
+        proxy_pixels = proxy.size[0] * proxy.size[1]
+        key = json.dumps(dict(self.settings(), encoder=cache_key), sort_keys=True)
+        if self.target_bytes is not None:
+            # 許せる 1 画素あたりのビット数は画像の大きさで変わるので, 大きさもキーに入れる
+            key += f"{full_size[0]}x{full_size[1]}"
+        phash = image_dhash(proxy) if self.cache is not None else None
+        if phash is not None:
+            level = self.cache.lookup(key, phash)
+            if level is not None:
+                return {"cq_level": level, "ssim": None, "bpp": None, "proxy_encodes": 0, "cached": True}
+
+        results = {}
+
+        def measure(level):
+            # 同じ cq-level は1回だけエンコードする
+            if level not in results:
+                with _temporary_file('.avif') as temp_avif_name:
+                    encoder_for_level(level).encode_image(proxy, temp_avif_name)
+                    bpp = os.path.getsize(temp_avif_name) * 8 / proxy_pixels
+                    score = None
+                    if self.target_ssim is not None:
+                        with Image.open(temp_avif_name) as encoded:
+                            score = image_ssim(proxy, encoded)
+                results[level] = (score, bpp)
+            return results[level]
+
+        level = self.min_level
+        if self.target_ssim is not None:
+            # SSIM を満たす一番大きい cq-level
+            low, high = self.min_level, self.max_level
+            while low < high:
+                middle = (low + high + 1) // 2
+                if measure(middle)[0] >= self.target_ssim:
+                    low = middle
+                else:
+                    high = middle - 1
+            level = low
+        if self.target_bytes is not None:
+            # サイズに収まる一番小さい cq-level
+            budget_bpp = self.target_bytes * 8 / (full_size[0] * full_size[1])
+            low, high = self.min_level, self.max_level
+            while low < high:
+                middle = (low + high) // 2
+                if measure(middle)[1] <= budget_bpp:
+                    high = middle
+                else:
+                    low = middle + 1
+            level = max(level, low)
+        score, bpp = measure(level)
+        if phash is not None:
+            self.cache.store(key, phash, level)
+        return {
+            "cq_level": level,
+            "ssim": None if score is None else round(score, 4),
+            "bpp": round(bpp, 4),
+            "proxy_encodes": len(results),
+            "cached": False,
+        }
+
+# レポートの置き場所 (出力先ディレクトリの中)
+REPORT_DIRNAME = "kkImg_reports"
+
+# ファイル毎の工程 (レポートの列の順番)
+# スキャン (scan) と画面の更新 (ui) は変換全体の時間として run_stages に入る
+REPORT_STAGES = ("search", "decode", "encode", "exif")
+
+def _percentile(sorted_values, fraction):
+    # 最近傍順位法
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+class RunReport:
+    """
+    変換1回分の記録
+    ファイル毎の工程 (REPORT_STAGES) と全体の工程の所要時間, 入出力のサイズを集め, 最後に JSON/CSV に書き出す
+    """
+    def __init__(self, trace=None, profile=False):
+        # trace: 工程が終わる毎に (工程, 秒, パス) で呼ばれる
+        self.trace = trace
+        self.profile = profile
+        self.started_at = datetime.now()
+        self.started = time.monotonic()
+        self.finished = None
+        self.skipped = 0
+        self.extra = {}
+        self._files = OrderedDict()
+        self._run_stages = {}
+        self._lock = threading.Lock()
+        self._profilers = []
+        self._thread_profiler = threading.local()
+
+    def _file(self, path):
+        record = self._files.get(path)
+        if record is None:
+            record = self._files[path] = {"output": None, "input_size": None, "output_size": None, "quality": None, "error": None, "stages": {}}
+        return record
+
+    def add_timing(self, stage, seconds, path=None):
+        with self._lock:
+            stages = self._run_stages if path is None else self._file(path)["stages"]
+            stages[stage] = stages.get(stage, 0.0) + seconds
+        if self.trace is not None:
+            self.trace(stage, seconds, path)
+
+    @contextlib.contextmanager
+    def stage(self, stage, path=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(stage, time.perf_counter() - started, path)
+
+    def timed_iter(self, stage, iterable):
+        # 列挙 (スキャンなど) にかかった時間だけを数える
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_timing(stage, time.perf_counter() - started)
+                return
+            self.add_timing(stage, time.perf_counter() - started)
+            yield item
+
+    def add_file(self, src_path, dst_path):
+        input_size = os.path.getsize(src_path)
+        output_size = os.path.getsize(dst_path)
+        with self._lock:
+            record = self._file(src_path)
+            record.update(output=dst_path, input_size=input_size, output_size=output_size)
+
+    def add_failure(self, src_path, error):
+        with self._lock:
+            self._file(src_path)["error"] = error
+
+    def add_quality(self, src_path, choice):
+        # 自動調整で選んだ cq-level (AdaptiveQuality.choose の結果)
+        with self._lock:
+            self._file(src_path)["quality"] = choice
+
+    def thread_profiler(self):
+        """
+        呼び出したスレッド用の cProfile (profile=False の場合は None)
+        Python 3.12 からは同時に1つの cProfile しか有効にできないので, 最初に呼んだスレッドの分だけを返す
+        """
+        if not self.profile:
+            return None
+        profiler = getattr(self._thread_profiler, "profiler", None)
+        if profiler is None:
+            with self._lock:
+                if self._profilers and sys.version_info >= (3, 12):
+                    return None
+                profiler = self._thread_profiler.profiler = cProfile.Profile()
+                self._profilers.append(profiler)
+        return profiler
+
+    @contextlib.contextmanager
+    def profiling(self):
+        """
+        呼び出したスレッドの処理を cProfile で測る (測れない場合は何もしない)
+        結果は全てのスレッドが終わってから write_profile でまとめる
+        """
+        profiler = self.thread_profiler()
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError:
+                # 他の計測ツール (デバッガーなど) が動いている
+                profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def stage_percentiles(self):
+        result = {}
+        with self._lock:
+            records = list(self._files.values())
+        for stage in REPORT_STAGES:
+            values = sorted(record["stages"][stage] for record in records if stage in record["stages"])
+            if not values:
+                continue
+            result[stage] = {
+                "count": len(values),
+                "total": round(sum(values), 4),
+                "p50": round(_percentile(values, 0.5), 4),
+                "p90": round(_percentile(values, 0.9), 4),
+                "p99": round(_percentile(values, 0.99), 4),
+                "max": round(values[-1], 4),
+            }
+        return result
+
+    def summary(self):
+        with self._lock:
+            records = [record for record in self._files.values() if record["output_size"] is not None]
+            failed = sum(1 for record in self._files.values() if record["error"] is not None)
+            run_stages = dict(self._run_stages)
+        bytes_in = sum(record["input_size"] for record in records)
+        bytes_out = sum(record["output_size"] for record in records)
+        levels = sorted(record["quality"]["cq_level"] for record in records if record["quality"] is not None)
+        cq_levels = {}
+        if levels:
+            cq_levels["cq_levels"] = {
+                "p50": _percentile(levels, 0.5),
+                "min": levels[0],
+                "max": levels[-1],
+                "cached": sum(1 for record in records if record["quality"] is not None and record["quality"]["cached"]),
+            }
+        return dict({
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "seconds": round((self.finished or time.monotonic()) - self.started, 3),
+            "files": len(records),
+            "skipped": self.skipped,
+            "failed": failed,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "compression_ratio": round(bytes_out / bytes_in, 4) if bytes_in else None,
+            "run_stages": {stage: round(seconds, 4) for stage, seconds in run_stages.items()},
+            "stages": self.stage_percentiles(),
+        }, **cq_levels, **self.extra)
+
+    def summary_text(self):
+        summary = self.summary()
+        parts = [f"{summary['files']}件 {summary['seconds']}秒"]
+        if summary["failed"]:
+            parts.append(f"失敗 {summary['failed']}件")
+        if summary["compression_ratio"] is not None:
+            parts.append(f"圧縮率 {summary['compression_ratio'] * 100:.1f}%")
+        if "cq_levels" in summary:
+            parts.append(f"cq-level {summary['cq_levels']['min']}-{summary['cq_levels']['max']} (中央値 {summary['cq_levels']['p50']})")
+        for stage, values in summary["stages"].items():
+            parts.append(f"{stage} p50 {values['p50']:.2f}s / p90 {values['p90']:.2f}s")
+        return " · ".join(parts)
+
+    def write(self, directory, basename=None):
+        """
+        Returns:
+          (JSON のパス, CSV のパス)
+        """
+        os.makedirs(directory, exist_ok=True)
+        basename = basename or self.started_at.strftime("report-%Y%m%d-%H%M%S")
+        json_path = os.path.join(directory, basename + ".json")
+        csv_path = os.path.join(directory, basename + ".csv")
+        with self._lock:
+            files = [dict(record, source=path) for path, record in self._files.items()]
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({"summary": self.summary(), "files": files}, f, ensure_ascii=False, indent=1)
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                ["source", "output", "input_size", "output_size", "ratio", "cq_level", "ssim", "error"]
+                + [f"{stage}_seconds" for stage in REPORT_STAGES]
+            )
+            for record in files:
+                ratio = record["output_size"] / record["input_size"] if record["input_size"] and record["output_size"] is not None else ""
+                quality = record["quality"] or {}
+                writer.writerow(
+                    [record["source"], record["output"] or ""]
+                    + ["" if record[key] is None else record[key] for key in ("input_size", "output_size")]
+                    + [ratio]
+                    + ["" if quality.get(key) is None else quality[key] for key in ("cq_level", "ssim")]
+                    + [record["error"] or ""]
+                    + [record["stages"].get(stage, "") for stage in REPORT_STAGES]
+                )
+        return json_path, csv_path
+
+    def write_profile(self, path):
+        with self._lock:
+            profilers = list(self._profilers)
+        if not profilers:
+            return None
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+        return path
+
+def _stage(report, stage, path):
+    return report.stage(stage, path) if report is not None else contextlib.nullcontext()
+
+def _profiling(report):
+    return report.profiling() if report is not None else contextlib.nullcontext()
+
+def convert_image_to_avif(src_path, dst_path, encoder, report=None, on_state=None, extra_outputs=()):
+    """
+    出力は一時ファイルに書き, Exif をコピーし終わってから変換先に置き換える (途中で落ちても壊れた出力が残らない)
+    on_state: 工程が変わる毎に "tagging" で呼ばれる
+    extra_outputs: [(OutputTarget, 変換先)] 1回デコードした画素から AVIF と同時にエンコードする
+    """
+    outputs = [dst_path] + [path for _, path in extra_outputs]
+    temp_paths = [partial_output_path(path) for path in outputs]
+    for path in outputs:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    try:
+        if extra_outputs:
+            _encode_image_targets(src_path, temp_paths, encoder, [target for target, _ in extra_outputs], report)
+        else:
+            _encode_image_file(src_path, temp_paths[0], encoder, report)
+        if on_state is not None:
+            on_state("tagging")
+        # Exif情報をコピー (出力がいくつあっても exiftool の呼び出しは1回)
+        with _stage(report, "exif", src_path):
+            get_exiftool_pool().copy_tags_many(src_path, temp_paths)
+        for temp_path, path in zip(temp_paths, outputs):
+            os.replace(temp_path, path)
+    except BaseException:
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        raise
+    if report is not None:
+        report.add_file(src_path, dst_path)
+
+def _encode_image_targets(src_path, temp_paths, encoder, targets, report=None):
+    if Image is None:
+        raise RuntimeError("複数の形式への書き出しには Pillow が必要です")
+    with _stage(report, "decode", src_path):
+        image = _decode_image(src_path)
+        # 同じ大きさへの縮小は1回だけにする
+        resized = {None: image}
+        for target in targets:
+            if target.max_size not in resized:
+                thumbnail = image.copy()
+                thumbnail.thumbnail((target.max_size, target.max_size), Image.Resampling.LANCZOS)
+                resized[target.max_size] = thumbnail
+    if not encoder.in_process and os.path.splitext(src_path)[1].lower() in AVIFENC_INPUT_EXTENSIONS:
+        # avifenc には元のファイルを渡す (デコードした画素を PNG に書き直さない)
+        jobs = [(lambda path: encoder.encode_file(src_path, path), temp_paths[0])]
+    else:
+        jobs = [(lambda path: encoder.encode_image(image, path), temp_paths[0])]
+    jobs += [(lambda path, target=target: target.encode_image(resized[target.max_size], path), path) for target, path in zip(targets, temp_paths[1:])]
+    # 形式毎のエンコードを同時に進める
+    with _stage(report, "encode", src_path):
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            for future in [executor.submit(encode, path) for encode, path in jobs]:
+                future.result()
+
+def _encode_image_file(src_path, dst_path, encoder, report=None):
+    # ファイル拡張子の確認
+    file_extension = os.path.splitext(src_path)[1].lower()
+    if file_extension != '.heic':
+        with _stage(report, "encode", src_path):
+            encoder.encode_file(src_path, dst_path)
+    elif pillow_heif is not None:
+        if not encoder.in_process and pillow_can_save_avif():
+            # 一時ファイルを使わずに, デコードした画素を同じ設定の Pillow エンコーダーに渡す
+            encoder = PillowAvifEncoder(encoder.quality, encoder.jobs, encoder.codec, encoder.speed)
+        with _stage(report, "decode", src_path):
+            image = _decode_image(src_path)
+        with _stage(report, "encode", src_path):
+            encoder.encode_image(image, dst_path)
+    else:
+        # pillow-heif がない場合は一時ファイルを使用して ImageMagick から PNG に変換
+        # (Pillow がなくても動くように, PNG はデコードせずにそのままエンコーダーに渡す)
+        with _temporary_file() as temp_png_name:
+            with _stage(report, "decode", src_path):
+                subprocess.run([
+                    'magick', src_path, temp_png_name
+                ], check=True)
+            # PNG から AVIF に変換
+            with _stage(report, "encode", src_path):
+                encoder.encode_file(temp_png_name, dst_path)
+
+class JobCancelled(Exception):
+    pass
+
+class JobControl:
+    """
+    実行中の変換に中断・一時停止を伝える
+    """
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._running.set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def checkpoint(self):
+        # 一時停止中はここで待ち, 中断されていたら JobCancelled を投げる
+        self._running.wait()
+        if self._cancelled.is_set():
+            raise JobCancelled()
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+
+class ConversionStats:
+    """
+    変換の進み具合 (ファイル/秒, 残り時間, 削減できた容量)
+    """
+    def __init__(self, total=None):
+        self.total = total
+        self.done = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, src_path, dst_path):
+        src_size = os.path.getsize(src_path)
+        dst_size = os.path.getsize(dst_path)
+        with self._lock:
+            self.done += 1
+            self.bytes_in += src_size
+            self.bytes_out += dst_size
+
+    def files_per_second(self):
+        elapsed = time.monotonic() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def eta_seconds(self):
+        rate = self.files_per_second()
+        if self.total is None or rate == 0:
+            return None
+        return max(0.0, (self.total - self.done) / rate)
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_in - self.bytes_out
+
+    def summary(self):
+        eta = self.eta_seconds()
+        eta_text = "--:--" if eta is None else f"{int(eta) // 60:02d}:{int(eta) % 60:02d}"
+        return f"{self.files_per_second():.1f} ファイル/秒 · 残り {eta_text} · {format_bytes(self.bytes_saved)} 削減"
+
+class UiUpdatePump:
+    """
+    別スレッドからの画面の変更を受け取り, 決まった間隔でまとめて page.update() する
+    """
+    def __init__(self, update, fps=10):
+        self._update = update
+        self._interval = 1 / fps
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def post(self, change):
+        # change: 画面の部品を書き換える関数 (引数なし)
+        self._queue.put(change)
+
+    def _run(self):
+        while True:
+            changes = [self._queue.get()]
+            while True:
+                try:
+                    changes.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for change in changes:
+                try:
+                    change()
+                except Exception:
+                    traceback.print_exc()
+            self._update()
+            time.sleep(self._interval)
+
+def run_conversion_jobs(tasks, quality, cpu_budget, files_in_flight=None, on_file_done=None, total=None,
+                        encoder="avifenc", codec=None, speed=None, control=None, report=None, duplicates=None,
+                        adaptive=None, journal=None, on_file_failed=None, budget=None, extra_outputs=None):
+    """
+    複数のファイルを同時に変換する
+    Args:
+      tasks: (変換元のパス, 変換先のパス) のリストまたはイテレーター (列挙しながら変換を始める)
+      quality: cq-level
+      cpu_budget: 変換に使うスレッドの総数
+      files_in_flight: 同時に変換するファイル数 (None の場合は自動)
+      on_file_done: 1ファイル終わる毎に (完了数, 総数, 変換元, 変換先) で呼ばれる (総数が分からなければ None)
+      total: 総数 (tasks がリストの場合は省略できる)
+      encoder: AVIF_ENCODERS の名前
+      codec: aom / rav1e / svt (None は既定)
+      speed: エンコードの速度 0-10 (None は既定)
+      control: JobControl (中断・一時停止)
+      report: RunReport (工程毎の時間を記録する)
+      duplicates: {変換元: [(重複した変換元, 変換先)]} 変換が終わったら結果をリンクして完了として知らせる
+      adaptive: AdaptiveQuality (画像毎に cq-level を選ぶ. quality は使わない)
+      journal: JobJournal (ファイル毎の状態を記録する)
+      on_file_failed: 失敗する毎に (完了数, 総数, 変換元, 変換先, エラー) で呼ばれる (失敗しても残りの変換は続ける)
+      budget: ResourceBudget (各ファイルは読み込む直前に見積もったメモリと一時ディスクを確保し, 空くまで待つ)
+        tasks がリストの場合だけ, 見積もりの大きい画像から順に変換する (イテレーターは列挙した順)
+      extra_outputs: (変換元, 変換先) から [(OutputTarget, 追加の変換先)] を返す関数 (target_outputs)
+    Returns:
+      失敗したファイルの [(変換元, 変換先, エラー)]
+    """
+    if total is None and hasattr(tasks, "__len__"):
+        total = len(tasks) + sum(len(items) for items in (duplicates or {}).values())
+    files_in_flight, jobs_per_file = split_cpu_budget(cpu_budget, cpu_budget if total is None else total, files_in_flight)
+    create_avif_encoder(encoder, quality, jobs_per_file, codec, speed)
+    local = threading.local()
+    cache_key = f"{encoder}/{codec}/{speed}"
+    costs = {}
+    if budget is not None and hasattr(tasks, "__len__"):
+        # 大きい画像から変換する (最後に大きい画像が1つだけ残って待たされないように)
+        costs = {src: estimate_job_cost(src, encoder) for src, _ in tasks}
+        tasks = sorted(tasks, key=lambda task: costs[task[0]], reverse=True)
+
+    def thread_encoder(level, jobs=jobs_per_file):
+        # エンコーダーはスレッド毎 (cq-level, --jobs 毎) に1つ作って使い回す
+        if not hasattr(local, "encoders"):
+            local.encoders = {}
+        if (level, jobs) not in local.encoders:
+            local.encoders[level, jobs] = create_avif_encoder(encoder, level, jobs, codec, speed)
+        return local.encoders[level, jobs]
+
+    def mark(src, dst, state, error=None):
+        if journal is None:
+            return
+        try:
+            journal.mark(src, dst, state, error)
+        except sqlite3.Error:
+            # 記録できなくても変換は続ける (再開した時にそのファイルを変換し直すだけ)
+            traceback.print_exc()
+
+    def convert(src, dst):
+        if control is not None:
+            control.checkpoint()
+        cost = None
+        if budget is not None:
+            cost = costs.get(src) or estimate_job_cost(src, encoder)
+            # 画像を読み込む直前に, 予算が空くまで待つ
+            budget.acquire(cost, control)
+        try:
+            return convert_file(src, dst, cost)
+        finally:
+            if cost is not None:
+                budget.release(cost)
+
+    def convert_file(src, dst, cost):
+        # 単独で変換する大きな画像にはスレッドをすべて使う
+        jobs = cpu_budget if cost is not None and budget.is_large(cost) else jobs_per_file
+        with _profiling(report):
+            return _convert_one(src, dst, jobs)
+
+    def _convert_one(src, dst, jobs):
+        try:
+            mark(src, dst, "encoding")
+            level = quality
+            if adaptive is not None:
+                with _stage(report, "search", src):
+                    choice = adaptive.choose(src, thread_encoder, cache_key)
+                level = choice["cq_level"]
+                if report is not None:
+                    report.add_quality(src, choice)
+            convert_image_to_avif(
+                src, dst, thread_encoder(level, jobs), report, lambda state: mark(src, dst, state),
+                extra_outputs(src, dst) if extra_outputs is not None else (),
+            )
+        except JobCancelled:
+            raise
+        except Exception as exc:
+            # 1件の失敗で全体を止めない
+            error = f"{type(exc).__name__}: {exc}"
+            mark(src, dst, "failed", error)
+            if report is not None:
+                report.add_failure(src, error)
+            return error
+        # done は on_file_done (マニフェストへの記録) の後で collect が書く
+        return None
+
+    executor = ThreadPoolExecutor(max_workers=files_in_flight)
+    pending = {}
+    done_count = 0
+    failures = []
+
+    def fail(src, dst, error):
+        nonlocal done_count
+        done_count += 1
+        failures.append((src, dst, error))
+        if on_file_failed is not None:
+            on_file_failed(done_count, total, src, dst, error)
+
+    def collect():
+        nonlocal done_count
+        # 終わった順に進捗を知らせる
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            src, dst = pending.pop(future)
+            error = future.result()
+            if error is not None:
+                fail(src, dst, error)
+                for duplicate_src, duplicate_dst in (duplicates or {}).get(src, []):
+                    if report is not None:
+                        report.add_failure(duplicate_src, error)
+                    mark(duplicate_src, duplicate_dst, "failed", error)
+                    fail(duplicate_src, duplicate_dst, error)
+                continue
+            done_count += 1
+            if on_file_done is not None:
+                on_file_done(done_count, total, src, dst)
+            mark(src, dst, "done")
+            for duplicate_src, duplicate_dst in (duplicates or {}).get(src, []):
+                try:
+                    link_or_copy(dst, duplicate_dst)
+                    if extra_outputs is not None:
+                        for (_, path), (_, duplicate_path) in zip(extra_outputs(src, dst), extra_outputs(duplicate_src, duplicate_dst)):
+                            link_or_copy(path, duplicate_path)
+                    # リンクした重複もレポートの件数とサイズに含める
+                    if report is not None:
+                        report.add_file(duplicate_src, duplicate_dst)
+                except OSError as exc:
+                    error = f"{type(exc).__name__}: {exc}"
+                    if report is not None:
+                        report.add_failure(duplicate_src, error)
+                    mark(duplicate_src, duplicate_dst, "failed", error)
+                    fail(duplicate_src, duplicate_dst, error)
+                    continue
+                done_count += 1
+                if on_file_done is not None:
+                    on_file_done(done_count, total, duplicate_src, duplicate_dst)
+                mark(duplicate_src, duplicate_dst, "done")
+
+    try:
+        for src, dst in tasks:
+            if control is not None:
+                control.checkpoint()
+            # 先読みは同時変換数の2倍まで (予算が空くのを待っているファイルも数える)
+            while len(pending) >= files_in_flight * 2:
+                collect()
+            mark(src, dst, "queued")
+            for duplicate_src, duplicate_dst in (duplicates or {}).get(src, []):
+                mark(duplicate_src, duplicate_dst, "queued")
+            pending[executor.submit(convert, src, dst)] = (src, dst)
+        while pending:
+            collect()
+    except BaseException:
+        # 中断されたら残りは取り消す (記録は queued のまま残り, 次回に再開する)
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+    return failures
+
+def in_shard(relpath, shard):
+    """
+    shard: (番号, 分割数) または None
+    相対パスで振り分けるので, どのホストで実行しても同じファイルは同じ番号になる
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(relpath.replace(os.sep, "/").encode("utf-8")) % count == index
+
+def convert_directory(input_dir, output_dir, quality=30, cpu_budget=None, files_in_flight=None,
+                      recursive=False, incremental=True, use_hash=False,
+                      encoder="avifenc", codec=None, speed=None, shard=None,
+                      control=None, on_file_done=None, report=None, profile_path=None, dedup=False, adaptive=None,
+                      retry_failed=False, on_file_failed=None, budget=None, targets=None):
+    """
+    ディレクトリ内の画像を AVIF に変換する (GUI なしで使う場合の入口)
+    列挙しながら変換を始めるので, 総数は on_file_done に None で渡される
+    report に RunReport を渡すと工程毎の時間を記録する. profile_path を指定すると cProfile の結果を保存する
+    dedup=True の場合は内容が同じファイルを1回だけ変換する (ハッシュを計算するため列挙が終わってから変換を始める)
+    adaptive に AdaptiveQuality を渡すと, quality の代わりに画像毎に cq-level を選ぶ
+    前回の変換が途中で止まっていた場合は出力先の .kkImg_journal.sqlite から再開する
+    retry_failed=True の場合は前回までに失敗したファイルだけを変換し直す
+    budget に ResourceBudget を渡すと, 画像の大きさから見積もったメモリと一時ディスクが予算に収まるように変換する
+    targets に OutputTarget のリストを渡すと, 1回のデコードで AVIF と一緒にそれぞれの形式でも書き出す
+    Returns:
+      {"converted", "skipped", "failed", "resumed", "bytes_in", "bytes_out", "bytes_saved", "seconds"}
+    """
+    if profile_path is not None and report is None:
+        report = RunReport(profile=True)
+    os.makedirs(output_dir, exist_ok=True)
+    settings = avif_encoder_settings(quality, encoder, codec, speed, adaptive)
+    extra_outputs = None
+    if targets:
+        settings["outputs"] = [target.settings() for target in targets]
+        extra_outputs = target_outputs(targets, output_dir)
+    if report is not None:
+        report.extra["settings"] = settings
+    stats = ConversionStats()
+    skipped = []
+    journal = JobJournal(output_dir, shard)
+    resumed = journal.begin(settings)
+    manifest = open_manifest(output_dir) if incremental else None
+    if retry_failed:
+        tasks = [(src_path, dst_path) for src_path, dst_path, _ in journal.failed()]
+    else:
+        scan = scan_directory(input_dir, CONVERT_EXTENSIONS, recursive)
+        if report is not None:
+            scan = report.timed_iter("scan", scan)
+        entries = (entry for entry in scan if in_shard(entry.relpath, shard))
+        tasks = iter_conversion_tasks(entries, output_dir)
+        if manifest is not None:
+            tasks = iter_incremental_conversion(manifest, tasks, settings, use_hash, skipped=skipped, extra_outputs=extra_outputs)
+        if resumed:
+            tasks = journal.pending(tasks)
+    duplicates = None
+    if dedup:
+        hash_index = HashIndex()
+        try:
+            tasks, duplicates = plan_deduplicated_tasks(tasks, hash_index)
+        finally:
+            hash_index.close()
+
+    def file_done(done_count, total, src_path, dst_path):
+        if manifest is not None:
+            record_conversion(manifest, src_path, dst_path, settings, use_hash=use_hash,
+                              extra_paths=extra_output_paths(extra_outputs, src_path, dst_path))
+        stats.add(src_path, dst_path)
+        if on_file_done is not None:
+            on_file_done(done_count, total, src_path, dst_path)
+
+    try:
+        with _profiling(report):
+            failures = run_conversion_jobs(
+                tasks, quality, cpu_budget or os.cpu_count() or 1, files_in_flight,
+                on_file_done=file_done, encoder=encoder, codec=codec, speed=speed, control=control, report=report,
+                duplicates=duplicates, adaptive=adaptive, journal=journal, on_file_failed=on_file_failed,
+                budget=budget, extra_outputs=extra_outputs,
+            )
+        journal.finish()
+    finally:
+        journal.close()
+        if manifest is not None:
+            manifest.close()
+        if report is not None:
+            report.skipped = len(skipped)
+            report.finish()
+            if profile_path is not None:
+                report.write_profile(profile_path)
+    return {
+        "converted": stats.done,
+        "skipped": len(skipped),
+        "failed": len(failures),
+        "resumed": resumed,
+        "deduplicated": sum(len(items) for items in (duplicates or {}).values()),
+        "bytes_in": stats.bytes_in,
+        "bytes_out": stats.bytes_out,
+        "bytes_saved": stats.bytes_saved,
+        "seconds": round(time.monotonic() - stats.started, 3),
+    }
+
+# 複数のホストで分けて変換する場合の作業キュー (共有ディレクトリに置く)
+QUEUE_DIRNAME = ".kkImg_queue"
+QUEUE_SHARD_SIZE = 64
+QUEUE_LEASE_SECONDS = 60
+QUEUE_MAX_ATTEMPTS = 3
+
+def _write_json_atomic(path, data):
+    temp_path = partial_output_path(path)
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+def _read_json(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+class WorkQueue:
+    """
+    共有ディレクトリのファイルで作る作業キュー
+    todo/ の分割 (shard) を claimed/ に rename できたワーカーが担当し, 終わったら done/ に結果を書く
+    担当中のワーカーは claimed/ のファイルの更新日時を定期的に更新し, 更新が止まったものは todo/ に戻す
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.todo_dir = os.path.join(directory, "todo")
+        self.claimed_dir = os.path.join(directory, "claimed")
+        self.done_dir = os.path.join(directory, "done")
+        self.failed_dir = os.path.join(directory, "failed")
+        self.settings_path = os.path.join(directory, "settings.json")
+        self.finished_path = os.path.join(directory, "finished")
+
+    def create(self, settings, shards):
+        """
+        Args:
+          settings: 入出力のディレクトリと変換の設定 (すべてのワーカーが同じ設定で変換する)
+          shards: 相対パスのリストのリスト
+        """
+        queue_dirs = (self.todo_dir, self.claimed_dir, self.done_dir, self.failed_dir)
+        if os.path.isdir(self.directory) and os.listdir(self.directory):
+            # 前のキューだけを作り直す (キューでないディレクトリの中身は消さない)
+            if not os.path.isfile(self.settings_path):
+                raise ValueError(f"キューではない空でないディレクトリは使えません: {self.directory}")
+            for directory in queue_dirs:
+                shutil.rmtree(directory, ignore_errors=True)
+            for path in (self.settings_path, self.finished_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        for directory in queue_dirs:
+            os.makedirs(directory)
+        _write_json_atomic(self.settings_path, settings)
+        for index, relpaths in enumerate(shards):
+            _write_json_atomic(os.path.join(self.todo_dir, f"shard-{index:06d}.json"), relpaths)
+        return len(shards)
+
+    def settings(self):
+        return _read_json(self.settings_path)
+
+    def _claimed_path(self, shard_id, worker_id):
+        return os.path.join(self.claimed_dir, f"{shard_id}@{worker_id}.json")
+
+    def claim(self, worker_id):
+        """
+        Returns:
+          (分割の名前, 相対パスのリスト) または None (残っていない場合)
+        """
+        for name in sorted(os.listdir(self.todo_dir)):
+            if name.startswith("."):
+                # 書き込み中
+                continue
+            shard_id = os.path.splitext(name)[0]
+            claimed_path = self._claimed_path(shard_id, worker_id)
+            try:
+                # rename できたワーカーだけが担当する
+                os.rename(os.path.join(self.todo_dir, name), claimed_path)
+            except OSError:
+                continue
+            if os.path.exists(os.path.join(self.done_dir, name)):
+                # 戻された後で元のワーカーが終わらせていた
+                os.remove(claimed_path)
+                continue
+            try:
+                # rename では更新日時が変わらないので, すぐに戻されないように更新する
+                os.utime(claimed_path)
+                return shard_id, _read_json(claimed_path)
+            except FileNotFoundError:
+                continue
+        return None
+
+    def heartbeat(self, shard_id, worker_id):
+        # 担当がなくなっていたら (戻されていたら) False
+        try:
+            os.utime(self._claimed_path(shard_id, worker_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, shard_id, worker_id, result):
+        _write_json_atomic(os.path.join(self.done_dir, shard_id + ".json"), result)
+        try:
+            os.remove(self._claimed_path(shard_id, worker_id))
+        except FileNotFoundError:
+            pass
+
+    def requeue_stale(self, lease_seconds=QUEUE_LEASE_SECONDS, attempts=None, max_attempts=QUEUE_MAX_ATTEMPTS):
+        """
+        更新が止まった担当を todo/ に戻す (max_attempts 回目は failed/ に移す)
+        Args:
+          attempts: {分割の名前: 戻した回数} 呼び出し側で保持する
+        Returns:
+          戻した分割の名前のリスト
+        """
+        attempts = {} if attempts is None else attempts
+        requeued = []
+        now = time.time()
+        for name in os.listdir(self.claimed_dir):
+            claimed_path = os.path.join(self.claimed_dir, name)
+            try:
+                if now - os.stat(claimed_path).st_mtime < lease_seconds:
+                    continue
+            except FileNotFoundError:
+                continue
+            shard_id = name.split("@", 1)[0]
+            attempts[shard_id] = attempts.get(shard_id, 0) + 1
+            target_dir = self.todo_dir if attempts[shard_id] < max_attempts else self.failed_dir
+            try:
+                os.rename(claimed_path, os.path.join(target_dir, shard_id + ".json"))
+            except OSError:
+                continue
+            requeued.append(shard_id)
+        return requeued
+
+    def counts(self):
+        return {
+            name: len([entry for entry in os.listdir(directory) if entry.endswith(".json") and ".kkImg-part" not in entry])
+            for name, directory in (("todo", self.todo_dir), ("claimed", self.claimed_dir), ("done", self.done_dir), ("failed", self.failed_dir))
+        }
+
+    def results(self):
+        for name in sorted(os.listdir(self.done_dir)):
+            if name.endswith(".json") and ".kkImg-part" not in name:
+                yield _read_json(os.path.join(self.done_dir, name))
+
+    def finish(self):
+        open(self.finished_path, "w").close()
+
+    @property
+    def finished(self):
+        return os.path.exists(self.finished_path)
+
+def create_work_queue(queue_dir, input_dir, output_dir, quality=30, encoder="avifenc", codec=None, speed=None,
+                      recursive=False, incremental=True, use_hash=False, shard_size=QUEUE_SHARD_SIZE):
+    """
+    ディレクトリを列挙し, 変換が必要なファイルを shard_size 件ずつに分けてキューに入れる
+    Returns:
+      (WorkQueue, 分割数, スキップした件数)
+    """
+    settings = avif_encoder_settings(quality, encoder, codec, speed)
+    entries = list(scan_directory(input_dir, CONVERT_EXTENSIONS, recursive))
+    tasks = list(iter_conversion_tasks(entries, output_dir))
+    relpaths = {src: entry.relpath for entry, (src, _) in zip(entries, tasks)}
+    skipped = []
+    if incremental and os.path.isdir(output_dir):
+        manifest = open_manifest(output_dir)
+        try:
+            tasks, skipped = plan_incremental_conversion(manifest, tasks, settings, use_hash)
+        finally:
+            manifest.close()
+    pending = [relpaths[src] for src, _ in tasks]
+    shards = [pending[start:start + shard_size] for start in range(0, len(pending), shard_size)]
+    work_queue = WorkQueue(queue_dir)
+    work_queue.create({
+        "input": os.path.abspath(input_dir),
+        "output": os.path.abspath(output_dir),
+        "manifest_input": input_dir,
+        "manifest_output": output_dir,
+        "encoder": {"quality": int(quality), "encoder": encoder, "codec": codec, "speed": speed},
+        "settings": settings,
+        "use_hash": use_hash,
+    }, shards)
+    return work_queue, len(shards), len(skipped)
+
+def run_worker(queue_dir, worker_id=None, cpu_budget=None, input_dir=None, output_dir=None,
+               wait_for_work=False, poll_seconds=2.0, on_file_done=None):
+    """
+    キューから分割を1つずつ受け取って変換する
+    input_dir / output_dir はホスト毎にマウント先が違う場合に指定する
+    wait_for_work=True の場合はコーディネーターが終わるまで待ち続ける (False なら todo/ が空になったら終わる)
+    Returns:
+      処理した分割の数
+    """
+    work_queue = WorkQueue(queue_dir)
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    queue_settings = work_queue.settings()
+    input_dir = input_dir or queue_settings["input"]
+    output_dir = output_dir or queue_settings["output"]
+    lease_seconds = queue_settings.get("lease", QUEUE_LEASE_SECONDS)
+    # このホストで使えないエンコーダーなら, 分割を受け取って全部失敗させる前に止める
+    encoder_name = queue_settings["encoder"]["encoder"]
+    if encoder_name not in available_avif_encoders():
+        raise RuntimeError(f"このホストではエンコーダー {encoder_name} が使えません")
+    processed = 0
+    while not work_queue.finished:
+        claim = work_queue.claim(worker_id)
+        if claim is None:
+            if not wait_for_work:
+                break
+            time.sleep(poll_seconds)
+            continue
+        shard_id, relpaths = claim
+        control = JobControl()
+        stop_heartbeat = threading.Event()
+
+        def heartbeat():
+            while not stop_heartbeat.wait(lease_seconds / 4):
+                if not work_queue.heartbeat(shard_id, worker_id):
+                    # 担当が他のワーカーに移ったので止める
+                    control.cancel()
+                    return
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        converted = []
+        stats = ConversionStats(len(relpaths))
+        tasks = [
+            (os.path.join(input_dir, relpath), os.path.join(output_dir, replace_extension(relpath, 'avif')))
+            for relpath in relpaths
+        ]
+        outputs = {src: relpath for (src, _), relpath in zip(tasks, relpaths)}
+
+        def file_done(done_count, total, src_path, dst_path):
+            converted.append(outputs[src_path])
+            stats.add(src_path, dst_path)
+            if on_file_done is not None:
+                on_file_done(done_count, total, src_path, dst_path)
+
+        try:
+            failures = run_conversion_jobs(
+                tasks, queue_settings["encoder"]["quality"], cpu_budget or os.cpu_count() or 1,
+                on_file_done=file_done, control=control, budget=default_resource_budget(),
+                encoder=queue_settings["encoder"]["encoder"], codec=queue_settings["encoder"]["codec"],
+                speed=queue_settings["encoder"]["speed"],
+            )
+        except JobCancelled:
+            continue
+        finally:
+            stop_heartbeat.set()
+        work_queue.complete(shard_id, worker_id, {
+            "shard": shard_id,
+            "worker": worker_id,
+            "settings": queue_settings["settings"],
+            "converted": converted,
+            "failed": [[outputs[src], error] for src, _, error in failures],
+            "bytes_in": stats.bytes_in,
+            "bytes_out": stats.bytes_out,
+            "seconds": round(time.monotonic() - stats.started, 3),
+        })
+        processed += 1
+    return processed
+
+def run_coordinator(queue_dir, local_workers=0, cpu_budget=None, lease_seconds=QUEUE_LEASE_SECONDS,
+                    poll_seconds=1.0, on_progress=None):
+    """
+    キューが空になるまで待ち, 止まったワーカーの分割を戻し, 結果をマニフェストに記録する
+    local_workers: このホストで起動するワーカーのプロセス数 (途中で終了したら起動し直す)
+    on_progress: 状況が変わる毎に WorkQueue.counts() の結果で呼ばれる
+    Returns:
+      {"shards", "converted", "failed", "lost_shards", "requeued", "bytes_in", "bytes_out", "bytes_saved", "seconds"}
+    """
+    work_queue = WorkQueue(queue_dir)
+    queue_settings = work_queue.settings()
+    queue_settings["lease"] = lease_seconds
+    _write_json_atomic(work_queue.settings_path, queue_settings)
+    started = time.monotonic()
+    attempts = {}
+    requeued = 0
+    worker_jobs = max(1, (cpu_budget or os.cpu_count() or 1) // max(1, local_workers))
+
+    def start_worker():
+        # ワーカーの名前は既定の ホスト名-PID
+        # 進捗はコーディネーターが出すので, ワーカーの出力は捨てる
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "worker", queue_dir, "-j", str(worker_jobs)],
+            stdout=subprocess.DEVNULL,
+        )
+
+    processes = [start_worker() for _ in range(local_workers)]
+    last_counts = None
+    try:
+        while True:
+            requeued += len(work_queue.requeue_stale(lease_seconds, attempts))
+            counts = work_queue.counts()
+            if counts != last_counts and on_progress is not None:
+                on_progress(counts)
+            last_counts = counts
+            if counts["todo"] == 0 and counts["claimed"] == 0:
+                break
+            # todo/ が残っているのに終わったワーカーは起動し直す
+            for index, process in enumerate(processes):
+                if process.poll() is not None and counts["todo"] > 0:
+                    processes[index] = start_worker()
+            time.sleep(poll_seconds)
+    finally:
+        work_queue.finish()
+        for process in processes:
+            try:
+                process.wait(timeout=lease_seconds)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    summary = {"shards": 0, "converted": 0, "failed": 0, "lost_shards": work_queue.counts()["failed"],
+               "requeued": requeued, "bytes_in": 0, "bytes_out": 0}
+    # マニフェストには convert_directory と同じ形のパスで記録する
+    manifest_input = queue_settings.get("manifest_input", queue_settings["input"])
+    manifest_output = queue_settings.get("manifest_output", queue_settings["output"])
+    manifest = open_manifest(queue_settings["output"])
+    try:
+        for result in work_queue.results():
+            summary["shards"] += 1
+            summary["converted"] += len(result["converted"])
+            summary["failed"] += len(result["failed"])
+            summary["bytes_in"] += result["bytes_in"]
+            summary["bytes_out"] += result["bytes_out"]
+            for relpath in result["converted"]:
+                record_conversion(
+                    manifest, os.path.join(manifest_input, relpath),
+                    os.path.join(manifest_output, replace_extension(relpath, 'avif')),
+                    result["settings"], use_hash=queue_settings["use_hash"],
+                )
+    finally:
+        manifest.close()
+    summary["bytes_saved"] = summary["bytes_in"] - summary["bytes_out"]
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    return summary
+
+def predict_directory_dates(directory, extensions=None, recursive=False):
+    """
+    ファイル名から日時を推測する (exiftool は使わない)
+    Returns:
+      [{"path", "proposed", "rule", "tz"}] (推測できなかったものは proposed が None)
+    """
+    engine = get_date_engine()
+    results = []
+    for entry in scan_directory(directory, extensions, recursive):
+        match = engine.match(entry.name)
+        results.append({
+            "path": entry.path,
+            "proposed": format_exif_datetime(match.datetime) if match else None,
+            "rule": match.rule if match else None,
+            "tz": str(match.tz) if match and match.tz else None,
+        })
+    return results
+
+def write_directory_dates(directory, extensions=None, recursive=False, dry_run=False):
+    """
+    推測した日時が現在の DateTimeOriginal と違うファイルにだけまとめて書き込む
+    書き込む前の値は directory の .kkImg_date_undo.json に保存する
+    Returns:
+      write_dates_batch の結果
+    """
+    files = [entry.relpath for entry in scan_directory(directory, extensions, recursive)]
+    plan = plan_date_writes(directory, files)
+    changes = [(row["path"], row["proposed"]) for row in plan if row["proposed"] and row["proposed"] != row["current"]]
+    return write_dates_batch(changes, dry_run=dry_run, undo_path=os.path.join(directory, DATE_UNDO_FILENAME))
+
+def main(page: "ft.Page"):
     appHeight = 48
     appIconSize = 18
     page.window_title_bar_hidden = True
@@ -213,6 +3089,21 @@ def main(page: ft.Page):
 
 
     page.on_window_event = on_window_event
+    # 別スレッドからの画面の更新は最大10回/秒にまとめる
+    current_report = None
+
+    def timed_page_update():
+        # 変換中は画面の更新にかかった時間もレポートに入れる
+        report = current_report
+        if report is None:
+            page.update()
+            return
+        with report.stage("ui"):
+            page.update()
+
+    ui_pump = UiUpdatePump(timed_page_update, fps=10)
+    # プレビューは元の画像ではなく縮小画像を表示する
+    thumbnail_cache = ThumbnailCache()
 
     def dropdown_changed(e):
         if nav_func_switch.value == "PNG2AVIF":
@@ -271,81 +3162,245 @@ def main(page: ft.Page):
         output_file_button.text = e.path
         page.update()
 
-    def job_file_ck(e):
-        job_ck_button.text = "お待ちください..."
-        page.update()
+    last_scan_seconds = 0.0
+
+    def plan_conversion(refresh):
         job_i_dir = input_file_button.text
         job_o_dir = output_file_button.text
-        job_i_dir_list = list_png_files(job_i_dir)
-        if len(job_i_dir_list) > 0:
-            job_ck_button.text = str(len(job_i_dir_list)) + "件のファイルが見つかりました"
-            run_job_button.disabled = False
-            run_job_button.text = "実行"
-        else:
-            job_ck_button.text = "ファイルが見つかりません"
-            run_job_button.disabled = True
-            run_job_button.text = "確認を実行してください"
+        # 確認の時に読み直し, 実行の時はその結果を使う
+        nonlocal last_scan_seconds
+        scan = get_directory_scan(job_i_dir, CONVERT_EXTENSIONS, recursive_checkbox.value, refresh=refresh)
+        started = time.perf_counter()
+        tasks = list(iter_conversion_tasks(scan, job_o_dir))
+        if refresh:
+            last_scan_seconds = time.perf_counter() - started
+        settings = avif_encoder_settings(quality_slider.value, adaptive=selected_adaptive(), **selected_encoder())
+        targets = selected_targets()
+        if targets:
+            settings["outputs"] = [target.settings() for target in targets]
+        if not incremental_checkbox.value or not os.path.isdir(job_o_dir):
+            return tasks, [], settings
+        conn = open_manifest(job_o_dir)
+        try:
+            to_convert, skipped = plan_incremental_conversion(
+                conn, tasks, settings, use_hash=hash_checkbox.value, source_stats=scan.stats(),
+                extra_outputs=target_outputs(targets, job_o_dir) if targets else None,
+            )
+        finally:
+            conn.close()
+        return to_convert, skipped, settings
+
+    def plan_duplicates(tasks):
+        hash_index = HashIndex()
+        try:
+            return plan_deduplicated_tasks(tasks, hash_index)
+        finally:
+            hash_index.close()
+
+    def selected_encoder():
+        return {
+            "encoder": encoder_dropdown.value,
+            "codec": None if codec_dropdown.value == "auto" else codec_dropdown.value,
+            "speed": None if speed_dropdown.value == "auto" else int(speed_dropdown.value),
+        }
+
+    def selected_targets():
+        # 追加の出力は ; で区切る
+        return [parse_output_target(spec.strip()) for spec in (extra_targets_field.value or "").split(";") if spec.strip()]
+
+    def selected_adaptive(cache=None):
+        if not adaptive_checkbox.value:
+            return None
+        return AdaptiveQuality(target_ssim=round(ssim_slider.value, 2), cache=cache)
+
+    def job_file_ck(e):
+        job_ck_button.text = "お待ちください..."
+        job_ck_button.disabled = True
         page.update()
 
-    def run_convert(e):
-        png_file_dir = input_file_button.text
+        def work():
+            try:
+                to_convert, skipped, _ = plan_conversion(refresh=True)
+                duplicate_text = ""
+                if dedup_checkbox.value and to_convert:
+                    _, duplicates = plan_duplicates(to_convert)
+                    duplicate_text = f" (うち重複 {sum(len(items) for items in duplicates.values())}件)"
+            except ValueError as exc:
+                # 追加の出力などの指定の誤り
+                message = str(exc)
+            except Exception as exc:
+                # フォルダーが消えた, 読めないなど
+                message = f"エラー: {exc}"
+            else:
+                message = None
+            if message is not None:
+                def show_error():
+                    job_ck_button.disabled = False
+                    job_ck_button.text = message
+                    run_job_button.disabled = True
+                    run_job_button.text = "確認を実行してください"
+                ui_pump.post(show_error)
+                return
+
+            def show():
+                job_ck_button.disabled = False
+                if len(to_convert) > 0:
+                    job_ck_button.text = f"{len(skipped)}件スキップ / {len(to_convert)}件変換{duplicate_text}"
+                    run_job_button.disabled = False
+                    run_job_button.text = "実行"
+                elif len(skipped) > 0:
+                    job_ck_button.text = f"{len(skipped)}件スキップ / 変換するファイルはありません"
+                    run_job_button.disabled = True
+                    run_job_button.text = "確認を実行してください"
+                else:
+                    job_ck_button.text = "ファイルが見つかりません"
+                    run_job_button.disabled = True
+                    run_job_button.text = "確認を実行してください"
+            ui_pump.post(show)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    conversion_control = JobControl()
+
+    def run_convert(e, retry=False):
+        nonlocal conversion_control, current_report
+        cancel_button.disabled = False
         avif_file_dir = output_file_button.text
-        png_file_list = list_files(png_file_dir, ('.png', '.jpeg', '.jpg', '.heic'))
+        use_hash = hash_checkbox.value
+        encoder = selected_encoder()
+        control = conversion_control = JobControl()
         conv_prog_ring.visible = True
         conv_prog_ring_p.visible = True
-        num_count = 1
-        for png_file in png_file_list:
-            avif_file_name = replace_extension(png_file, 'avif')
-            png_full_path = os.path.join(png_file_dir, png_file)
-            avif_full_path = os.path.join(avif_file_dir, avif_file_name)
-            run_job_button.text = f"[{num_count}] {avif_file_name}"
-            conv_img_prev.src = png_full_path
-            conv_prog_ring_p.value = num_count / len(png_file_list)
-            page.update()
-            num_count += 1
+        conv_prog_ring_p.value = 0
+        run_job_button.disabled = True
+        job_ck_button.disabled = True
+        pause_button.text = "一時停止"
+        conv_control_row.visible = True
+        conv_stats_text.value = ""
+        conv_report_text.value = ""
+        retry_button.visible = False
+        report = current_report = RunReport()
+        report.add_timing("scan", last_scan_seconds)
+        page.update()
 
-            # ファイル拡張子の確認
-            file_extension = os.path.splitext(png_file)[1].lower()
-            if file_extension in ['.png', '.jpeg', '.jpg']:
-                # avifenc を使用して変換
-                subprocess.run([
-                    'avifenc', png_full_path, avif_full_path,
-                    '--min', '0', '--max', '63', '-a', 'end-usage=q',
-                    '-a', f'cq-level={int(quality_slider.value)}', '-a', 'tune=ssim',
-                    '--jobs', f'{int(jobs_slider.value)}'
-                ], check=True)
-            else:
-                # 一時ファイルを使用して ImageMagick から PNG に変換
-                with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as temp_png:
-                    temp_png_name = temp_png.name
-                    temp_png.close()
-                    subprocess.run([
-                        'magick', png_full_path, temp_png_name
-                    ], check=True)
-                    # PNG から AVIF に変換
-                    subprocess.run([
-                        'avifenc', '-a', 'end-usage=q',
-                        '--min', '0', '--max', '63', 
-                        '-a', f'cq-level={int(quality_slider.value)}',
-                        '-a', 'tune=ssim',
-                        temp_png_name, avif_full_path,
-                        '--jobs', f'{int(jobs_slider.value)}'
-                    ], check=True)
-
-                    os.remove(temp_png_name)
-
-            # Exif情報をコピー
-            subprocess.run([
-                "exiftool", 
-                "-TagsFromFile", png_full_path, avif_full_path,
-                "-overwrite_original"
-            ], check=True)
-
-        run_job_button.text = "完了"
-        conv_img_prev.src="s\\t.png"
-        conv_prog_ring.visible = False
-        conv_prog_ring_p.visible = False
-        run_job_button.disabled = False
+        def work():
+            nonlocal current_report
+            result = "完了"
+            manifest = None
+            adaptive = None
+            journal = None
+            failures = []
+            try:
+                tasks, skipped, settings = plan_conversion(refresh=False)
+                targets = selected_targets()
+                extra_outputs = target_outputs(targets, avif_file_dir) if targets else None
+                # 前回が途中で止まっていれば続きから, retry の場合は失敗したファイルだけを変換する
+                journal = JobJournal(avif_file_dir)
+                resumed = journal.begin(settings)
+                if retry:
+                    tasks, skipped = [(src, dst) for src, dst, _ in journal.failed()], []
+                elif resumed:
+                    tasks = list(journal.pending(tasks))
+                if adaptive_checkbox.value:
+                    adaptive = selected_adaptive(QualityLevelCache())
+                report.skipped = len(skipped)
+                report.extra["settings"] = settings
+                duplicates = None
+                total = len(tasks)
+                if dedup_checkbox.value and tasks:
+                    tasks, duplicates = plan_duplicates(tasks)
+                stats = ConversionStats(total)
+                manifest = open_manifest(avif_file_dir)
+                thumbnail_cache.prefetch(src for src, _ in tasks[:16])
+
+                def on_file_done(num_count, total, png_full_path, avif_full_path):
+                    record_conversion(manifest, png_full_path, avif_full_path, settings, use_hash=use_hash,
+                                      extra_paths=extra_output_paths(extra_outputs, png_full_path, avif_full_path))
+                    stats.add(png_full_path, avif_full_path)
+                    summary = stats.summary()
+                    preview = thumbnail_cache.lookup(png_full_path)
+                    thumbnail_cache.prefetch(src for src, _ in tasks[num_count:num_count + 16])
+
+                    def show():
+                        run_job_button.text = f"[{num_count}/{total}] {os.path.basename(avif_full_path)}"
+                        if preview is not None:
+                            conv_img_prev.src = preview
+                        conv_prog_ring_p.value = num_count / total
+                        conv_stats_text.value = summary
+                    ui_pump.post(show)
+
+                def on_file_failed(num_count, total, src_path, dst_path, error):
+                    def show():
+                        run_job_button.text = f"[{num_count}/{total}] 失敗: {os.path.basename(src_path)}"
+                        conv_prog_ring_p.value = num_count / total
+                    ui_pump.post(show)
+
+                failures = run_conversion_jobs(
+                    tasks,
+                    quality=settings["quality"],
+                    cpu_budget=int(jobs_slider.value),
+                    files_in_flight=int(parallel_slider.value),
+                    on_file_done=on_file_done,
+                    control=control,
+                    report=report,
+                    duplicates=duplicates,
+                    total=total,
+                    adaptive=adaptive,
+                    journal=journal,
+                    on_file_failed=on_file_failed,
+                    budget=default_resource_budget(),
+                    extra_outputs=extra_outputs,
+                    **encoder,
+                )
+                journal.finish()
+                if failures:
+                    result = f"完了 ({len(failures)}件が失敗)"
+            except JobCancelled:
+                result = "中断しました"
+            except Exception as exc:
+                traceback.print_exc()
+                result = f"エラー: {exc}"
+            finally:
+                if manifest is not None:
+                    manifest.close()
+                if journal is not None:
+                    journal.close()
+                if adaptive is not None:
+                    adaptive.cache.close()
+                report.finish()
+                current_report = None
+            try:
+                report_path, _ = report.write(os.path.join(avif_file_dir, REPORT_DIRNAME))
+                report_text = f"{report.summary_text()} ({report_path})"
+            except OSError as exc:
+                report_text = f"レポートを保存できませんでした: {exc}"
+
+            def finish():
+                run_job_button.text = result
+                conv_report_text.value = report_text
+                conv_img_prev.src="s\\t.png"
+                conv_prog_ring.visible = False
+                conv_prog_ring_p.visible = False
+                conv_control_row.visible = False
+                retry_button.visible = len(failures) > 0
+                run_job_button.disabled = False
+                job_ck_button.disabled = False
+            ui_pump.post(finish)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def pause_convert(e):
+        if conversion_control.paused:
+            conversion_control.resume()
+            pause_button.text = "一時停止"
+        else:
+            conversion_control.pause()
+            pause_button.text = "再開"
+        page.update()
+
+    def cancel_convert(e):
+        conversion_control.cancel()
+        cancel_button.disabled = True
         page.update()
 
     file_picker = ft.FilePicker(on_result=on_dialog_result)
@@ -357,9 +3412,37 @@ def main(page: ft.Page):
     input_file_button = ft.ElevatedButton(text="読み込み元ディレクトリを選択...",on_click=lambda _: file_picker.get_directory_path())
     output_file_button = ft.ElevatedButton(text="書き出し先ディレクトリを選択...",on_click=lambda _: out_file_picker.get_directory_path())
     quality_slider = ft.Slider(min=0, max=63, divisions=63, label="高 - {value} - 低", value=30)
+    # 画像毎に SSIM を満たす cq-level を探す (Pillow で AVIF を読み書きできる場合だけ)
+    adaptive_checkbox = ft.Checkbox(label="画像毎に自動で調整", value=False, disabled=not pillow_can_save_avif())
+    ssim_slider = ft.Slider(min=0.80, max=0.99, divisions=19, label="SSIM {value}", value=0.95, expand=True)
     jobs_slider = ft.Slider(min=1, max=os.cpu_count(), divisions=os.cpu_count(), label="遅 - {value} - 速", value=os.cpu_count()-1)
+    parallel_slider = ft.Slider(min=1, max=os.cpu_count(), divisions=os.cpu_count(), label="{value} ファイル", value=max(1, (os.cpu_count() - 1) // 2))
+    encoder_dropdown = ft.Dropdown(
+        label="エンコーダー", value="avifenc", width=160,
+        # avifenc は既定なので, 見つからなくても選べるようにしておく (変換の時にエラーを表示する)
+        options=[ft.dropdown.Option(name) for name in avif_encoder_choices()],
+    )
+    codec_dropdown = ft.Dropdown(
+        label="コーデック", value="auto", width=140,
+        options=[ft.dropdown.Option("auto", "自動")] + [ft.dropdown.Option(codec) for codec in AVIF_CODECS],
+    )
+    speed_dropdown = ft.Dropdown(
+        label="速度", value="auto", width=120,
+        options=[ft.dropdown.Option("auto", "既定")] + [ft.dropdown.Option(str(speed)) for speed in range(11)],
+    )
+    recursive_checkbox = ft.Checkbox(label="サブフォルダも含める", value=False)
+    incremental_checkbox = ft.Checkbox(label="変換済みで変更のないファイルはスキップする", value=True)
+    hash_checkbox = ft.Checkbox(label="更新日時が違う場合は内容で比較する", value=False)
+    dedup_checkbox = ft.Checkbox(label="内容が同じファイルは1回だけ変換する", value=False)
+    extra_targets_field = ft.TextField(label="追加の出力", hint_text="webp:D:\\thumbs:quality=75,max=512; jxl:D:\\archive", dense=True)
     job_ck_button = ft.ElevatedButton(text="変換ファイルを確認",on_click=job_file_ck)
     run_job_button = ft.FilledButton(text="確認を実行してください",on_click=run_convert,disabled=True)
+    pause_button = ft.OutlinedButton(text="一時停止", on_click=pause_convert)
+    cancel_button = ft.OutlinedButton(text="中断", on_click=cancel_convert)
+    conv_stats_text = ft.Text("")
+    conv_control_row = ft.Row([pause_button, cancel_button, conv_stats_text], visible=False)
+    retry_button = ft.OutlinedButton(text="失敗したファイルを再試行", on_click=lambda e: run_convert(e, retry=True), visible=False)
+    conv_report_text = ft.Text("", size=12, selectable=True)
     conv_img_prev = ft.Image(
                         src="s\\t.png",
                         fit=ft.ImageFit.CONTAIN,
@@ -393,9 +3476,18 @@ def main(page: ft.Page):
             ft.Row([ft.Text("入力",width=48),ft.Container(input_file_button,expand=True,tooltip="変換する画像があるディレクトリを選択します")],vertical_alignment="CENTER",spacing=10),
             ft.Row([ft.Text("出力",width=48),ft.Container(output_file_button,expand=True,tooltip="画像を保存するディレクトリを選択します")],vertical_alignment="CENTER",spacing=10),
             ft.Row([ft.Text("品質",width=48),ft.Container(quality_slider,expand=True,tooltip="エンコードの品質を選択します")],vertical_alignment="CENTER",spacing=10),
+            ft.Row([ft.Text("自動",width=48),ft.Container(ft.Row([adaptive_checkbox, ssim_slider]),expand=True,tooltip="縮小画像で試し, 目標の SSIM を満たす一番小さいファイルになる品質を画像毎に選びます (品質のスライダーは使いません)")],vertical_alignment="CENTER",spacing=10),
             ft.Row([ft.Text("仕事",width=48),ft.Container(jobs_slider,expand=True,tooltip="エンコードをするスレッドの数を選択します")],vertical_alignment="CENTER",spacing=10),
+            ft.Row([ft.Text("方式",width=48),ft.Container(ft.Row([encoder_dropdown, codec_dropdown, speed_dropdown],wrap=True),expand=True,tooltip="エンコーダーとコーデック, 速度を選択します")],vertical_alignment="CENTER",spacing=10),
+            ft.Row([ft.Text("追加",width=48),ft.Container(extra_targets_field,expand=True,tooltip="1回読み込んだ画像から AVIF と一緒に書き出す形式と出力先です (avif/webp/jpeg/jxl, ; で区切る. max は長辺の画素数)")],vertical_alignment="CENTER",spacing=10),
+            ft.Row([ft.Text("同時",width=48),ft.Container(parallel_slider,expand=True,tooltip="同時に変換するファイルの数を選択します (スレッドはファイル間で分け合います)")],vertical_alignment="CENTER",spacing=10),
+            ft.Row([ft.Text("範囲",width=48),ft.Container(ft.Row([recursive_checkbox, dedup_checkbox],wrap=True),expand=True,tooltip="サブフォルダの画像も同じ構成で出力先に変換します. 重複したファイルは変換結果をリンクします")],vertical_alignment="CENTER",spacing=10),
+            ft.Row([ft.Text("差分",width=48),ft.Container(ft.Row([incremental_checkbox, hash_checkbox],wrap=True),expand=True,tooltip="前回の変換結果 (出力先の .kkImg_manifest.sqlite) と比べます")],vertical_alignment="CENTER",spacing=10),
             ft.Row([ft.Text("確認",width=48),ft.Container(job_ck_button,expand=True,tooltip="間違いがないか確認します")],vertical_alignment="CENTER",spacing=10),
             ft.Row([ft.Container(run_job_button,expand=True,tooltip="変換を実行します")],vertical_alignment="CENTER",spacing=10),
+            conv_control_row,
+            conv_report_text,
+            retry_button,
             ft.Row([ft.Container(conv_prev_stack,expand=True)],vertical_alignment="CENTER",spacing=10),
         ]
     )
@@ -405,6 +3497,32 @@ def main(page: ft.Page):
 
         page.update()
 
+    # 一覧の項目 (ファイル名: Radio)
+    ex_radios = {}
+
+    def ex_list_label(file_name, current, predicted):
+        # 現在の値と推測した値が違うものには印を付ける
+        mark = " ≠" if predicted and current != predicted else ""
+        return f"{file_name}  {current or '----:--:-- --:--:--'} → {predicted or '-'}{mark}"
+
+    def load_ex_list_dates(directory, files):
+        # 一覧のファイルの日時をまとめて読み, 推測した値と並べて表示する
+        paths = [os.path.join(directory, file) for file in files]
+        current = get_exif_date_cache().read_many(paths)
+        matches = get_date_engine().match_many(files)
+
+        def show():
+            for file, path in zip(files, paths):
+                radio = ex_radios.get(file)
+                if radio is None:
+                    continue
+                match = matches[file]
+                radio.label = ex_list_label(
+                    file, str(current[path].get("DateTimeOriginal", "")),
+                    format_exif_datetime(match.datetime) if match else "",
+                )
+        ui_pump.post(show)
+
     def ex_job_file_ck(e):
         ex_directory_path = ex_input_file_button.text
         ex_img_list = get_image_files(ex_file_type_button.value, ex_directory_path)
@@ -412,8 +3530,13 @@ def main(page: ft.Page):
             ex_job_ck_button.text = str(len(ex_img_list)) + "ファイルが見つかりました (*." + str(ex_file_type_button.value) + ")"
             ex_file_view.visible = True
             lv_r_c.controls.clear()
+            ex_radios.clear()
             for i in ex_img_list:
-                lv_r_c.controls.append(ft.Radio(value=i, label=i))
+                ex_radios[i] = ft.Radio(value=i, label=i)
+                lv_r_c.controls.append(ex_radios[i])
+            # 一覧の先頭の縮小画像を先に作っておく
+            thumbnail_cache.prefetch(os.path.join(ex_directory_path, i) for i in ex_img_list[:50])
+            threading.Thread(target=load_ex_list_dates, args=(ex_directory_path, ex_img_list), daemon=True).start()
         else:
             ex_job_ck_button.text = "入力項目を確認してください"
             ex_file_view.visible = False
@@ -429,26 +3552,176 @@ def main(page: ft.Page):
         prev_file_name = e.control.value
         prev_file_dir = ex_input_file_button.text
         preb_file_path = os.path.join(prev_file_dir, prev_file_name)
-        picture_con.src = preb_file_path
 
-        buf = run('exiftool -T -DateTimeOriginal \"' + preb_file_path + '\"', shell=True, stdout=PIPE)
-        # buf: bytes型
-        data = buf.stdout.decode("UTF-8").strip("\n")
-        # data: str型
-        pic_date_inpit.value = data
-        page.update()
+        def work():
+            preview = thumbnail_cache.get(preb_file_path)
+            # 一覧を読み込んだ時の値があれば exiftool は呼ばない
+            tags = get_exif_date_cache().read(preb_file_path)
+
+            def show():
+                # 読み込み中に別のファイルが選ばれていたら反映しない
+                if lv_r.value == prev_file_name:
+                    picture_con.src = preview
+                    pic_date_inpit.value = str(tags.get("DateTimeOriginal", ""))
+            ui_pump.post(show)
+
+        threading.Thread(target=work, daemon=True).start()
     def img_time_predict(e):
         pic_date_inpit.value = convert_filename_to_datetime_2(lv_r.value)
         page.update()
     def img_time_write(e):
         prev_file_name = lv_r.value
         prev_file_dir = ex_input_file_button.text
+        value = pic_date_inpit.value
+        if not prev_file_name:
+            ex_write_status.value = "ファイルを選択してください"
+            page.update()
+            return
         preb_file_path = os.path.join(prev_file_dir, prev_file_name)
-        subprocess.run('exiftool -alldates=\"' + pic_date_inpit.value + '\" \"' + preb_file_path + '\"', shell=True)
+        ex_write_status.value = "書き込んでいます..."
+        ex_write_button.disabled = True
+        page.update()
+
+        def work():
+            # exiftool の書き込みは画面のスレッドでは待たない
+            try:
+                get_exiftool_pool().write_tags(preb_file_path, {"AllDates": value})
+            except Exception as exc:
+                message = f"エラー: {exc}"
+            else:
+                message = f"書き込みました: {prev_file_name}"
+            finally:
+                get_exif_date_cache().invalidate(preb_file_path)
+
+            def show():
+                ex_write_status.value = message
+                ex_write_button.disabled = False
+            ui_pump.post(show)
+            load_ex_list_dates(prev_file_dir, [prev_file_name])
+
+        threading.Thread(target=work, daemon=True).start()
+
+    bulk_plan = []
+
+    def bulk_undo_path():
+        return os.path.join(ex_input_file_button.text, DATE_UNDO_FILENAME)
+
+    def bulk_predict(e):
+        bulk_status.value = "推測しています..."
+        bulk_predict_button.disabled = True
+        page.update()
+
+        def work():
+            directory = ex_input_file_button.text
+            try:
+                files = get_image_files(ex_file_type_button.value, directory)
+                plan = [row for row in plan_date_writes(directory, files) if row["proposed"]]
+            except Exception as exc:
+                def show_error():
+                    bulk_status.value = f"エラー: {exc}"
+                    bulk_predict_button.disabled = False
+                ui_pump.post(show_error)
+                return
+
+            def show():
+                bulk_plan[:] = plan
+                bulk_table.rows.clear()
+                for row in plan:
+                    bulk_table.rows.append(ft.DataRow(
+                        cells=[
+                            ft.DataCell(ft.Checkbox(value=row["proposed"] != row["current"])),
+                            ft.DataCell(ft.Text(row["file"])),
+                            ft.DataCell(ft.Text(row["current"])),
+                            ft.DataCell(ft.Text(row["proposed"])),
+                        ]
+                    ))
+                changed = sum(1 for row in plan if row["proposed"] != row["current"])
+                bulk_status.value = f"{len(files)}件中 {len(plan)}件を推測 / {changed}件が現在の値と異なります"
+                bulk_view.visible = True
+                bulk_predict_button.disabled = False
+                bulk_write_button.disabled = len(plan) == 0
+                bulk_undo_button.disabled = not os.path.isfile(bulk_undo_path())
+            ui_pump.post(show)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def bulk_write(e):
+        changes = [
+            (row["path"], row["proposed"])
+            for row, table_row in zip(bulk_plan, bulk_table.rows)
+            if table_row.cells[0].content.value
+        ]
+        dry_run = bulk_dry_run_checkbox.value
+        bulk_status.value = "書き込んでいます..."
+        bulk_write_button.disabled = True
+        page.update()
+
+        def work():
+            try:
+                entries = write_dates_batch(changes, dry_run=dry_run, undo_path=bulk_undo_path())
+            except Exception as exc:
+                message = f"エラー: {exc}"
+            else:
+                if dry_run:
+                    message = f"ドライラン: {len(entries)}件に書き込みます (実際には書き込んでいません)"
+                else:
+                    message = f"{len(entries)}件に書き込みました"
+
+            def show():
+                bulk_status.value = message
+                bulk_write_button.disabled = False
+                bulk_undo_button.disabled = not os.path.isfile(bulk_undo_path())
+            ui_pump.post(show)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def bulk_undo(e):
+        bulk_status.value = "元に戻しています..."
+        bulk_undo_button.disabled = True
+        page.update()
+
+        def work():
+            try:
+                restored = undo_date_writes(bulk_undo_path())
+            except Exception as exc:
+                message = f"エラー: {exc}"
+            else:
+                message = f"{restored}件を元に戻しました"
+
+            def show():
+                bulk_status.value = message
+                bulk_undo_button.disabled = not os.path.isfile(bulk_undo_path())
+            ui_pump.post(show)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    bulk_predict_button = ft.ElevatedButton(text="ディレクトリ内をまとめて推測", on_click=bulk_predict)
+    bulk_dry_run_checkbox = ft.Checkbox(label="ドライラン", value=True)
+    bulk_write_button = ft.FilledTonalButton(text="チェックしたものを書込", on_click=bulk_write, disabled=True)
+    bulk_undo_button = ft.OutlinedButton(text="元に戻す", on_click=bulk_undo, disabled=True)
+    bulk_status = ft.Text("")
+    bulk_table = ft.DataTable(
+        columns=[
+            ft.DataColumn(ft.Text("書込")),
+            ft.DataColumn(ft.Text("ファイル")),
+            ft.DataColumn(ft.Text("現在の値")),
+            ft.DataColumn(ft.Text("推測した値")),
+        ],
+        rows=[],
+    )
+    bulk_view = ft.Column(
+        [
+            ft.Row([bulk_dry_run_checkbox, bulk_write_button, bulk_undo_button], wrap=True),
+            bulk_status,
+            ft.Column([bulk_table], scroll=ft.ScrollMode.AUTO, height=300),
+        ], visible=False
+    )
 
     lv_r = ft.RadioGroup(content=lv_r_c,on_change=radiogroup_changed)
     lv = ft.Column([lv_r],scroll=ft.ScrollMode.AUTO)
     pic_date_inpit = ft.TextField(label="Date/Time Original (yyyy:MM:dd hh:mm:ss)", prefix_text="",hint_text="yyyy:MM:dd hh:mm:ss",expand=True)
+    ex_write_button = ft.FilledTonalButton(text="書込", on_click=img_time_write)
+    ex_write_status = ft.Text("")
     picture_con = ft.Image(
                         src="fonts\\framed_picture_3d.png",
                         fit=ft.ImageFit.CONTAIN,
@@ -462,9 +3735,10 @@ def main(page: ft.Page):
                 [
                     pic_date_inpit,
                     ft.ElevatedButton(text="推測", on_click=img_time_predict),
-                    ft.FilledTonalButton(text="書込", on_click=img_time_write)
+                    ex_write_button
                 ]
             ),
+            ex_write_status,
             ft.Row(
                 [
                     lv,
@@ -489,11 +3763,20 @@ def main(page: ft.Page):
     page.on_resize = page_resize
 
 
+    # ユーザー定義のルールが読めなくても, 組み込みのルールで推測は続ける
+    rules_error = date_rules_error()
+    date_rules_text = ft.Text(
+        f"日時のルールを読み込めませんでした (組み込みのルールだけを使います): {rules_error}", visible=rules_error is not None,
+    )
+
     dtBut = ft.Column(
         [
+            date_rules_text,
             ft.Row([ft.Text("入力",width=48),ft.Container(ex_input_file_button,expand=True,tooltip="処理対象のディレクトリを選択します")],vertical_alignment="CENTER",spacing=10),
             ft.Row([ft.Text("種類",width=48),ft.Container(ex_file_type_button,expand=True,tooltip="処理対象の拡張子を選択します")],vertical_alignment="CENTER",spacing=10),
             ft.Row([ft.Text("検出",width=48),ft.Container(ex_job_ck_button,expand=True,tooltip="対象ファイルを検出します")],vertical_alignment="CENTER",spacing=10),
+            ft.Row([ft.Text("一括",width=48),ft.Container(bulk_predict_button,expand=True,tooltip="全てのファイルの日時をファイル名から推測して一覧にします")],vertical_alignment="CENTER",spacing=10),
+            ft.Row([ft.Container(bulk_view,expand=True)],vertical_alignment="CENTER"),
             ft.Row([ft.Container(ex_file_view,expand=True)],vertical_alignment="CENTER"),
         ],visible = False
     )
@@ -516,5 +3799,270 @@ def main(page: ft.Page):
         )
     )
 
-ft.app(target=main, assets_dir="assets")
+def run_gui():
+    if ft is None:
+        raise SystemExit("GUI を使うには flet が必要です (pip install flet)")
+    ft.app(target=main, assets_dir="assets")
+
+def _parse_shard(value):
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if not match or int(match.group(2)) < 1 or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError("K/N の形式で, 0 <= K < N にしてください")
+    return int(match.group(1)), int(match.group(2))
+
+def _parse_size(value):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([KMG]?)B?", value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError("サイズは 300K や 1.5M の形式で指定してください")
+    return int(float(match.group(1)) * 1024 ** " KMG".index(match.group(2) or " "))
+
+def _parse_output_target(value):
+    try:
+        return parse_output_target(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc)) from exc
+
+def _extensions(values):
+    if not values:
+        return None
+    return tuple(value if value.startswith(".") else "." + value for value in values)
+
+def _emit(args, record, text):
+    # --json の場合は1行1レコードの JSON を出力する
+    if args.json:
+        print(json.dumps(record, ensure_ascii=False), flush=True)
+    elif text is not None:
+        print(text, flush=True)
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog="kkImg", description="画像の再エンコードと日時の書き込み (引数なしで GUI を起動します)")
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("gui", help="GUI を起動する")
+
+    convert_parser = subparsers.add_parser("convert", help="ディレクトリ内の画像を AVIF に変換する")
+    convert_parser.add_argument("input", help="読み込み元ディレクトリ")
+    convert_parser.add_argument("output", help="書き出し先ディレクトリ")
+    convert_parser.add_argument("-q", "--quality", type=int, default=30, help="cq-level (0-63, 小さいほど高品質)")
+    convert_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="変換に使うスレッドの総数")
+    convert_parser.add_argument("-p", "--parallel", type=int, default=None, help="同時に変換するファイル数 (既定は自動)")
+    convert_parser.add_argument("-r", "--recursive", action="store_true", help="サブディレクトリも変換する")
+    convert_parser.add_argument("--no-incremental", action="store_true", help="変換済みのファイルもすべて変換し直す")
+    convert_parser.add_argument("--hash", action="store_true", help="更新日時が違う場合は内容で比較する")
+    convert_parser.add_argument("--encoder", choices=avif_encoder_choices(), default="avifenc")
+    convert_parser.add_argument("--codec", choices=AVIF_CODECS, default=None)
+    convert_parser.add_argument("--speed", type=int, choices=range(11), default=None, metavar="0-10")
+    convert_parser.add_argument("--shard", type=_parse_shard, default=None, metavar="K/N", help="N 台で分けて実行する場合の K 番目 (0 始まり)")
+    convert_parser.add_argument("--dedup", action="store_true", help="内容が同じファイルは1回だけ変換し, 結果をリンクする")
+    convert_parser.add_argument("--target-ssim", type=float, default=None, metavar="0-1", help="画像毎に, この SSIM を満たす一番大きい cq-level を探す (-q は使わない)")
+    convert_parser.add_argument("--target-size", type=_parse_size, default=None, metavar="SIZE", help="画像毎に, このサイズに収まる cq-level を探す (例: 500K)")
+    convert_parser.add_argument("--min-level", type=int, default=ADAPTIVE_MIN_LEVEL, help="自動調整で探す cq-level の下限")
+    convert_parser.add_argument("--max-level", type=int, default=ADAPTIVE_MAX_LEVEL, help="自動調整で探す cq-level の上限")
+    convert_parser.add_argument("--memory-budget", type=_parse_size, default=None, metavar="SIZE", help="同時に変換するファイルのメモリの上限 (既定は搭載メモリの半分)")
+    convert_parser.add_argument("--disk-budget", type=_parse_size, default=None, metavar="SIZE", help="一時ファイルの容量の上限 (既定は空き容量の半分)")
+    convert_parser.add_argument("--no-budget", action="store_true", help="メモリと一時ファイルの容量を制限しない")
+    convert_parser.add_argument("--target", action="append", type=_parse_output_target, default=[], metavar="FORMAT:DIR[:KEY=VALUE,...]",
+                                help="AVIF と一緒に書き出す形式 (avif/webp/jpeg/jxl, 複数指定可). 例: webp:thumbs:quality=75,max=512")
+    convert_parser.add_argument("--retry-failed", action="store_true", help="前回までに失敗したファイルだけを変換し直す")
+    convert_parser.add_argument("--json", action="store_true", help="進捗と結果を JSON Lines で出力する")
+    convert_parser.add_argument("--report", default=None, metavar="DIR", help=f"レポートの保存先 (既定は OUTPUT/{REPORT_DIRNAME})")
+    convert_parser.add_argument("--no-report", action="store_true", help="レポートを保存しない")
+    convert_parser.add_argument("--profile", default=None, metavar="FILE", help="cProfile の結果を保存する (pstats 形式)")
+
+    coordinate_parser = subparsers.add_parser("coordinate", help="変換を分割してキューに入れ, ワーカーの結果を集める")
+    coordinate_parser.add_argument("input", help="読み込み元ディレクトリ")
+    coordinate_parser.add_argument("output", help="書き出し先ディレクトリ")
+    coordinate_parser.add_argument("-q", "--quality", type=int, default=30, help="cq-level (0-63, 小さいほど高品質)")
+    coordinate_parser.add_argument("-r", "--recursive", action="store_true", help="サブディレクトリも変換する")
+    coordinate_parser.add_argument("--no-incremental", action="store_true", help="変換済みのファイルもすべて変換し直す")
+    coordinate_parser.add_argument("--hash", action="store_true", help="更新日時が違う場合は内容で比較する")
+    coordinate_parser.add_argument("--encoder", choices=avif_encoder_choices(), default="avifenc")
+    coordinate_parser.add_argument("--codec", choices=AVIF_CODECS, default=None)
+    coordinate_parser.add_argument("--speed", type=int, choices=range(11), default=None, metavar="0-10")
+    coordinate_parser.add_argument("--queue", default=None, metavar="DIR", help=f"キューの置き場所 (既定は OUTPUT/{QUEUE_DIRNAME}, すべてのワーカーから見える場所)")
+    coordinate_parser.add_argument("--shard-size", type=int, default=QUEUE_SHARD_SIZE, help="1つの分割に入れるファイル数")
+    coordinate_parser.add_argument("--workers", type=int, default=0, help="このホストで起動するワーカーの数")
+    coordinate_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="このホストのワーカーが使うスレッドの総数")
+    coordinate_parser.add_argument("--lease", type=float, default=QUEUE_LEASE_SECONDS, help="この秒数だけ応答のないワーカーの分割を他に回す")
+    coordinate_parser.add_argument("--json", action="store_true")
+
+    worker_parser = subparsers.add_parser("worker", help="キューから分割を受け取って変換する")
+    worker_parser.add_argument("queue", help="コーディネーターのキューのディレクトリ")
+    worker_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="変換に使うスレッドの総数")
+    worker_parser.add_argument("--id", default=None, help="ワーカーの名前 (既定は ホスト名-PID)")
+    worker_parser.add_argument("--input", default=None, help="このホストでの読み込み元ディレクトリ (マウント先が違う場合)")
+    worker_parser.add_argument("--output", default=None, help="このホストでの書き出し先ディレクトリ (マウント先が違う場合)")
+    worker_parser.add_argument("--wait", action="store_true", help="キューが空でもコーディネーターが終わるまで待つ")
+    worker_parser.add_argument("--json", action="store_true")
+
+    dedup_parser = subparsers.add_parser("dedup", help="複数のディレクトリから内容が同じ画像を探す")
+    dedup_parser.add_argument("directories", nargs="+")
+    dedup_parser.add_argument("-r", "--recursive", action="store_true")
+    dedup_parser.add_argument("--perceptual", action="store_true", help="見た目が近い画像も探す (Pillow が必要)")
+    dedup_parser.add_argument("--distance", type=int, default=4, help="見た目が近いとみなす dHash の距離")
+    dedup_parser.add_argument("--json", action="store_true")
+
+    predict_parser = subparsers.add_parser("predict", help="ファイル名から日時を推測する")
+    predict_parser.add_argument("directory")
+    predict_parser.add_argument("-e", "--ext", action="append", help="対象の拡張子 (複数指定可)")
+    predict_parser.add_argument("-r", "--recursive", action="store_true")
+    predict_parser.add_argument("--json", action="store_true")
+
+    write_parser = subparsers.add_parser("write-dates", help="推測した日時を Exif にまとめて書き込む")
+    write_parser.add_argument("directory")
+    write_parser.add_argument("-e", "--ext", action="append", help="対象の拡張子 (複数指定可)")
+    write_parser.add_argument("-r", "--recursive", action="store_true")
+    write_parser.add_argument("-n", "--dry-run", action="store_true", help="書き込まずに変更内容だけを表示する")
+    write_parser.add_argument("--undo", action="store_true", help="前回の書き込みを元に戻す")
+    write_parser.add_argument("--json", action="store_true")
+    return parser
+
+def cli_main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.command in (None, "gui"):
+        run_gui()
+        return 0
+
+    if args.command == "convert":
+        def on_file_done(done_count, total, src_path, dst_path):
+            _emit(args, {"event": "file", "done": done_count, "src": src_path, "dst": dst_path}, f"[{done_count}] {dst_path}")
+
+        def on_file_failed(done_count, total, src_path, dst_path, error):
+            _emit(args, {"event": "failed", "done": done_count, "src": src_path, "dst": dst_path, "error": error},
+                  f"[{done_count}] 失敗: {src_path} ({error})")
+        report = RunReport(profile=args.profile is not None)
+        budget = None if args.no_budget else default_resource_budget(args.memory_budget, args.disk_budget)
+        adaptive = None
+        try:
+            if args.target_ssim is not None or args.target_size is not None:
+                adaptive = AdaptiveQuality(
+                    args.target_ssim, args.target_size, args.min_level, args.max_level, cache=QualityLevelCache()
+                )
+            summary = convert_directory(
+                args.input, args.output, quality=args.quality, cpu_budget=args.jobs, files_in_flight=args.parallel,
+                recursive=args.recursive, incremental=not args.no_incremental, use_hash=args.hash,
+                encoder=args.encoder, codec=args.codec, speed=args.speed, shard=args.shard,
+                on_file_done=on_file_done, report=report, profile_path=args.profile, dedup=args.dedup,
+                adaptive=adaptive, retry_failed=args.retry_failed, on_file_failed=on_file_failed, budget=budget,
+                targets=args.target,
+            )
+        except KeyboardInterrupt:
+            _emit(args, {"event": "cancelled"}, "中断しました")
+            return 130
+        except Exception as exc:
+            _emit(args, {"event": "error", "message": str(exc)}, f"エラー: {exc}")
+            return 1
+        finally:
+            if adaptive is not None:
+                adaptive.cache.close()
+        if not args.no_report:
+            report_path, _ = report.write(args.report or os.path.join(args.output, REPORT_DIRNAME))
+            _emit(args, {"event": "report", "path": report_path, "stages": report.stage_percentiles()}, report.summary_text())
+        _emit(args, dict(event="summary", **summary),
+              f"{summary['converted']}件を変換 / {summary['skipped']}件をスキップ / {summary['failed']}件が失敗"
+              f" / {format_bytes(summary['bytes_saved'])} 削減 ({summary['seconds']} 秒)")
+        # 失敗したファイルは --retry-failed で変換し直せる
+        return 1 if summary["failed"] else 0
+
+    if args.command == "coordinate":
+        queue_dir = args.queue or os.path.join(args.output, QUEUE_DIRNAME)
+        try:
+            os.makedirs(args.output, exist_ok=True)
+            _, shard_count, skipped = create_work_queue(
+                queue_dir, args.input, args.output, quality=args.quality, encoder=args.encoder, codec=args.codec,
+                speed=args.speed, recursive=args.recursive, incremental=not args.no_incremental, use_hash=args.hash,
+                shard_size=args.shard_size,
+            )
+        except Exception as exc:
+            _emit(args, {"event": "error", "message": str(exc)}, f"エラー: {exc}")
+            return 1
+        _emit(args, {"event": "queued", "queue": queue_dir, "shards": shard_count, "skipped": skipped},
+              f"{shard_count}個に分割しました ({skipped}件をスキップ) {queue_dir}")
+
+        def on_progress(counts):
+            _emit(args, dict(event="progress", **counts),
+                  f"残り {counts['todo']} / 変換中 {counts['claimed']} / 完了 {counts['done']} / 失敗 {counts['failed']}")
+
+        try:
+            summary = run_coordinator(queue_dir, args.workers, args.jobs, args.lease, on_progress=on_progress)
+        except KeyboardInterrupt:
+            _emit(args, {"event": "cancelled"}, "中断しました")
+            return 130
+        _emit(args, dict(event="summary", skipped=skipped, **summary),
+              f"{summary['converted']}件を変換 / {skipped}件をスキップ / {summary['failed']}件が失敗"
+              f" / 再試行 {summary['requeued']}回 / {format_bytes(summary['bytes_saved'])} 削減 ({summary['seconds']} 秒)")
+        return 1 if summary["failed"] or summary["lost_shards"] else 0
+
+    if args.command == "worker":
+        def on_worker_file_done(done_count, total, src_path, dst_path):
+            _emit(args, {"event": "file", "src": src_path, "dst": dst_path}, f"[{done_count}/{total}] {dst_path}")
+        try:
+            processed = run_worker(args.queue, args.id, args.jobs, args.input, args.output, args.wait,
+                                   on_file_done=on_worker_file_done)
+        except RuntimeError as exc:
+            _emit(args, {"event": "error", "message": str(exc)}, f"エラー: {exc}")
+            return 1
+        _emit(args, {"event": "summary", "shards": processed}, f"{processed}個の分割を変換しました")
+        return 0
+
+    if args.command == "dedup":
+        paths = [
+            entry.path
+            for directory in args.directories
+            for entry in scan_directory(directory, CONVERT_EXTENSIONS, args.recursive)
+        ]
+        hash_index = HashIndex()
+        try:
+            hashes = hash_index.hash_files(paths, perceptual=args.perceptual)
+        finally:
+            hash_index.close()
+        groups = find_duplicate_groups(hashes)
+        for group in groups:
+            _emit(args, {"event": "duplicate", "digest": hashes[group[0]][0], "paths": group}, "\n".join(group) + "\n")
+        near = find_near_duplicate_groups(hashes, args.distance) if args.perceptual else []
+        for path, other_path, distance in near:
+            _emit(args, {"event": "near_duplicate", "paths": [path, other_path], "distance": distance}, f"~{distance}\t{path}\t{other_path}")
+        _emit(args, {"event": "summary", "files": len(paths), "duplicate_groups": len(groups), "near_duplicates": len(near)},
+              f"{len(paths)}件中 重複 {len(groups)}組 / 近い画像 {len(near)}組")
+        return 0
+
+    if args.command in ("predict", "write-dates") and date_rules_error() is not None:
+        _emit(args, {"event": "warning", "message": date_rules_error()},
+              f"日時のルールを読み込めませんでした (組み込みのルールだけを使います): {date_rules_error()}")
+
+    if args.command == "predict":
+        try:
+            rows = predict_directory_dates(args.directory, _extensions(args.ext), args.recursive)
+            for row in rows:
+                _emit(args, dict(event="date", **row), f"{row['path']}\t{row['proposed'] or '-'}")
+        except KeyboardInterrupt:
+            _emit(args, {"event": "cancelled"}, "中断しました")
+            return 130
+        except Exception as exc:
+            _emit(args, {"event": "error", "message": str(exc)}, f"エラー: {exc}")
+            return 1
+        return 0
+
+    if args.command == "write-dates":
+        try:
+            if args.undo:
+                restored = undo_date_writes(os.path.join(args.directory, DATE_UNDO_FILENAME))
+                _emit(args, {"event": "summary", "restored": restored}, f"{restored}件を元に戻しました")
+                return 0
+            entries = write_directory_dates(args.directory, _extensions(args.ext), args.recursive, dry_run=args.dry_run)
+        except KeyboardInterrupt:
+            _emit(args, {"event": "cancelled"}, "中断しました")
+            return 130
+        except Exception as exc:
+            _emit(args, {"event": "error", "message": str(exc)}, f"エラー: {exc}")
+            return 1
+        for entry in entries:
+            _emit(args, dict(event="date", **entry), f"{entry['path']}\t{entry['before'].get('DateTimeOriginal', '-')} -> {entry['after']}")
+        _emit(args, {"event": "summary", "written": 0 if args.dry_run else len(entries), "planned": len(entries)},
+              f"{len(entries)}件に{'書き込みます (ドライラン)' if args.dry_run else '書き込みました'}")
+        return 0
+    return 2
+
+if __name__ == "__main__":
+    sys.exit(cli_main())
 
@@ -0,0 +1,853 @@
+"""
+kkImg のテスト
+
+  python -m pytest tests
+
+avifenc / exiftool は tmp_path に書いた偽物 (Python スクリプト) を PATH の先頭に置いて使う
+"""
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import kkImg  # noqa: E402
+
+# 偽物のツールはシバン付きのスクリプトなので Windows では動かない
+needs_posix = pytest.mark.skipif(sys.platform == "win32", reason="偽の avifenc / exiftool はシバンで起動する")
+
+FAKE_AVIFENC = """#!{python}
+# 入力をそのまま出力に書く. 名前に bad を含むファイルは失敗する
+import shutil, sys
+src, dst = sys.argv[1], sys.argv[2]
+if "bad" in src:
+    sys.exit("avifenc: 変換できません")
+shutil.copyfile(src, dst)
+"""
+
+FAKE_EXIFTOOL = """#!{python}
+# -stay_open の受け答えをする. タグは画像の横の .tags.json に書く (なければ DateTimeOriginal だけがある)
+import csv, json, os, sys
+flood = int(os.environ.get("FAKE_EXIFTOOL_STDERR_LINES", "0"))
+
+def load(path):
+    try:
+        with open(path + ".tags.json") as f:
+            return json.load(f)
+    except OSError:
+        return {{"DateTimeOriginal": "2020:01:01 00:00:00"}}
+
+def save(path, tags):
+    with open(path + ".tags.json", "w") as f:
+        json.dump({{tag: value for tag, value in tags.items() if value}}, f)
+
+args = []
+for line in sys.stdin:
+    line = line.rstrip("\\n")
+    if args == ["-stay_open"] and line == "False":
+        break
+    if not line.startswith("-execute"):
+        args.append(line)
+        continue
+    number = line[len("-execute"):]
+    marker = None
+    if "-echo4" in args:
+        index = args.index("-echo4")
+        marker = args[index + 1]
+        del args[index:index + 2]
+    paths = [arg for arg in args if not arg.startswith("-") and os.path.exists(arg)]
+    if "-json" in args:
+        sys.stdout.write(json.dumps([dict(load(path), SourceFile=path) for path in paths]) + "\\n")
+    elif "-TagsFromFile" not in args:
+        for arg in args:
+            if arg.startswith("-csv="):
+                with open(arg[len("-csv="):], newline="") as f:
+                    for row in csv.DictReader(f):
+                        path = row.pop("SourceFile")
+                        save(path, dict(load(path), **row))
+        updates = dict(arg[1:].split("=", 1) for arg in args if arg.startswith("-") and "=" in arg and not arg.startswith("-csv="))
+        for path in paths:
+            if updates:
+                save(path, dict(load(path), **updates))
+    # 警告が大量に出た場合 (パイプの容量を超える)
+    sys.stderr.write("Warning: something odd\\n" * flood)
+    sys.stdout.write("{{ready%s}}\\n" % number)
+    sys.stdout.flush()
+    if marker:
+        sys.stderr.write(marker + "\\n")
+        sys.stderr.flush()
+    args = []
+"""
+
+
+def write_png(path, width=2, height=2, color=(255, 0, 0)):
+    # Pillow なしで作る小さな PNG
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    rows = b"".join(b"\x00" + bytes(color) * width for _ in range(height))
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows)))
+        f.write(chunk(b"IEND", b""))
+
+
+@pytest.fixture
+def fake_tools(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, source in (("avifenc", FAKE_AVIFENC), ("exiftool", FAKE_EXIFTOOL)):
+        path = bin_dir / name
+        path.write_text(source.format(python=sys.executable), encoding="utf-8")
+        path.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ.get("PATH", ""))
+    # 前のテストで起動した exiftool を使わないようにする
+    monkeypatch.setattr(kkImg, "_exiftool_pool", None)
+    yield bin_dir
+    if kkImg._exiftool_pool is not None:
+        kkImg._exiftool_pool.close()
+
+
+@pytest.fixture
+def images(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for index in range(10):
+        write_png(input_dir / f"image{index:02d}.png", color=(index * 20, 0, 0))
+    return input_dir
+
+
+# ファイル名からの日時推測
+
+@pytest.fixture
+def engine():
+    return kkImg.FilenameDateEngine(kkImg.DEFAULT_DATE_RULES)
+
+
+@pytest.mark.parametrize("filename, expected, rule", [
+    ("vlcsnap-2022-08-12-12h18m06s123.png", datetime(2022, 8, 12, 12, 18, 6, 123000), "vlcsnap"),
+    ("VirtualBox_Windows_13_08_2022_20_08_37.png", datetime(2022, 8, 13, 20, 8, 37), "virtualbox"),
+    ("Screenshot_20220812-121806.png", datetime(2022, 8, 12, 12, 18, 6), "screenshot"),
+    ("IMG_20220812_121806.jpg", datetime(2022, 8, 12, 12, 18, 6), "img"),
+    ("Polish_20220813_200837408.jpg", datetime(2022, 8, 13, 20, 8, 37, 408000), "polish"),
+    ("22-08-13-20-08-37-408_photo.jpg", datetime(2022, 8, 13, 20, 8, 37, 408000), "photo"),
+])
+def test_engine_local_time_rules(engine, filename, expected, rule):
+    match = engine.match(filename)
+    assert match.datetime == expected
+    assert match.rule == rule
+
+
+def test_engine_unix_time_rules(engine):
+    match = engine.match("Screenshot_1660318616.png")
+    assert match.datetime == datetime(2022, 8, 12, 15, 36, 56, tzinfo=timezone.utc)
+    match = engine.match("1660318616181.jpg")
+    assert kkImg.format_exif_datetime(match.datetime) == "2022:08:13 00:36:56"
+    assert match.rule == "unix_ms"
+
+
+def test_engine_no_match(engine):
+    assert engine.match("DSC01234.JPG") is None
+    assert engine.match_many(["DSC01234.JPG", "IMG_20220812_121806.jpg"])["DSC01234.JPG"] is None
+
+
+def test_polish_filename_no_longer_raises(engine, monkeypatch):
+    # 置き換える前の convert_filename_to_datetime_2 は Polish のファイル名で IndexError になっていた
+    monkeypatch.setattr(kkImg, "_date_engine", engine)
+    assert kkImg.convert_filename_to_datetime_2("Polish_20220813_200837408.jpg") == "2022:08:13 20:08:37"
+    assert kkImg.convert_filename_to_datetime_2("DSC01234.JPG") == "DSC01234.JPG"
+
+
+def test_legacy_name_uses_engine(engine, monkeypatch):
+    # 以前の convert_filename_to_datetime は Unix時間のスクリーンショットで UnboundLocalError になっていた
+    monkeypatch.setattr(kkImg, "_date_engine", engine)
+    assert kkImg.convert_filename_to_datetime("Screenshot_1660318616.png") == "2022:08:12 15:36:56"
+    assert kkImg.convert_filename_to_datetime("IMG_20220812_121806.jpg") == "2022:08:12 12:18:06"
+
+
+@pytest.mark.parametrize("pattern, prefix", [
+    (r"IMG_(?P<Y>\d{4})", "IMG_"),
+    (r"IMGS?_(?P<Y>\d{4})", "IMG"),
+    (r"a\.b", "a"),
+    (r"(?i)img_", ""),
+    (r"IMG_(?P<Y>\d{4})|DSC(?P<y>\d\d)", ""),
+    (r"IMG_(?:a|b)", "IMG_"),
+])
+def test_literal_prefix(pattern, prefix):
+    assert kkImg._literal_prefix(pattern) == prefix
+
+
+def test_engine_prefix_does_not_change_priority():
+    # 先頭の文字列がないルールも, 並んだ順に試す
+    engine = kkImg.FilenameDateEngine([
+        kkImg.DateRule("any", r".*?(?P<Y>\d{4})-(?P<m>\d\d)-(?P<d>\d\d)", None),
+        kkImg.DateRule("img", r"IMG_(?P<Y>\d{4})(?P<m>\d\d)(?P<d>\d\d)", None),
+    ])
+    assert engine.match("IMG_20220812 2021-01-02").rule == "any"
+    assert engine.match("IMG_20220812").rule == "img"
+
+
+@pytest.mark.parametrize("content", [
+    "{not json",
+    json.dumps([{"name": "broken", "pattern": "IMG_(?P<Y>"}]),
+    json.dumps([{"name": "tz", "pattern": "X(?P<Y>\\d{4})(?P<m>\\d\\d)(?P<d>\\d\\d)", "tz": "Nowhere/City"}]),
+])
+def test_broken_rules_file_falls_back_to_builtin_rules(tmp_path, monkeypatch, content):
+    rules_path = tmp_path / "rules.json"
+    rules_path.write_text(content, encoding="utf-8")
+    monkeypatch.setattr(kkImg, "DATE_RULES_CONFIG", str(rules_path))
+    monkeypatch.setattr(kkImg, "_date_engine", None)
+    monkeypatch.setattr(kkImg, "_date_rules_error", None)
+    assert kkImg.get_date_engine().match("IMG_20220812_121806.jpg").rule == "img"
+    assert kkImg.date_rules_error().startswith(str(rules_path))
+
+
+def test_user_rules_come_first(tmp_path, monkeypatch):
+    rules_path = tmp_path / "rules.json"
+    rules_path.write_text(json.dumps([{"name": "mine", "pattern": r"IMG_(?P<Y>\d{4})(?P<d>\d\d)(?P<m>\d\d)"}]))
+    monkeypatch.setattr(kkImg, "DATE_RULES_CONFIG", str(rules_path))
+    monkeypatch.setattr(kkImg, "_date_engine", None)
+    assert kkImg.get_date_engine().match("IMG_20221208_121806.jpg").datetime == datetime(2022, 8, 12)
+    assert kkImg.date_rules_error() is None
+
+
+def test_engine_invalid_date_tries_later_rules():
+    engine = kkImg.FilenameDateEngine([
+        kkImg.DateRule("ymd", r"X(?P<Y>\d{4})(?P<m>\d{2})(?P<d>\d{2})", None),
+        kkImg.DateRule("ydm", r"X\d{2}(?P<y>\d{2})(?P<d>\d{2})(?P<m>\d{2})", None),
+    ])
+    # 13月は ymd では日付にならないので, 後の ydm を使う
+    match = engine.match("X20211302")
+    assert (match.rule, match.datetime) == ("ydm", datetime(2021, 2, 13))
+    assert engine.match("X20210102").rule == "ymd"
+    assert engine.match("X20211313") is None
+
+
+def test_engine_fields_in_any_order():
+    engine = kkImg.FilenameDateEngine([kkImg.DateRule("dmy", r"(?P<d>\d\d)/(?P<m>\d\d)/(?P<Y>\d{4}) (?P<H>\d\d)", None)])
+    assert engine.match("05/06/2021 07").datetime == datetime(2021, 6, 5, 7)
+
+
+def test_engine_rejects_rule_without_date():
+    with pytest.raises(ValueError):
+        kkImg.FilenameDateEngine([kkImg.DateRule("broken", r"IMG_(?P<H>\d\d)", None)])
+
+
+# ディレクトリのスキャン
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    (root / "sub" / "deeper").mkdir(parents=True)
+    for relpath in ("a.PNG", "b.jpg", "notes.txt", "sub/c.heic", "sub/deeper/d.jpeg"):
+        (root / relpath).write_bytes(b"x" * 3)
+    return root
+
+
+def test_scan_directory_filters_and_recurses(tree):
+    flat = {entry.relpath for entry in kkImg.scan_directory(str(tree), kkImg.CONVERT_EXTENSIONS)}
+    assert flat == {"a.PNG", "b.jpg"}
+    deep = {entry.relpath for entry in kkImg.scan_directory(str(tree), kkImg.CONVERT_EXTENSIONS, recursive=True)}
+    assert deep == {"a.PNG", "b.jpg", os.path.join("sub", "c.heic"), os.path.join("sub", "deeper", "d.jpeg")}
+    entry = next(entry for entry in kkImg.scan_directory(str(tree)) if entry.name == "notes.txt")
+    assert (entry.path, entry.size) == (str(tree / "notes.txt"), 3)
+
+
+def test_directory_scan_is_shared_and_bounded(tree, tmp_path, monkeypatch):
+    monkeypatch.setattr(kkImg, "_scan_cache", kkImg.OrderedDict())
+    first = kkImg.get_directory_scan(str(tree), kkImg.CONVERT_EXTENSIONS)
+    assert kkImg.get_directory_scan(str(tree), kkImg.CONVERT_EXTENSIONS) is first
+    assert sorted(entry.name for entry in first) == ["a.PNG", "b.jpg"]
+    # 読み終わった後は記録した結果を返す
+    assert first.complete
+    assert sorted(entry.name for entry in first) == ["a.PNG", "b.jpg"]
+    assert kkImg.get_directory_scan(str(tree), kkImg.CONVERT_EXTENSIONS, refresh=True) is not first
+    for index in range(kkImg.SCAN_CACHE_SIZE + 2):
+        (tmp_path / f"other{index}").mkdir()
+        kkImg.get_directory_scan(str(tmp_path / f"other{index}"))
+    assert len(kkImg._scan_cache) == kkImg.SCAN_CACHE_SIZE
+
+
+# 変換の計画
+
+@pytest.mark.parametrize("cpu_budget, file_count, files_in_flight, expected", [
+    (8, 100, None, (8, 1)),
+    (8, 100, 2, (2, 4)),
+    (8, 3, None, (3, 2)),
+    (8, 0, None, (1, 8)),
+    (0, 10, None, (1, 1)),
+])
+def test_split_cpu_budget(cpu_budget, file_count, files_in_flight, expected):
+    assert kkImg.split_cpu_budget(cpu_budget, file_count, files_in_flight) == expected
+
+
+def test_cli_encoder_choices_follow_available_encoders(monkeypatch):
+    monkeypatch.setattr(kkImg.AvifencEncoder, "available", staticmethod(lambda: False))
+    monkeypatch.setattr(kkImg.PillowAvifEncoder, "available", staticmethod(lambda: False))
+    assert kkImg.avif_encoder_choices() == ["avifenc"]
+    with pytest.raises(SystemExit):
+        kkImg.build_arg_parser().parse_args(["convert", "in", "out", "--encoder", "pillow"])
+    monkeypatch.setattr(kkImg.PillowAvifEncoder, "available", staticmethod(lambda: True))
+    args = kkImg.build_arg_parser().parse_args(["convert", "in", "out", "--encoder", "pillow"])
+    assert args.encoder == "pillow"
+
+
+def test_parse_output_target():
+    target = kkImg.parse_output_target("webp:/srv/thumbs:quality=75,max=512,method=6")
+    assert (target.format, target.directory, target.quality, target.max_size) == ("webp", "/srv/thumbs", 75, 512)
+    assert target.options == {"method": "6"}
+    # Windows のドライブ名の : は設定と間違えない
+    assert kkImg.parse_output_target("JPEG:C:\\out").directory == "C:\\out"
+    assert kkImg.parse_output_target("jpeg:C:\\out").format == "jpeg"
+    with pytest.raises(ValueError):
+        kkImg.parse_output_target("webp")
+
+
+def test_to_rgb_or_rgba():
+    Image = pytest.importorskip("PIL.Image")
+    rgb = Image.new("RGB", (2, 2))
+    assert kkImg._to_rgb_or_rgba(rgb) is rgb
+    assert kkImg._to_rgb_or_rgba(Image.new("L", (2, 2))).mode == "RGB"
+    assert kkImg._to_rgb_or_rgba(Image.new("LA", (2, 2))).mode == "RGBA"
+    palette = Image.new("P", (2, 2))
+    palette.info["transparency"] = 0
+    assert kkImg._to_rgb_or_rgba(palette).mode == "RGBA"
+
+
+def test_decode_image_closes_file(tmp_path):
+    pytest.importorskip("PIL")
+    write_png(tmp_path / "image.png", width=3, height=2)
+    image = kkImg._decode_image(str(tmp_path / "image.png"))
+    # 読み終わった画素はファイルを閉じた後も使える
+    assert image.size == (3, 2)
+    assert image.getpixel((0, 0)) == (255, 0, 0)
+
+
+@pytest.mark.parametrize("format", ["webp", "jpeg"])
+def test_output_target_keeps_icc_profile(tmp_path, format):
+    Image = pytest.importorskip("PIL.Image")
+    ImageCms = pytest.importorskip("PIL.ImageCms")
+    profile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    image = Image.new("RGB", (4, 4), (10, 20, 30))
+    image.info["icc_profile"] = profile
+    dst_path = tmp_path / f"out.{format}"
+    kkImg.OutputTarget(format, str(tmp_path)).encode_image(image, str(dst_path))
+    with Image.open(dst_path) as written:
+        assert written.info.get("icc_profile") == profile
+
+
+def test_resource_budget_limits_concurrent_jobs():
+    budget = kkImg.ResourceBudget(memory_bytes=100, disk_bytes=None)
+    assert budget.try_acquire((40, 0))
+    assert budget.try_acquire((40, 0))
+    # 合計が予算を超えるものは待つ
+    assert not budget.try_acquire((30, 0))
+    budget.release((40, 0))
+    assert budget.try_acquire((30, 0))
+    assert budget.used == (70, 0)
+
+
+def test_resource_budget_runs_large_job_alone():
+    budget = kkImg.ResourceBudget(memory_bytes=100, disk_bytes=None)
+    large = (500, 0)
+    assert budget.is_large(large)
+    assert budget.try_acquire((10, 0))
+    # 他の変換がある間は待つ
+    assert not budget.try_acquire(large)
+    budget.release((10, 0))
+    assert budget.try_acquire(large)
+    # 大きな画像の変換中は何も始めない
+    assert not budget.try_acquire((1, 0))
+    budget.release(large)
+    assert budget.used == (0, 0)
+
+
+def test_resource_budget_acquire_waits_for_release():
+    budget = kkImg.ResourceBudget(memory_bytes=100, disk_bytes=None)
+    budget.acquire((40, 0))
+    budget.acquire((40, 0))
+    acquired = threading.Event()
+
+    def acquire():
+        budget.acquire((30, 0))
+        acquired.set()
+
+    threading.Thread(target=acquire, daemon=True).start()
+    assert not acquired.wait(0.2)
+    budget.release((40, 0))
+    assert acquired.wait(2)
+    assert budget.used == (70, 0)
+
+
+def test_resource_budget_waiting_large_job_blocks_small_jobs():
+    budget = kkImg.ResourceBudget(memory_bytes=100, disk_bytes=None)
+    large = (80, 0)
+    budget.acquire((10, 0))
+    acquired = threading.Event()
+
+    def acquire_large():
+        budget.acquire(large)
+        acquired.set()
+
+    threading.Thread(target=acquire_large, daemon=True).start()
+    time.sleep(0.2)
+    # 大きな画像が待っている間は, 予算に収まる小さな画像も始めない
+    assert not budget.try_acquire((10, 0))
+    budget.release((10, 0))
+    assert acquired.wait(2)
+    budget.release(large)
+    assert budget.try_acquire((10, 0))
+
+
+def test_resource_budget_acquire_stops_on_cancel():
+    budget = kkImg.ResourceBudget(memory_bytes=100, disk_bytes=None)
+    budget.acquire((80, 0))
+    control = kkImg.JobControl()
+    control.cancel()
+    with pytest.raises(kkImg.JobCancelled):
+        budget.acquire((80, 0), control, poll_seconds=0.01)
+    assert budget.used == (80, 0)
+
+
+def test_read_image_size(tmp_path):
+    png = tmp_path / "a.png"
+    write_png(png, 7, 3)
+    assert tuple(kkImg.read_image_size(str(png))) == (7, 3)
+    truncated = tmp_path / "truncated.jpg"
+    truncated.write_bytes(b"\xff\xd8\xff\xff")
+    assert kkImg.read_image_size(str(truncated)) is None
+    memory, disk = kkImg.estimate_job_cost(str(truncated))
+    assert memory >= kkImg.JOB_BASE_MEMORY and disk == 4
+
+
+# プレビューの縮小画像
+
+def test_thumbnail_cache_evicts_least_recently_used(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    sources = []
+    for name in ("a", "b", "c"):
+        path = tmp_path / f"{name}.png"
+        Image.new("RGB", (640, 480), (200, 30, 30)).save(path)
+        sources.append(str(path))
+    cache = kkImg.ThumbnailCache(directory=str(tmp_path / "cache"), max_bytes=10 ** 9, size=64)
+    first = cache.get(sources[0])
+    assert first != sources[0]
+    with Image.open(first) as thumbnail:
+        assert max(thumbnail.size) == 64
+    # 縮小画像2つ分だけ残す
+    cache.max_bytes = 2 * os.path.getsize(first)
+    second = cache.get(sources[1])
+    assert cache.lookup(sources[0]) == first
+    third = cache.get(sources[2])
+    assert not os.path.exists(second)
+    assert cache.lookup(sources[1]) is None
+    assert os.path.exists(first) and os.path.exists(third)
+    # 次に起動した時も残っている縮小画像を使う
+    reopened = kkImg.ThumbnailCache(directory=str(tmp_path / "cache"), max_bytes=cache.max_bytes, size=64)
+    assert reopened.lookup(sources[0]) == first
+    assert reopened.lookup(sources[2]) == third
+
+
+# exiftool
+
+@needs_posix
+def test_exiftool_large_stderr_does_not_block(fake_tools, monkeypatch):
+    monkeypatch.setenv("FAKE_EXIFTOOL_STDERR_LINES", "20000")
+    process = kkImg.ExifToolProcess()
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(output=process.execute("-ver")), daemon=True)
+    thread.start()
+    thread.join(20)
+    # 止まった場合はロックが外れないので close() は呼ばない
+    assert not thread.is_alive(), "exiftool の stderr が詰まって止まった"
+    try:
+        stdout, stderr = result["output"]
+        assert stderr.count("Warning") == 20000
+        # 次の呼び出しに前の出力が混ざらない
+        stdout, stderr = process.execute("-ver")
+        assert stderr.count("Warning") == 20000
+    finally:
+        process.close()
+
+
+# Exif の読み込みキャッシュ
+
+class CountingPool:
+    size = 2
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def read_tags_many(self, paths, tags):
+        with self._lock:
+            self.calls.append(sorted(os.path.basename(path) for path in paths))
+        return {path: {"DateTimeOriginal": f"{os.path.basename(path)}@{os.path.getsize(path)}"} for path in paths}
+
+
+def test_exif_tag_cache_rereads_only_changed_files(images):
+    pool = CountingPool()
+    cache = kkImg.ExifTagCache(chunk_size=4, pool=pool)
+    paths = sorted(str(path) for path in images.iterdir())
+    first = cache.read_many(paths)
+    # 4件ずつに分けて読む
+    assert sorted(len(call) for call in pool.calls) == [2, 4, 4]
+    assert cache.read_many(paths) == first
+    assert len(pool.calls) == 3
+
+    # 書き換えられたファイルと, invalidate したファイルだけを読み直す
+    write_png(images / "image01.png", width=5, height=5)
+    cache.invalidate(str(images / "image02.png"))
+    second = cache.read_many(paths)
+    assert pool.calls[3:] == [["image01.png", "image02.png"]]
+    assert second[str(images / "image01.png")] != first[str(images / "image01.png")]
+    assert cache.read(str(images / "missing.png")) == {}
+
+
+# 日時の一括書き込み
+
+@needs_posix
+def test_write_dates_batch_and_undo(fake_tools, images, tmp_path, monkeypatch):
+    monkeypatch.setattr(kkImg, "_exif_date_cache", None)
+    paths = [str(images / f"image0{index}.png") for index in range(3)]
+    changes = [(path, f"2019:05:0{index + 1} 12:00:00") for index, path in enumerate(paths)]
+    undo_path = tmp_path / "undo.json"
+    cache = kkImg.get_exif_date_cache()
+    assert cache.read(paths[0])["DateTimeOriginal"] == "2020:01:01 00:00:00"
+
+    entries = kkImg.write_dates_batch(changes, dry_run=True, undo_path=str(undo_path))
+    assert [(entry["path"], entry["after"]) for entry in entries] == changes
+    assert entries[0]["before"] == {"DateTimeOriginal": "2020:01:01 00:00:00"}
+    assert not undo_path.exists()
+
+    kkImg.write_dates_batch(changes, undo_path=str(undo_path))
+    pool = kkImg.get_exiftool_pool()
+    assert pool.read_tags(paths[1], kkImg.ALL_DATE_TAGS) == dict.fromkeys(kkImg.ALL_DATE_TAGS, "2019:05:02 12:00:00")
+    # 書き込んだファイルの古い値はキャッシュから返さない
+    assert cache.read(paths[0])["DateTimeOriginal"] == "2019:05:01 12:00:00"
+
+    # 元々なかったタグは消して, 書き込む前の値に戻す
+    assert kkImg.undo_date_writes(str(undo_path)) == 3
+    assert not undo_path.exists()
+    for path in paths:
+        assert pool.read_tags(path, kkImg.ALL_DATE_TAGS) == {"DateTimeOriginal": "2020:01:01 00:00:00"}
+    assert cache.read(paths[0])["DateTimeOriginal"] == "2020:01:01 00:00:00"
+
+
+# 重複の検出
+
+@needs_posix
+def test_duplicates_are_converted_once_and_linked(fake_tools, images, tmp_path):
+    (images / "copy_of_00.png").write_bytes((images / "image00.png").read_bytes())
+    (images / "again_00.png").write_bytes((images / "image00.png").read_bytes())
+    (images / "copy_of_05.png").write_bytes((images / "image05.png").read_bytes())
+    output_dir = tmp_path / "output"
+    tasks = list(kkImg.iter_conversion_tasks(kkImg.scan_directory(str(images), kkImg.CONVERT_EXTENSIONS), str(output_dir)))
+    hash_index = kkImg.HashIndex(str(tmp_path / "hash_index.sqlite"))
+    try:
+        unique_tasks, duplicates = kkImg.plan_deduplicated_tasks(tasks, hash_index)
+    finally:
+        hash_index.close()
+    assert len(unique_tasks) == 10
+    assert sum(len(items) for items in duplicates.values()) == 3
+
+    done = []
+    failures = kkImg.run_conversion_jobs(
+        unique_tasks, 30, 2, duplicates=duplicates,
+        on_file_done=lambda count, total, src, dst: done.append(os.path.basename(dst)),
+    )
+    assert failures == []
+    assert len(done) == 13
+    # 重複は変換結果へのリンク (またはコピー) になる
+    for name, original in (("copy_of_00", "image00"), ("again_00", "image00"), ("copy_of_05", "image05")):
+        assert (output_dir / f"{name}.avif").read_bytes() == (output_dir / f"{original}.avif").read_bytes()
+        assert os.path.samefile(output_dir / f"{name}.avif", output_dir / f"{original}.avif")
+
+
+# 変換済みファイルの記録 (マニフェスト)
+
+@needs_posix
+def test_manifest_skips_unchanged_and_reconverts_changes(fake_tools, images, tmp_path):
+    output_dir = tmp_path / "output"
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2)
+    assert (summary["converted"], summary["skipped"]) == (10, 0)
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2)
+    assert (summary["converted"], summary["skipped"]) == (0, 10)
+    # 内容が変わった変換元と, 消された出力だけを変換し直す
+    write_png(images / "image01.png", width=3, height=3)
+    os.remove(output_dir / "image02.avif")
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2)
+    assert (summary["converted"], summary["skipped"]) == (2, 8)
+    assert (output_dir / "image01.avif").read_bytes() == (images / "image01.png").read_bytes()
+    # 設定が変わったら全部変換し直す
+    summary = kkImg.convert_directory(str(images), str(output_dir), quality=20, cpu_budget=2)
+    assert (summary["converted"], summary["skipped"]) == (10, 0)
+
+
+@needs_posix
+def test_manifest_hash_ignores_touched_sources(fake_tools, images, tmp_path):
+    output_dir = tmp_path / "output"
+    kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2, use_hash=True)
+    stat = os.stat(images / "image03.png")
+    os.utime(images / "image03.png", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2, use_hash=True)
+    assert (summary["converted"], summary["skipped"]) == (0, 10)
+    os.utime(images / "image03.png", ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2)
+    assert (summary["converted"], summary["skipped"]) == (1, 9)
+
+
+# 変換の再開
+
+@needs_posix
+def test_journal_resumes_cancelled_batch(fake_tools, images, tmp_path):
+    output_dir = tmp_path / "output"
+    control = kkImg.JobControl()
+
+    def on_file_done(done_count, total, src_path, dst_path):
+        if done_count == 3:
+            control.cancel()
+
+    with pytest.raises(kkImg.JobCancelled):
+        kkImg.convert_directory(str(images), str(output_dir), cpu_budget=1, files_in_flight=1, incremental=False,
+                                control=control, on_file_done=on_file_done)
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2, incremental=False)
+    assert summary["resumed"]
+    assert summary["converted"] == 7
+    assert sorted(name for name in os.listdir(output_dir) if name.endswith(".avif")) == [
+        f"image{index:02d}.avif" for index in range(10)
+    ]
+    # 終わった変換は再開しない
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2, incremental=False)
+    assert not summary["resumed"]
+    assert summary["converted"] == 10
+
+
+@needs_posix
+def test_journal_keeps_failures_for_retry(fake_tools, images, tmp_path):
+    write_png(images / "bad.png")
+    output_dir = tmp_path / "output"
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2)
+    assert (summary["converted"], summary["failed"]) == (10, 1)
+    journal = kkImg.JobJournal(str(output_dir))
+    try:
+        assert [os.path.basename(src) for src, _, _ in journal.failed()] == ["bad.png"]
+    finally:
+        journal.close()
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2, retry_failed=True)
+    assert (summary["converted"], summary["failed"]) == (0, 1)
+
+
+@needs_posix
+def test_manifest_regenerates_missing_target_output(fake_tools, images, tmp_path):
+    pytest.importorskip("PIL")
+    output_dir = tmp_path / "output"
+    targets = [kkImg.parse_output_target(f"webp:{tmp_path / 'webp'}:quality=70")]
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2, targets=targets)
+    assert summary["converted"] == 10
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2, targets=targets)
+    assert (summary["converted"], summary["skipped"]) == (0, 10)
+    # AVIF が残っていても, 消えた webp は作り直す
+    os.remove(tmp_path / "webp" / "image03.webp")
+    summary = kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2, targets=targets)
+    assert (summary["converted"], summary["skipped"]) == (1, 9)
+    assert (tmp_path / "webp" / "image03.webp").exists()
+
+
+@needs_posix
+def test_targets_pass_original_file_to_avifenc(fake_tools, images, tmp_path):
+    pytest.importorskip("PIL")
+    output_dir = tmp_path / "output"
+    targets = [kkImg.parse_output_target(f"jpeg:{tmp_path / 'jpeg'}")]
+    kkImg.convert_directory(str(images), str(output_dir), cpu_budget=2, targets=targets)
+    # 偽の avifenc は入力をそのまま書くので, 一時 PNG を経由していなければ元のファイルと同じになる
+    for index in range(10):
+        name = f"image{index:02d}"
+        assert (output_dir / f"{name}.avif").read_bytes() == (images / f"{name}.png").read_bytes()
+        assert (tmp_path / "jpeg" / f"{name}.jpg").exists()
+
+
+def test_journal_rejects_unknown_state(tmp_path):
+    journal = kkImg.JobJournal(str(tmp_path))
+    try:
+        with pytest.raises(ValueError):
+            journal.mark("a.png", "a.avif", "finished")
+        journal.mark("a.png", "a.avif", "done")
+        assert journal.counts() == {"done": 1}
+    finally:
+        journal.close()
+
+
+def test_journal_per_shard(tmp_path):
+    first = kkImg.JobJournal(str(tmp_path), (0, 2))
+    second = kkImg.JobJournal(str(tmp_path), (1, 2))
+    first.close()
+    second.close()
+    assert sorted(os.listdir(tmp_path)) == [".kkImg_journal-0-of-2.sqlite", ".kkImg_journal-1-of-2.sqlite"]
+
+
+# コマンドライン
+
+def json_events(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+@needs_posix
+def test_cli_convert_json_output(fake_tools, images, tmp_path, capsys):
+    write_png(images / "bad.png")
+    output_dir = tmp_path / "output"
+    assert kkImg.cli_main(["convert", str(images), str(output_dir), "-j", "2", "--json"]) == 1
+    events = json_events(capsys)
+    files = [event for event in events if event["event"] == "file"]
+    # 失敗も進捗の件数に数える
+    assert sorted(event["done"] for event in events if event["event"] in ("file", "failed")) == list(range(1, 12))
+    assert {os.path.basename(event["dst"]) for event in files} == {f"image{index:02d}.avif" for index in range(10)}
+    assert [os.path.basename(event["src"]) for event in events if event["event"] == "failed"] == ["bad.png"]
+    report = next(event for event in events if event["event"] == "report")
+    assert os.path.isfile(report["path"])
+    assert report["stages"]["encode"]["count"] == 11
+    assert events[-1]["event"] == "summary"
+    assert (events[-1]["converted"], events[-1]["failed"]) == (10, 1)
+
+    # 2回目は全部スキップする (失敗したファイルは --retry-failed で変換し直す)
+    os.remove(images / "bad.png")
+    assert kkImg.cli_main(["convert", str(images), str(output_dir), "--json", "--no-report"]) == 0
+    events = json_events(capsys)
+    assert [event["event"] for event in events] == ["summary"]
+    assert (events[0]["converted"], events[0]["skipped"]) == (0, 10)
+
+
+def test_cli_reports_errors_as_json(tmp_path, capsys):
+    assert kkImg.cli_main(["convert", str(tmp_path / "missing"), str(tmp_path / "output"), "--json"]) == 1
+    events = json_events(capsys)
+    assert [event["event"] for event in events] == ["error"]
+
+
+@needs_posix
+def test_cli_predict_json_output(fake_tools, tmp_path, capsys):
+    write_png(tmp_path / "Screenshot_20200102-030405.png")
+    write_png(tmp_path / "holiday.png")
+    assert kkImg.cli_main(["predict", str(tmp_path), "--json"]) == 0
+    events = {os.path.basename(event["path"]): event for event in json_events(capsys) if event["event"] == "date"}
+    assert events["Screenshot_20200102-030405.png"]["proposed"] == "2020:01:02 03:04:05"
+    assert events["Screenshot_20200102-030405.png"]["rule"] == "screenshot"
+    assert events["holiday.png"]["proposed"] is None
+
+
+# 共有ディレクトリの作業キュー
+
+def test_work_queue_claim_and_complete(tmp_path):
+    work_queue = kkImg.WorkQueue(str(tmp_path / "queue"))
+    assert work_queue.create({"input": "in"}, [["a.png"], ["b.png"]]) == 2
+    first = work_queue.claim("worker-1")
+    second = work_queue.claim("worker-2")
+    assert first == ("shard-000000", ["a.png"])
+    assert second == ("shard-000001", ["b.png"])
+    assert work_queue.claim("worker-3") is None
+    work_queue.complete(first[0], "worker-1", {"converted": ["a.png"]})
+    assert work_queue.counts() == {"todo": 0, "claimed": 1, "done": 1, "failed": 0}
+    assert list(work_queue.results()) == [{"converted": ["a.png"]}]
+
+
+def test_work_queue_requeues_stale_claims(tmp_path):
+    work_queue = kkImg.WorkQueue(str(tmp_path / "queue"))
+    work_queue.create({}, [["a.png"]])
+    shard_id, _ = work_queue.claim("worker-1")
+    attempts = {}
+    assert work_queue.requeue_stale(60, attempts) == []
+    # 止まったワーカー (更新日時が古いまま)
+    stale = time.time() - 120
+    claimed_path = os.path.join(work_queue.claimed_dir, f"{shard_id}@worker-1.json")
+    os.utime(claimed_path, (stale, stale))
+    assert work_queue.requeue_stale(60, attempts) == [shard_id]
+    assert not work_queue.heartbeat(shard_id, "worker-1")
+    assert work_queue.claim("worker-2")[0] == shard_id
+    # max_attempts 回目は failed/ に移す
+    claimed_path = os.path.join(work_queue.claimed_dir, f"{shard_id}@worker-2.json")
+    os.utime(claimed_path, (stale, stale))
+    assert work_queue.requeue_stale(60, attempts, max_attempts=2) == [shard_id]
+    assert work_queue.counts() == {"todo": 0, "claimed": 0, "done": 0, "failed": 1}
+
+
+def test_work_queue_create_keeps_other_files(tmp_path):
+    # キューではないディレクトリを --queue に指定しても中身を消さない
+    directory = tmp_path / "photos"
+    directory.mkdir()
+    (directory / "keep.jpg").write_bytes(b"x")
+    with pytest.raises(ValueError):
+        kkImg.WorkQueue(str(directory)).create({}, [["a.png"]])
+    assert os.listdir(directory) == ["keep.jpg"]
+
+
+def test_work_queue_create_replaces_previous_queue(tmp_path):
+    work_queue = kkImg.WorkQueue(str(tmp_path / "queue"))
+    work_queue.create({"run": 1}, [["a.png"], ["b.png"]])
+    work_queue.claim("worker-1")
+    work_queue.finish()
+    (tmp_path / "queue" / "notes.txt").write_text("x")
+    work_queue.create({"run": 2}, [["c.png"]])
+    assert work_queue.settings() == {"run": 2}
+    assert work_queue.counts() == {"todo": 1, "claimed": 0, "done": 0, "failed": 0}
+    assert not work_queue.finished
+    assert (tmp_path / "queue" / "notes.txt").exists()
+
+
+@needs_posix
+def test_coordinator_with_two_local_workers(fake_tools, images, tmp_path):
+    output_dir = tmp_path / "output"
+    queue_dir = tmp_path / "queue"
+    _, shard_count, skipped = kkImg.create_work_queue(str(queue_dir), str(images), str(output_dir), shard_size=3)
+    assert (shard_count, skipped) == (4, 0)
+    summary = kkImg.run_coordinator(str(queue_dir), local_workers=2, cpu_budget=2, poll_seconds=0.1)
+    assert (summary["shards"], summary["converted"], summary["failed"], summary["lost_shards"]) == (4, 10, 0, 0)
+    assert sorted(name for name in os.listdir(output_dir) if name.endswith(".avif")) == [
+        f"image{index:02d}.avif" for index in range(10)
+    ]
+    # コーディネーターがマニフェストに記録するので, 次は全てスキップする
+    _, shard_count, skipped = kkImg.create_work_queue(str(queue_dir), str(images), str(output_dir), shard_size=3)
+    assert (shard_count, skipped) == (0, 10)
+    with open(queue_dir / "settings.json", encoding="utf-8") as f:
+        assert json.load(f)["input"] == str(images)
+
+
+# 実行レポート
+
+@pytest.mark.parametrize("values, fraction, expected", [
+    (list(range(1, 11)), 0.5, 5),
+    (list(range(1, 11)), 0.9, 9),
+    (list(range(1, 11)), 0.99, 10),
+    (list(range(1, 101)), 0.99, 99),
+    (list(range(1, 101)), 0.9, 90),
+    ([7], 0.5, 7),
+    ([1, 2], 0.5, 1),
+    ([], 0.5, None),
+])
+def test_percentile_nearest_rank(values, fraction, expected):
+    assert kkImg._percentile(values, fraction) == expected
+
+
+def test_report_stage_percentiles():
+    report = kkImg.RunReport()
+    for index in range(10):
+        report.add_timing("encode", float(index + 1), f"file{index}.png")
+    stages = report.stage_percentiles()["encode"]
+    assert (stages["count"], stages["p50"], stages["p90"], stages["max"]) == (10, 5.0, 9.0, 10.0)
+
+
+@needs_posix
+def test_profile_with_parallel_workers(fake_tools, images, tmp_path):
+    import pstats
+
+    profile_path = tmp_path / "run.prof"
+    summary = kkImg.convert_directory(str(images), str(tmp_path / "output"), cpu_budget=4, files_in_flight=4,
+                                      profile_path=str(profile_path))
+    assert (summary["converted"], summary["failed"]) == (10, 0)
+    functions = {name for _, _, name in pstats.Stats(str(profile_path)).stats}
+    assert "run_conversion_jobs" in functions